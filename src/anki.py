@@ -2,13 +2,59 @@ import os
 import re
 import argparse
 import random
+import hashlib
+import heapq
+import math
+import sys
+import marshal
+import sqlite3
+import io
+import codecs
+from itertools import compress
+from contextlib import nullcontext, ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import freeze_support
+
+from matcher import AnkiMatcher
+from lemma import LemmaMatcher, INFLECTORS, loadLemmaTable
+from runstats import RunStats
+from scheduler import Scheduler, SCHEDULE_SUFFIX
+from countcache import CountCache, fileDigest, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, DIGEST_BLOCK
+from readers import openText, isPlainText, DEFAULT_ENCODING
+from atomicfile import atomicWrite
 
 MINN_CONF = 1
 MAXX_CONF = 5
+KNOWN_CONFIDENCE = 4  # History words last rated at least this are known; rated lower, they are still being learned
+CHUNK_SIZE = 1 << 20  # Characters read per step when scanning a text file
+SNAPSHOT_SUFFIX = ".snap"  # Compiled copy of a dictionary TSV, written next to it
+SNAPSHOT_VERSION = 2
+JOURNAL_SUFFIX = ".journal"  # Append-only log of history changes, written next to the history TSV
+JOURNAL_MIN_ENTRIES = 1000  # The journal is folded into the TSV once it holds more entries than this
+JOURNAL_COMPACT_RATIO = 0.5  # ... and more than this fraction of the history size
+KNOWN_SUFFIX = ".known"  # Known-word index of a history, written next to the history TSV
+KNOWN_REFRESH_ROWS = 1000  # The index is saved again once loading it read more journal rows than this past it
+KNOWN_VERSION = 2
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")  # Dictionary/history paths opened as SqliteAnkiDictionary
+TSV_HEADER = "id\tWord1\tWord2\tPronunciation\tMeaning\tTranslation\tExtra1\tExtra2\tFalse\tconfidence\n"
 DBUG = False
 
+# What counts as an occurrence of a word
+COUNT_SUBSTRING = "substring"  # Every occurrence of either form in the raw text, as str.count would find it
+COUNT_SEGMENT = "segment"  # Tokens of a longest-match segmentation of the text over the dictionary forms
+COUNT_LEMMA = "lemma"  # Whitespace-delimited tokens, each inflected form counted for its dictionary lemma
+COUNT_MODES = (COUNT_SUBSTRING, COUNT_SEGMENT, COUNT_LEMMA)
+
+# How review cards are drawn from the tagged words
+SAMPLE_UNIFORM = "uniform"  # Every tagged word equally likely
+SAMPLE_FREQUENCY = "frequency"  # Weighted by how often the word occurs in the scanned text
+
+# How requiredCount is applied when several text files are tagged
+THRESHOLD_FILE = "file"  # A word is tagged if it reaches requiredCount in any single file
+THRESHOLD_CORPUS = "corpus"  # Counts are summed over all files before the threshold is applied
+
 class AnkiWord:
-    def __init__(self, id, simplified, traditional, pronunciation, meaning, translation, extra1, extra2, tag, confidence):
+    def __init__(self, id, simplified, traditional, pronunciation, meaning, translation, extra1, extra2, tag, confidence=MINN_CONF):
         try:
             conf = int(confidence)
         except ValueError:
@@ -24,16 +70,185 @@ class AnkiWord:
         self.extra1 = extra1  # Some extra field (e.g., tags or notes)
         self.extra2 = extra2  # Another extra field
         self.tag = tag  # Boolean tag for tracking if the word meets appearance threshold
-        self.confidence = max(MINN_CONF, min(MAXX_CONF, int(confidence)))
+        self.confidence = max(MINN_CONF, min(MAXX_CONF, conf))
         # self.confidence = confidence
 
     def __repr__(self):
         return f"AnkiWord(id={self.id}, simplified={self.simplified}, traditional={self.traditional}, " \
                f"pronunciation={self.pronunciation}, meaning={self.meaning}, translation={self.translation})"
 
+def _wordFromParts(parts):
+    # One 10-field TSV row -> AnkiWord
+    return AnkiWord(
+        id=parts[0],
+        simplified=parts[1],
+        traditional=parts[2],
+        pronunciation=parts[3],
+        meaning=parts[4],
+        translation=parts[5],
+        extra1=parts[6],
+        extra2=parts[7],
+        tag=parts[8].strip().lower() == "true",  # Convert string "True"/"False" to boolean
+        confidence=parts[9]  # must match the param in your AnkiWord constructor
+    )
+
+def _row(word):
+    return (word.id, word.simplified, word.traditional, word.pronunciation, word.meaning,
+            word.translation, word.extra1, word.extra2, bool(word.tag), word.confidence)
+
+def _rowLine(word, extra1=None, tag=None):
+    extra1 = word.extra1 if extra1 is None else extra1
+    tag = word.tag if tag is None else tag
+    return (f"{word.id}\t{word.simplified}\t{word.traditional}\t{word.pronunciation}\t{word.meaning}"
+            f"\t{word.translation}\t{extra1}\t{word.extra2}\t{tag}\t{word.confidence}\n")
+
 class AnkiDictionary:
     def __init__(self):
-        self.words = []  # List to store AnkiWord objects
+        self.words = []  # List to store AnkiWord objects (assigning it rebuilds the indexes below)
+        self.countMode = COUNT_SUBSTRING  # One of COUNT_MODES
+        self.textEncoding = DEFAULT_ENCODING  # Codec of the text files, e.g. gb18030 or big5; see readers.openText
+        self.lemmaLanguage = None  # Suffix rules used by COUNT_LEMMA, a key of lemma.INFLECTORS
+        self.lemmaTable = None  # Optional surface form -> lemmas table used by COUNT_LEMMA
+        self._lemmaTableVersion = ""
+        self._lemmaMatcher = None  # LemmaMatcher, and the (matcher, language, table) it was built for
+        self._lemmaFor = None
+        self._dirty = set()  # Positions of words added or changed by addNewWords since the last journaled save
+        self._journalFile = None  # Journal replayed by loadFromFile, and how many entries it holds
+        self._journalEntries = 0
+        self.knownWords = None  # KnownWordIndex of this history, kept up to date by addNewWords and saved by saveJournaled
+        self._matcher = None  # AnkiMatcher over every form in self.words, built on first use
+        self._matcherForms = None  # (simplified, traditional) pairs the matcher was built from
+        self._matcherSlots = None  # Per word: (simplified slot, traditional slot or -1)
+        self._snapshotMatcher = None  # Marshalled (matcher parts, slots) from a snapshot, loaded by getMatcher if the forms still match
+        self.stats = None  # RunStats counting rows, bytes and merges, or None to count nothing
+        self.wordCounts = None  # Occurrences per word from the last tagFromFile(s)/tagFromChapters, the sampling weights
+
+    @property
+    def words(self):
+        return self._words
+
+    @words.setter
+    def words(self, words):
+        self._words = words
+        self._reindex()
+
+    def _reindex(self):
+        self._byId = {}  # id -> position of the first word with that id
+        self._byForm = {}  # simplified/traditional form -> positions of the words carrying it
+        for i, word in enumerate(self._words):
+            self._byId.setdefault(word.id, i)
+            self._indexForms(word, i)
+
+    def _indexForms(self, word, i):
+        self._byForm.setdefault(word.simplified, []).append(i)
+        if word.traditional:
+            self._byForm.setdefault(word.traditional, []).append(i)
+
+    def _unindexForms(self, word, i):
+        for form in (word.simplified, word.traditional):
+            positions = self._byForm.get(form)
+            if positions and i in positions:
+                positions.remove(i)
+                if not positions:
+                    del self._byForm[form]
+
+    def wordFromId(self, id):
+        i = self._byId.get(id)
+        return None if i is None else self._words[i]
+
+    def wordsFromForm(self, form):
+        # Words whose simplified or (non-empty) traditional form equals form
+        return [self._words[i] for i in self._byForm.get(form, ())]
+
+    def hasForm(self, form):
+        return form in self._byForm
+
+    def forms(self):
+        # (simplified, traditional) of every word, in order
+        return [(word.simplified, word.traditional) for word in self.words]
+
+    def getMatcher(self):
+        # Rebuild only when the word forms changed since the last build (or since the snapshot was loaded)
+        forms = self.forms()
+        if self._snapshotMatcher is not None:
+            if self._matcher is None and forms == self._matcherForms:
+                parts, slots = marshal.loads(self._snapshotMatcher)
+                self._setMatcher(AnkiMatcher.fromParts(parts), forms, slots)
+            self._snapshotMatcher = None
+        if self._matcher is None or forms != self._matcherForms:
+            patterns = []
+            for simplified, traditional in forms:
+                patterns.append(simplified)
+                if traditional != "":
+                    patterns.append(traditional)
+            self._setMatcher(AnkiMatcher(patterns), forms)
+        return self._matcher
+
+    def _setMatcher(self, matcher, forms, slots=None):
+        self._matcher = matcher
+        self._matcherForms = forms
+        self._matcherSlots = slots if slots is not None else [
+            (matcher.slotOf[simplified], matcher.slotOf[traditional] if traditional != "" else -1) for simplified, traditional in forms]
+
+    def getScanner(self):
+        # What the text is fed through: the automaton, or in COUNT_LEMMA a surface form index over its slots
+        matcher = self.getMatcher()
+        if self.countMode != COUNT_LEMMA:
+            return matcher
+        key = (matcher, self.lemmaLanguage, self.lemmaTable)
+        if self._lemmaFor is None or any(a is not b for a, b in zip(key, self._lemmaFor)):
+            self._lemmaMatcher = LemmaMatcher(matcher.patterns, self.lemmaLanguage, self.lemmaTable)
+            self._lemmaFor = key
+        return self._lemmaMatcher
+
+    def loadLemmaTable(self, file_name):
+        self.lemmaTable = loadLemmaTable(file_name)
+        self._lemmaTableVersion = fileDigest(file_name) if self.lemmaTable else ""
+
+    def countVersion(self):
+        # Cache key part: counts depend on the forms, the count mode and, for lemmas, the rules used
+        version = f"{self.formsVersion()}:{self.countMode}"
+        if self.countMode == COUNT_LEMMA:
+            version += f":{self.lemmaLanguage}:{self._lemmaTableVersion}"
+        encoding = codecs.lookup(self.textEncoding).name
+        if encoding != DEFAULT_ENCODING:
+            version += f":{encoding}"
+        return version
+
+    def formsVersion(self):
+        # Fingerprint of the word forms; counts computed against one version stay valid for it
+        digest = hashlib.sha256()
+        for simplified, traditional in self.forms():
+            digest.update(f"{simplified}\t{traditional}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def countsFromSlots(self, slotCounts):
+        # Per word total: simplified occurrences plus traditional occurrences (if any)
+        return _countsFromSlots(slotCounts, self._matcherSlots, self.countMode)
+
+    def newMatchState(self):
+        return self.getScanner().newState(segment=self.countMode == COUNT_SEGMENT)
+
+    def countFromText(self, text):
+        # One pass over the text, returns occurrence counts aligned with self.words
+        matcher = self.getScanner()
+        return self.countsFromSlots(matcher.finish(matcher.feed(self.newMatchState(), text)))
+
+    def taggedSpans(self, text):
+        # (start, end) of every occurrence in text of a tagged word's forms, e.g. to highlight them
+        matcher = self.getMatcher()
+        slots = set()
+        for word, (s, t) in zip(self.words, self._matcherSlots):
+            if word.tag:
+                slots.add(s)
+                if t >= 0:
+                    slots.add(t)
+        return [(start, end) for start, end, slot in matcher.matches(text) if slot in slots]
+
+    def tagFromCounts(self, counts, requiredCount: int):
+        for word, total_count in zip(self.words, counts):
+            if(total_count >= requiredCount):
+                word.tag = True
 
     def clearTags(self):
         if not isinstance(self.words, list):
@@ -43,7 +258,33 @@ class AnkiDictionary:
             if hasattr(word, 'tag'):
                 word.tag = False
 
-    def tagFromFile(self, file_name, requiredCount: int):
+    def countFromFile(self, file_name, chunkSize: int = CHUNK_SIZE, cache=None):
+        # Streams the file through the matcher chunkSize characters at a time, so memory
+        # stays flat however big the book is. Returns counts aligned with self.words, or None.
+        # With a CountCache, a plain text file that was only appended to since its last scan is
+        # scanned from where that scan stopped. Compressed books and packages (.gz, .bz2, .xz,
+        # .zip, .epub) are decompressed on the fly, see readers.openText.
+        if not isinstance(file_name, str):
+            if(DBUG):print("file_name must be a string")
+            return None
+        if not isinstance(chunkSize, int) or chunkSize <= 0:
+            if(DBUG):print("chunkSize must be a positive integer")
+            return None
+
+        if cache is None:
+            slotCounts = _scanFile(self.getScanner(), self.newMatchState(), file_name, chunkSize, self.stats, self.textEncoding)
+        else:
+            slotCounts = _resumeScan(self.getScanner(), self.newMatchState(), file_name, chunkSize, cache, self.countVersion(),
+                                     self.stats, self.textEncoding)
+        if slotCounts is None:
+            return None
+        counts = self.countsFromSlots(slotCounts)
+        if self.stats is not None:
+            self.stats.add("files_scanned")
+            self.stats.add("word_occurrences", sum(counts))
+        return counts
+
+    def tagFromFile(self, file_name, requiredCount: int, chunkSize: int = CHUNK_SIZE, cache=None):
         if not isinstance(file_name, str):
             if(DBUG):print("file_name must be a string")
             return
@@ -51,64 +292,181 @@ class AnkiDictionary:
             if(DBUG):print("requiredCount must be a non-negative integer")
             return
 
-        try:
-            with open(file_name, encoding="utf-8") as f:
-                text = f.read()
-        except Exception as e:
-            if(DBUG):print(f"Error reading file {file_name}: {e}")
+        # Count how many times either form appears, all forms in a single pass
+        counts = self.countFromFile(file_name, chunkSize, cache)
+        if counts is None:
             return
+        self.wordCounts = counts
+        self.tagFromCounts(counts, requiredCount)
 
-        for word in self.words:
-            # Count how many times either form appears
-            simplified_count = text.count(word.simplified)
-        
-            # Set traditional_count to zero if word.traditional is an empty string
-            if word.traditional != "":
-                traditional_count = text.count(word.traditional)
-            else:
-                traditional_count = 0
+    def countFromFiles(self, fileNames, chunkSize: int = CHUNK_SIZE, workers: int = 1, cache=None):
+        # Returns one count list per file (None for unreadable files), in the order given.
+        # Files found in the CountCache are not scanned at all, grown files only from where
+        # their last scan stopped; with workers > 1 the rest are scanned on a process pool.
+        results = [None] * len(fileNames)
+        keys = [None] * len(fileNames)
+        if cache is not None:
+            version = self.countVersion()
+            for i, file_name in enumerate(fileNames):
+                try:
+                    keys[i] = cache.key(fileDigest(file_name), version)
+                except Exception as e:
+                    if(DBUG):print(f"Error reading file {file_name}: {e}")
+                    continue
+                results[i] = cache.get(keys[i], len(self.words))
+        pending = [i for i in range(len(fileNames)) if results[i] is None]
+        if self.stats is not None and cache is not None:
+            self.stats.add("cache_hits", len(fileNames) - len(pending))
 
-            total_count = simplified_count + traditional_count
-            if(total_count >= requiredCount):
-                word.tag = True
-                # if(DBUG):print(f"FOUND: {word.simplified}/{word.traditional} appeared {total_count} times")
+        if workers <= 1 or len(pending) <= 1:
+            scanned = [self.countFromFile(fileNames[i], chunkSize, cache) for i in pending]
+        else:
+            # Workers receive only the prebuilt matcher and the word -> slot map, once each
+            with ProcessPoolExecutor(max_workers=min(workers, len(pending)), initializer=_initCountWorker,
+                                     initargs=(self.getScanner(), self._matcherSlots, self.countMode, cache, self.countVersion(),
+                                               self.textEncoding)) as pool:
+                scanned = list(pool.map(_countFileWorker, [(fileNames[i], chunkSize) for i in pending]))
+            if self.stats is not None:
+                # Workers cannot report into this process; count whole files
+                self.stats.add("files_scanned", sum(counts is not None for counts in scanned))
+                self.stats.add("bytes_scanned", sum(os.path.getsize(fileNames[i]) for i, counts in zip(pending, scanned) if counts is not None))
+                self.stats.add("word_occurrences", sum(sum(counts) for counts in scanned if counts is not None))
 
-    def tagsAndNot(self, history):
-        if not isinstance(history, type(self)):
-            if(DBUG):print("history must be an instance of the same class")
+        for i, counts in zip(pending, scanned):
+            results[i] = counts
+            if cache is not None and counts is not None and keys[i] is not None:
+                cache.put(keys[i], counts)
+        return results
+
+    def tagFromFiles(self, fileNames, requiredCount: int, chunkSize: int = CHUNK_SIZE, workers: int = 1, thresholdScope=THRESHOLD_FILE, cache=None):
+        if not isinstance(requiredCount, int) or requiredCount < 0:
+            if(DBUG):print("requiredCount must be a non-negative integer")
+            return
+        if thresholdScope not in (THRESHOLD_FILE, THRESHOLD_CORPUS):
+            if(DBUG):print(f"thresholdScope must be {THRESHOLD_FILE} or {THRESHOLD_CORPUS}")
             return
 
-        known_words = set()
-        for word in history.words:
-            known_words.add(word.simplified)
-            if word.traditional:
-                known_words.add(word.traditional)
+        perFile = [counts for counts in self.countFromFiles(fileNames, chunkSize, workers, cache) if counts is not None]
+        self.wordCounts = [sum(column) for column in zip(*perFile)] if perFile else None
+        if thresholdScope == THRESHOLD_CORPUS:
+            if perFile:
+                self.tagFromCounts(self.wordCounts, requiredCount)
+        else:
+            for counts in perFile:
+                self.tagFromCounts(counts, requiredCount)
+
+    def countChaptersFromFiles(self, fileNames, chapterPattern, chunkSize: int = CHUNK_SIZE):
+        # One matching pass over the files, read as one book. A line matching chapterPattern
+        # starts a new chapter; text before the first heading is chapter 0. Returns a list of
+        # (number, title, counts) where counts maps word position -> occurrences in that chapter.
+        if isinstance(chapterPattern, str):
+            chapterPattern = re.compile(chapterPattern)
+        matcher = self.getScanner()
+        segment = self.countMode == COUNT_SEGMENT
+        slotWords = _slotWords(self._matcherSlots, self.countMode)  # A chapter costs its matches, not the deck size
+        chapters = []
+        state = matcher.newState(segment=segment)
+        number, title, hasText = 0, "", False
+        buffer, size = [], 0
+
+        def closeChapter():
+            if number or hasText:
+                chapters.append((number, title, _sparseCountsFromSlots(matcher.finish(state), slotWords)))
+
+        for file_name in fileNames:
+            try:
+                with openText(file_name, self.textEncoding) as f:
+                    for line in f:
+                        if chapterPattern.match(line):
+                            matcher.feed(state, "".join(buffer))
+                            buffer, size = [], 0
+                            closeChapter()
+                            number, title, hasText, state = number + 1, line.strip(), False, matcher.newState(segment=segment)
+                        buffer.append(line)
+                        size += len(line)
+                        hasText = hasText or not line.isspace()
+                        if size >= chunkSize:
+                            matcher.feed(state, "".join(buffer))
+                            buffer, size = [], 0
+            except Exception as e:
+                if(DBUG):print(f"Error reading file {file_name}: {e}")
+                continue
+            finally:
+                matcher.feed(state, "".join(buffer))
+                buffer, size = [], 0
+                matcher.endText(state)  # Files are separate texts; no match may span two of them
+        closeChapter()
+        return chapters
 
+    def tagFromChapters(self, chapters, requiredCount: int, chapter=None):
+        # Tags words reaching requiredCount in the given chapter number, or in the whole book
+        totals = [0] * len(self.words)
+        for number, title, counts in chapters:
+            if chapter is None or number == chapter:
+                for i, c in counts.items():
+                    totals[i] += c
+        self.wordCounts = totals
+        self.tagFromCounts(totals, requiredCount)
+
+    def chapterTags(self, chapters, requiredCount: int):
+        # word position -> labels (ch01, ch02, ...) of the chapters where it reaches requiredCount
+        tags = {}
+        for number, title, counts in chapters:
+            for i, c in counts.items():
+                if c >= requiredCount:
+                    tags.setdefault(i, []).append(f"ch{number:02d}")
+        return tags
+
+    def saveChaptersToFile(self, file_name, chapters, requiredCount: int):
+        # Saves the words found in any chapter, with their chapter labels added to Extra1
+        # (Anki's space-separated tags field)
+        if not isinstance(file_name, str):
+            if(DBUG):print("file_name must be a string")
+            return
+        tags = self.chapterTags(chapters, requiredCount)
+        words = self.words
+        # Every word written reaches requiredCount in some chapter, so it is tagged whatever the current tags are
+        rows = (_rowLine(words[i], " ".join(filter(None, [words[i].extra1] + labels)), True) for i, labels in sorted(tags.items()))
+        self._writeLines(file_name, rows)
+
+    def tagsAndNot(self, history):
+        if not isinstance(history, (AnkiDictionary, KnownWordIndex)):
+            if(DBUG):print("history must be an AnkiDictionary or a KnownWordIndex")
+            return
+
+        known_words = _knownForms(history)
         for word in self.words:
             if word.tag and (word.simplified in known_words or word.traditional in known_words):
                 word.tag = False
 
     def tagsAndNotConfident(self, history, confidenceThreshold):
-        if not isinstance(history, type(self)):
-            if(DBUG):print("history must be an instance of the same class")
+        if not isinstance(history, (AnkiDictionary, KnownWordIndex)):
+            if(DBUG):print("history must be an AnkiDictionary or a KnownWordIndex")
             return
 
-        known_words = set()
-        for word in history.words:
-            known_words.add(word.simplified)
-            if word.traditional:
-                known_words.add(word.traditional)
-
+        known_words = _knownForms(history)
         for word in self.words:
             if word.tag and (word.simplified in known_words or word.traditional in known_words) and word.confidence > confidenceThreshold:
                 word.tag = False
 
+    def tagsAndNotKnown(self, history, knownConfidence=KNOWN_CONFIDENCE):
+        # Untags the words history knows, i.e. one of their forms was last rated at least
+        # knownConfidence. Words rated lower stay tagged and come back for review.
+        if not isinstance(history, (AnkiDictionary, KnownWordIndex)):
+            if(DBUG):print("history must be an AnkiDictionary or a KnownWordIndex")
+            return
+
+        known_words = _knownForms(history, knownConfidence)
+        for word in self.words:
+            if word.tag and (word.simplified in known_words or word.traditional in known_words):
+                word.tag = False
+
     def tagsOr(self, history):
-        if not isinstance(history, type(self)):
+        if not isinstance(history, AnkiDictionary):
             if(DBUG):print("history must be an instance of the same class")
             return
 
-        new_words = [word for word in self.words if word.tag and word not in history.words]
+        new_words = [word for word in self.words if word.tag and history.wordFromId(word.id) is not word]
         history.addNewWords(new_words)
 
     def getTagged(self):
@@ -127,18 +485,35 @@ class AnkiDictionary:
                 if(DBUG):print("Only AnkiWord instances can be added")
                 continue
 
-            for i, existing_word in enumerate(self.words):
-                if existing_word.id == new_word.id:
-                    self.words[i] = new_word  # Replace existing word
-                    break
-            else:
-                self.words.append(new_word)  # Add new word if not found
+            i = self._upsert(new_word)
+            if i is not None:
+                self._dirty.add(i)
+            if self.knownWords is not None:
+                self.knownWords.record(new_word)
 
+    def _upsert(self, new_word):
+        # Returns the word's position if this changed the stored row, otherwise None
+        i = self._byId.get(new_word.id)
+        if i is not None:
+            changed = _row(self._words[i]) != _row(new_word)
+            self._unindexForms(self._words[i], i)
+            self._words[i] = new_word  # Replace existing word
+            self._indexForms(new_word, i)
+            return i if changed else None
+        self.addWord(new_word)  # Add new word if not found
+        return len(self._words) - 1
 
+    def appendWords(self, new_words):
+        # Like addWord for each entry: words are appended even if their id is already present
+        for word in new_words:
+            self.addWord(word)
 
     def addWord(self, word):
         if isinstance(word, AnkiWord):
-            self.words.append(word)
+            i = len(self._words)
+            self._words.append(word)
+            self._byId.setdefault(word.id, i)
+            self._indexForms(word, i)
         else:
             if(DBUG):print("Only AnkiWord instances can be added")
 
@@ -160,11 +535,82 @@ class AnkiDictionary:
             new_dict.addWord(word)
         return new_dict
 
-    def loadFromFile(self, file_name):
+    def getTaggedWeighted(self, numFlashCards, counts=None, skip=None):
+        # Random cards without replacement, a word's chance growing with its occurrences in
+        # counts (default: self.wordCounts). One pass over the tagged positions: each word draws
+        # the key log(u) / weight and a heap keeps the numFlashCards largest (Efraimidis-Spirakis),
+        # so nothing is copied or shuffled. skip(word) can exclude words.
+        if not isinstance(numFlashCards, int) or numFlashCards <= 0:
+            if(DBUG):print("numFlashCards must be a positive integer")
+            return AnkiDictionary()
+
+        counts = self.wordCounts if counts is None else counts
+        draw = random.random
+        heap = []
+        for i, word in self.taggedWords():
+            if skip is not None and skip(word):
+                continue
+            weight = counts[i] if counts else 1
+            key = math.log(draw() or 5e-324) / weight if weight > 0 else -math.inf
+            if len(heap) < numFlashCards:
+                heapq.heappush(heap, (key, i, word))
+            elif key > heap[0][0]:
+                heapq.heapreplace(heap, (key, i, word))
+
+        new_dict = AnkiDictionary()
+        for key, i, word in sorted(heap, reverse=True):
+            new_dict.addWord(word)
+        if not new_dict.words:
+            if(DBUG):print("No tagged words found.")
+        return new_dict
+
+    def taggedPositions(self):
+        return (i for i, word in enumerate(self.words) if word.tag)
+
+    def taggedWords(self):
+        # (position, word) of every tagged word, in order
+        words = self.words
+        return ((i, words[i]) for i in self.taggedPositions())
+
+    def getTaggedDue(self, numFlashCards, scheduler, now=None, weighted=False):
+        # Cards for a review session: tagged words the scheduler has due, earliest first, then
+        # tagged words it has never seen, drawn by getTaggedWeighted: uniformly, or with weighted
+        # by their occurrences. Both are one pass without building or shuffling the tagged list.
+        if not isinstance(numFlashCards, int) or numFlashCards <= 0:
+            if(DBUG):print("numFlashCards must be a positive integer")
+            return AnkiDictionary()
+
+        new_dict = AnkiDictionary()
+        for id in scheduler.due(numFlashCards, lambda id: getattr(self.wordFromId(id), "tag", False), now):
+            new_dict.addWord(self.wordFromId(id))
+        if len(new_dict.words) < numFlashCards:
+            counts = None if weighted else [1] * len(self.words)
+            for word in self.getTaggedWeighted(numFlashCards - len(new_dict.words), counts, skip=lambda word: word.id in scheduler).words:
+                new_dict.addWord(word)
+        if not new_dict.words:
+            if(DBUG):print("No tagged words found.")
+        return new_dict
+
+    def loadFromFile(self, file_name, snapshot: bool = False, journal: bool = False):
+        # With snapshot=True the rows (and matcher) are read from file_name + SNAPSHOT_SUFFIX
+        # when that snapshot matches the TSV, and the snapshot is rewritten when it does not.
+        # With journal=True, changes logged by saveJournaled are replayed on top of the TSV.
         if not isinstance(file_name, str):
             if(DBUG):print("file_name must be a string")
             return
+        if journal:
+            if os.path.exists(file_name):
+                self.loadFromFile(file_name, snapshot)
+            self.replayJournal(file_name)
+            return
 
+        if snapshot and self.loadSnapshot(file_name):
+            if self.stats is not None:
+                self.stats.add("snapshot_loads")
+                self.stats.add("rows_loaded", len(self.words))
+            return
+        first = len(self.words)
+        skipped = 0
         try:
             with open(file_name, "r", encoding="utf-8") as file:
                 for line_num, line in enumerate(file, start=1):
@@ -173,64 +619,966 @@ class AnkiDictionary:
                     parts = line.strip().split("\t")
                     if len(parts) != 10:
                         # if(DBUG):print(f"Skipping line {line_num} due to incorrect number of fields ({len(parts)}).")
+                        skipped += 1
                         continue
 
-                    # Convert string "True"/"False" to boolean
-                    tag = parts[8].strip().lower() == "true"
-
-                    word = AnkiWord(
-                        id=parts[0],
-                        simplified=parts[1],
-                        traditional=parts[2],
-                        pronunciation=parts[3],
-                        meaning=parts[4],
-                        translation=parts[5],
-                        extra1=parts[6],
-                        extra2=parts[7],
-                        tag=tag,  
-                        confidence=parts[9]  # must match the param in your AnkiWord constructor
-                    )
-                    self.addWord(word)
+                    self.addWord(_wordFromParts(parts))
         except Exception as e:
             if(DBUG):print(f"Error loading file {file_name}: {e}")
+            return
+        finally:
+            if self.stats is not None:
+                self.stats.add("rows_parsed", len(self.words) - first)
+                self.stats.add("rows_skipped", skipped)
+        if snapshot:
+            self.saveSnapshot(file_name, first)
 
+    def replayJournal(self, file_name):
+        # Applies file_name + JOURNAL_SUFFIX in order; a torn last line from a crash is skipped
+        self._journalFile = file_name
+        self._journalEntries = 0
+        try:
+            with open(file_name + JOURNAL_SUFFIX, "r", encoding="utf-8") as file:
+                for line in file:
+                    parts = line.rstrip("\n").split("\t")
+                    if not line.endswith("\n") or len(parts) != 10:
+                        continue
+                    self._upsert(_wordFromParts(parts))
+                    self._journalEntries += 1
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            if(DBUG):print(f"Error replaying journal of {file_name}: {e}")
+        if self.stats is not None:
+            self.stats.add("journal_rows_replayed", self._journalEntries)
 
-    def saveAllToFile(self, file_name):
+    def saveJournaled(self, file_name):
+        # Saves the history in time proportional to the changes since the last save: changed
+        # rows are appended to the journal, which is compacted into the TSV once it grows large.
         if not isinstance(file_name, str):
             if(DBUG):print("file_name must be a string")
             return
+        journalFile = file_name + JOURNAL_SUFFIX
+        if self._journalFile != file_name or not os.path.exists(file_name):
+            # The journal on disk (if any) was not replayed into these words; start over
+            self.compactJournal(file_name)
+            return
+
+        pending = sorted(self._dirty)
+        if self._journalEntries + len(pending) > max(JOURNAL_MIN_ENTRIES, JOURNAL_COMPACT_RATIO * len(self.words)):
+            self.compactJournal(file_name)
+            return
+        try:
+            with open(journalFile, "a", encoding="utf-8") as file:
+                for i in pending:
+                    file.write(_rowLine(self.words[i]))
+                file.flush()
+                os.fsync(file.fileno())
+        except Exception as e:
+            if(DBUG):print(f"Error appending to journal {journalFile}: {e}")
+            return
+        self._journalEntries += len(pending)
+        self._dirty.clear()
+        if self.knownWords is not None:
+            self.knownWords.journalRows = self._journalEntries
+            self.knownWords.save(file_name)
+        if self.stats is not None:
+            self.stats.add("journal_rows_appended", len(pending))
+
+    def compactJournal(self, file_name):
+        # Rewrites the TSV atomically, then drops the journal it now contains
+        if not self._writeRows(file_name, onlyTagged=True):
+            return
+        if self.stats is not None:
+            self.stats.add("rows_rewritten", len(self.words))
+        try:
+            os.remove(file_name + JOURNAL_SUFFIX)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            if(DBUG):print(f"Error removing journal of {file_name}: {e}")
+            return
+        self._journalFile = file_name
+        self._journalEntries = 0
+        self._dirty.clear()
+        if self.knownWords is not None:
+            self.knownWords.forms = {}  # Match the rewritten TSV exactly, as a rebuild from it would
+            self.knownWords.words = self.knownWords.journalRows = 0
+            for word in self.words:
+                if word.tag:
+                    self.knownWords.record(word)
+            self.knownWords.save(file_name)
+
+    def _snapshotStamp(self, file_name):
+        # Identifies the TSV as it is on disk, and the Python version marshal data was written by
+        stat = os.stat(file_name)
+        return (SNAPSHOT_VERSION, tuple(sys.version_info[:2]), stat.st_size, stat.st_mtime_ns)
+
+    def _wordColumns(self, first=0):
+        # The text fields (INTERNED_FIELDS interned, which marshal keeps), then tags and confidence as bytes
+        words = self.words[first:]
+        columns = [[sys.intern(getattr(word, field)) if field in INTERNED_FIELDS else getattr(word, field) for word in words]
+                   for field in WORD_FIELDS]
+        return columns + [bytes(1 if word.tag else 0 for word in words), bytes(max(MINN_CONF, min(MAXX_CONF, int(word.confidence))) for word in words)]
+
+    def _extendColumns(self, columns):
+        first = len(self._words)
+        self._words.extend(map(AnkiWord, *columns[:8], map(bool, columns[8]), columns[9]))
+        for i in range(first, len(self._words)):
+            self._byId.setdefault(self._words[i].id, i)
+            self._indexForms(self._words[i], i)
+
+    def saveSnapshot(self, file_name, first=0):
+        # Stores words[first:] (the rows loaded from file_name) as columns, plus the matcher
+        # when those rows are the whole dictionary. The header holds the TSV's size and mtime,
+        # and its digest for when only the mtime changed.
+        try:
+            header = self._snapshotStamp(file_name) + (fileDigest(file_name),)
+            columns = self._wordColumns(first)
+            matcher = marshal.dumps((self.getMatcher().toParts(), self._matcherSlots)) if first == 0 else None
+            with atomicWrite(file_name + SNAPSHOT_SUFFIX, "wb") as f:
+                marshal.dump(header, f)
+                f.write(marshal.dumps((columns, matcher)))
+        except Exception as e:
+            if(DBUG):print(f"Error writing snapshot of {file_name}: {e}")
+
+    def loadSnapshot(self, file_name):
+        # Returns True if an up-to-date snapshot was loaded. The matcher stays marshalled until
+        # getMatcher needs it, e.g. not at all when every count comes from the count cache.
+        try:
+            with open(file_name + SNAPSHOT_SUFFIX, "rb") as f:
+                header = marshal.load(f)
+                payload = f.read()
+            stamp = self._snapshotStamp(file_name)
+            if header[:4] != stamp:
+                # Same size but touched, copied or restored: only then are the contents hashed
+                if header[:3] != stamp[:3] or header[4] != fileDigest(file_name):
+                    return False
+                self._restampSnapshot(file_name, stamp + header[4:], payload)
+            # One loads() over the whole payload; marshal.load on a file reads piecemeal
+            columns, matcher = marshal.loads(payload)
+        except Exception as e:
+            if(DBUG):print(f"No usable snapshot for {file_name}: {e}")
+            return False
+
+        empty = len(self.words) == 0
+        self._extendColumns(columns)
+        if empty and matcher is not None:
+            self._matcher, self._matcherForms, self._snapshotMatcher = None, self.forms(), matcher
+        return True
+
+    def _restampSnapshot(self, file_name, header, payload):
+        # The TSV is unchanged; record its new mtime so the next load needs no digest
+        try:
+            with atomicWrite(file_name + SNAPSHOT_SUFFIX, "wb") as f:
+                marshal.dump(header, f)
+                f.write(payload)
+        except Exception as e:
+            if(DBUG):print(f"Error restamping snapshot of {file_name}: {e}")
+
+
+    def _writeRows(self, file_name, onlyTagged):
+        rows = (_rowLine(word) for word in self.words if not onlyTagged or getattr(word, 'tag', False))
+        return self._writeLines(file_name, rows)
+
+    def _writeLines(self, file_name, rows):
+        # Writes to a temporary file and renames it over file_name, so an interrupted
+        # save leaves the previous file intact. Returns True on success.
         try:
-            with open(file_name, "w", encoding="utf-8") as file:
-                file.write("id\tWord1\tWord2\tPronunciation\tMeaning\tTranslation\tExtra1\tExtra2\tFalse\tconfidence\n")
-                for word in self.words:
-                    file.write(f"{word.id}\t{word.simplified}\t{word.traditional}\t{word.pronunciation}\t{word.meaning}"
-                            f"\t{word.translation}\t{word.extra1}\t{word.extra2}\t{word.tag}\t{word.confidence}\n")
+            with atomicWrite(file_name, "w", encoding="utf-8") as file:
+                file.write(TSV_HEADER)
+                for row in rows:
+                    file.write(row)
+            return True
         except Exception as e:
             if(DBUG):print(f"Error saving to file {file_name}: {e}")
+            return False
 
+    def saveAllToFile(self, file_name):
+        if not isinstance(file_name, str):
+            if(DBUG):print("file_name must be a string")
+            return
+        self._writeRows(file_name, onlyTagged=False)
 
     def saveTrueToFile(self, file_name):
         # Save only tagged words to a TSV file
+        if not isinstance(file_name, str):
+            if(DBUG):print("file_name must be a string")
+            return
+        self._writeRows(file_name, onlyTagged=True)
+
+
+    def __repr__(self):
+        return f"AnkiDictionary with {len(self.words)} words"
+
+# Text fields of AnkiWord in TSV order, followed by tag and confidence
+WORD_FIELDS = ("id", "simplified", "traditional", "pronunciation", "meaning", "translation", "extra1", "extra2")
+INTERNED_FIELDS = ("simplified", "traditional", "pronunciation")  # Short, frequently repeated strings
+
+class AnkiWordColumns:
+    """Column store behind CompactAnkiDictionary.
+
+    Text fields live in one list per field, tag and confidence in bytearrays, so
+    a word costs a few list slots instead of a full object. Indexing yields
+    AnkiWordView objects that read and write straight through to the columns.
+    """
+
+    def __init__(self, words=()):
+        self.text = {field: [] for field in WORD_FIELDS}
+        self.tags = bytearray()
+        self.confidence = bytearray()
+        for word in words:
+            self.append(word)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [AnkiWordView(self, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("word index out of range")
+        return AnkiWordView(self, i)
+
+    def __iter__(self):
+        return (AnkiWordView(self, i) for i in range(len(self)))
+
+    def __setitem__(self, i, word):
+        for field in WORD_FIELDS:
+            value = getattr(word, field)
+            self.text[field][i] = sys.intern(value) if field in INTERNED_FIELDS else value
+        self.tags[i] = 1 if word.tag else 0
+        self.confidence[i] = max(MINN_CONF, min(MAXX_CONF, word.confidence))
+
+    def append(self, word):
+        for field in WORD_FIELDS:
+            value = getattr(word, field)
+            self.text[field].append(sys.intern(value) if field in INTERNED_FIELDS else value)
+        self.tags.append(1 if word.tag else 0)
+        self.confidence.append(max(MINN_CONF, min(MAXX_CONF, word.confidence)))
+
+def _columnProperty(field):
+    return property(lambda view: view._columns.text[field][view._index],
+                    lambda view, value: view._columns.text[field].__setitem__(view._index, value))
+
+class AnkiWordView(AnkiWord):
+    """An AnkiWord backed by one row of an AnkiWordColumns, for code written against AnkiWord."""
+    __slots__ = ("_columns", "_index")
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    @property
+    def tag(self):
+        return bool(self._columns.tags[self._index])
+
+    @tag.setter
+    def tag(self, value):
+        self._columns.tags[self._index] = 1 if value else 0
+
+    @property
+    def confidence(self):
+        return self._columns.confidence[self._index]
+
+    @confidence.setter
+    def confidence(self, value):
+        self._columns.confidence[self._index] = max(MINN_CONF, min(MAXX_CONF, int(value)))
+
+    def __eq__(self, other):
+        if isinstance(other, AnkiWordView):
+            return self._columns is other._columns and self._index == other._index
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self._columns), self._index))
+
+for _field in WORD_FIELDS:
+    setattr(AnkiWordView, _field, _columnProperty(_field))
+
+def _bytesAnd(a, b):
+    return (int.from_bytes(a, "little") & int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+def _bytesOr(a, b):
+    return (int.from_bytes(a, "little") | int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+def _bytesAndNot(a, b):
+    return (int.from_bytes(a, "little") & ~int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+class CompactAnkiDictionary(AnkiDictionary):
+    """AnkiDictionary stored as columns (see AnkiWordColumns) with bulk tag operations.
+
+    Tags are a bytearray of 0/1 flags, so clearing, thresholding and history
+    filtering become whole-column byte and big-integer operations instead of
+    per-object attribute updates. self.words still behaves like a list of
+    AnkiWord, so the CLI and GUI work unchanged.
+    """
+
+    @AnkiDictionary.words.setter
+    def words(self, words):
+        self._words = words if isinstance(words, AnkiWordColumns) else AnkiWordColumns(words)
+        self._reindex()
+
+    def _reindex(self):
+        # The id and form indexes are built on first use, so loading columns costs no per-word work
+        self._idIndex = None
+        self._formIndex = None
+
+    @property
+    def _byId(self):
+        if self._idIndex is None:
+            ids = self._words.text["id"]
+            self._idIndex = dict(zip(reversed(ids), range(len(ids) - 1, -1, -1)))  # Built backwards, so the first position of an id wins
+        return self._idIndex
+
+    @property
+    def _byForm(self):
+        if self._formIndex is None:
+            self._formIndex = {}
+            text = self._words.text
+            for i, (simplified, traditional) in enumerate(zip(text["simplified"], text["traditional"])):
+                self._formIndex.setdefault(simplified, []).append(i)
+                if traditional:
+                    self._formIndex.setdefault(traditional, []).append(i)
+        return self._formIndex
+
+    def forms(self):
+        return list(zip(self._words.text["simplified"], self._words.text["traditional"]))
+
+    def _wordColumns(self, first=0):
+        columns = [self._words.text[field][first:] for field in WORD_FIELDS]
+        return columns + [bytes(self._words.tags[first:]), bytes(self._words.confidence[first:])]
+
+    def _extendColumns(self, columns):
+        # Straight from the snapshot's columns; marshal has already interned INTERNED_FIELDS
+        for field, values in zip(WORD_FIELDS, columns):
+            self._words.text[field].extend(values)
+        self._words.tags.extend(columns[8])
+        self._words.confidence.extend(columns[9])
+        self._reindex()
+
+    def clearTags(self):
+        self._words.tags = bytearray(len(self._words))
+
+    def tagFromCounts(self, counts, requiredCount: int):
+        self._words.tags = bytearray(_bytesOr(self._words.tags, bytes(map(requiredCount.__le__, counts))))
+
+    def getTagged(self):
+        return [AnkiWordView(self._words, i) for i in compress(range(len(self._words)), self._words.tags)]
+
+    def getTaggedRand(self, numFlashCards):
+        # Samples positions first and only builds views for the selected words
+        if not isinstance(numFlashCards, int) or numFlashCards <= 0:
+            if(DBUG):print("numFlashCards must be a positive integer")
+            return AnkiDictionary()
+
+        tagged = list(compress(range(len(self._words)), self._words.tags))
+        if not tagged:
+            if(DBUG):print("No tagged words found.")
+            return AnkiDictionary()
+
+        new_dict = AnkiDictionary()
+        for i in random.sample(tagged, min(numFlashCards, len(tagged))):
+            new_dict.addWord(AnkiWordView(self._words, i))
+        return new_dict
+
+    def taggedPositions(self):
+        tags = self._words.tags
+        i = tags.find(1)
+        while i >= 0:
+            yield i
+            i = tags.find(1, i + 1)
+
+    def knownMask(self, history, knownConfidence=None):
+        # 1 where the simplified or traditional form of a word appears in history, last rated
+        # at least knownConfidence when it is given
+        known = _knownForms(history, knownConfidence)
+        text = self._words.text
+        return _bytesOr(bytes(map(known.__contains__, text["simplified"])), bytes(map(known.__contains__, text["traditional"])))
+
+    def tagsAndNot(self, history):
+        if not isinstance(history, (AnkiDictionary, KnownWordIndex)):
+            if(DBUG):print("history must be an AnkiDictionary or a KnownWordIndex")
+            return
+        self._words.tags = bytearray(_bytesAndNot(self._words.tags, self.knownMask(history)))
+
+    def tagsAndNotConfident(self, history, confidenceThreshold):
+        if not isinstance(history, (AnkiDictionary, KnownWordIndex)):
+            if(DBUG):print("history must be an AnkiDictionary or a KnownWordIndex")
+            return
+        confident = self._words.confidence.translate(bytes(1 if c > confidenceThreshold else 0 for c in range(256)))
+        self._words.tags = bytearray(_bytesAndNot(self._words.tags, _bytesAnd(self.knownMask(history), confident)))
+
+    def tagsAndNotKnown(self, history, knownConfidence=KNOWN_CONFIDENCE):
+        if not isinstance(history, (AnkiDictionary, KnownWordIndex)):
+            if(DBUG):print("history must be an AnkiDictionary or a KnownWordIndex")
+            return
+        self._words.tags = bytearray(_bytesAndNot(self._words.tags, self.knownMask(history, knownConfidence)))
+
+    def __repr__(self):
+        return f"CompactAnkiDictionary with {len(self.words)} words"
+
+ROW_COLUMNS = WORD_FIELDS + ("tag", "confidence")
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS words (
+    pos INTEGER PRIMARY KEY, id TEXT, simplified TEXT, traditional TEXT, pronunciation TEXT, meaning TEXT,
+    translation TEXT, extra1 TEXT, extra2 TEXT, tag INTEGER NOT NULL DEFAULT 0, confidence INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS words_id ON words(id);
+CREATE INDEX IF NOT EXISTS words_simplified ON words(simplified);
+CREATE INDEX IF NOT EXISTS words_traditional ON words(traditional);
+CREATE INDEX IF NOT EXISTS words_confidence ON words(confidence);
+CREATE INDEX IF NOT EXISTS words_tagged ON words(pos) WHERE tag = 1;
+"""
+SQLITE_SELECT = "SELECT pos, " + ", ".join(ROW_COLUMNS) + " FROM words"
+SQLITE_INSERT = "INSERT INTO words (pos, " + ", ".join(ROW_COLUMNS) + ") VALUES (" + ", ".join("?" * (len(ROW_COLUMNS) + 1)) + ")"
+SQLITE_APPEND = ("INSERT INTO words (pos, " + ", ".join(ROW_COLUMNS) + ") SELECT coalesce(max(pos) + 1, 0), "
+                 + ", ".join("?" * len(ROW_COLUMNS)) + " FROM words")  # Positions run 0..n-1, so max(pos) is one index probe
+
+def _sqliteRow(word):
+    return (word.id, word.simplified, word.traditional, word.pronunciation, word.meaning, word.translation,
+            word.extra1, word.extra2, 1 if word.tag else 0, max(MINN_CONF, min(MAXX_CONF, int(word.confidence))))
+
+def _sqliteProperty(field, column):
+    def get(view):
+        return bool(view._row[column]) if field == "tag" else view._row[column]
+    def set(view, value):
+        if field == "tag":
+            value = 1 if value else 0
+        elif field == "confidence":
+            value = max(MINN_CONF, min(MAXX_CONF, int(value)))
+        view._row[column] = value
+        view._owner.conn.execute(f"UPDATE words SET {field} = ? WHERE pos = ?", (value, view._pos))  # Kept until save()
+    return property(get, set)
+
+class SqliteWordView(AnkiWord):
+    """An AnkiWord read from one row of a SqliteAnkiDictionary; assignments change the row in the owner's open transaction."""
+    __slots__ = ("_owner", "_pos", "_row")
+
+    def __init__(self, owner, pos, row):
+        self._owner = owner
+        self._pos = pos
+        self._row = list(row)
+
+    def __eq__(self, other):
+        if isinstance(other, SqliteWordView):
+            return self._owner is other._owner and self._pos == other._pos
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self._owner), self._pos))
+
+for _column, _field in enumerate(ROW_COLUMNS):
+    setattr(SqliteWordView, _field, _sqliteProperty(_field, _column))
+
+class SqliteWordRows:
+    """Sequence view of the words table in position order, so code written for a list keeps working."""
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def _views(self, query, args=()):
+        return [SqliteWordView(self.owner, row[0], row[1:]) for row in self.owner.conn.execute(query, args)]
+
+    def __len__(self):
+        return self.owner.conn.execute("SELECT coalesce(max(pos) + 1, 0) FROM words").fetchone()[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            views = self._views(SQLITE_SELECT + " WHERE pos >= ? AND pos < ? ORDER BY pos", (start, stop))
+            return views[::step]
+        if i < 0:
+            i += len(self)
+        views = self._views(SQLITE_SELECT + " WHERE pos = ?", (i,))
+        if not views:
+            raise IndexError("word index out of range")
+        return views[0]
+
+    def __iter__(self):
+        for row in self.owner.conn.execute(SQLITE_SELECT + " ORDER BY pos"):
+            yield SqliteWordView(self.owner, row[0], row[1:])
+
+class SqliteFormIndex:
+    """`form in index` answered by the simplified/traditional indexes, standing in for AnkiDictionary._byForm.
+    With knownConfidence, only forms of rows rated at least that confident are in it."""
+
+    def __init__(self, owner, knownConfidence=None):
+        self.owner = owner
+        self.knownConfidence = knownConfidence
+
+    def __contains__(self, form):
+        if self.knownConfidence is None:
+            return self.owner.hasForm(form)
+        query = ("SELECT EXISTS(SELECT 1 FROM words WHERE simplified = ?1 AND confidence >= ?2) OR "
+                 "EXISTS(SELECT 1 FROM words WHERE traditional = ?1 AND traditional != '' AND confidence >= ?2)")
+        return bool(self.owner.conn.execute(query, (form, self.knownConfidence)).fetchone()[0])
+
+class SqliteAnkiDictionary(AnkiDictionary):
+    """AnkiDictionary kept in an SQLite database (stdlib sqlite3) instead of in memory.
+
+    Rows keep the 10-column TSV layout plus their position, with indexes on id,
+    simplified, traditional, confidence and tagged rows. Lookups, tag updates,
+    card selection and history filtering run as indexed queries, so only the
+    forms needed for matching and the selected cards are ever loaded.
+
+    Changes (tags, a review's ratings, imported or upserted rows) are made in an
+    open transaction that every query of this dictionary sees, and written to the
+    database only by save(), which saveJournaled and saveAllToFile call for the
+    database's own path. close(), or leaving a with block, drops unsaved changes,
+    so tagging a deck for one session never rewrites it.
+    """
+
+    def __init__(self, path):
+        self.conn = None  # The base constructor assigns self.words = [] before the database is open
+        super().__init__()
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SQLITE_SCHEMA)
+
+    @property
+    def words(self):
+        return SqliteWordRows(self)
+
+    @words.setter
+    def words(self, words):
+        if self.conn is None:
+            return
+        self.conn.execute("DELETE FROM words")
+        self.conn.executemany(SQLITE_INSERT, ((pos,) + _sqliteRow(word) for pos, word in enumerate(words)))
+
+    @property
+    def _byForm(self):
+        return SqliteFormIndex(self)
+
+    def save(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()  # Unsaved changes are rolled back
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def wordFromId(self, id):
+        views = self.words._views(SQLITE_SELECT + " WHERE id = ? ORDER BY pos LIMIT 1", (id,))
+        return views[0] if views else None
+
+    def wordsFromForm(self, form):
+        return self.words._views(SQLITE_SELECT + " WHERE simplified = ? OR (traditional = ? AND traditional != '') ORDER BY pos", (form, form))
+
+    def hasForm(self, form):
+        query = "SELECT EXISTS(SELECT 1 FROM words WHERE simplified = ?) OR EXISTS(SELECT 1 FROM words WHERE traditional = ? AND traditional != '')"
+        return bool(self.conn.execute(query, (form, form)).fetchone()[0])
+
+    def forms(self):
+        return self.conn.execute("SELECT simplified, traditional FROM words ORDER BY pos").fetchall()
+
+    def clearTags(self):
+        self.conn.execute("UPDATE words SET tag = 0 WHERE tag = 1")
+
+    def tagFromCounts(self, counts, requiredCount: int):
+        self.conn.executemany("UPDATE words SET tag = 1 WHERE pos = ?",
+                              ((pos,) for pos, count in enumerate(counts) if count >= requiredCount))
+
+    def getTagged(self):
+        return self.words._views(SQLITE_SELECT + " WHERE tag = 1 ORDER BY pos")
+
+    def getTaggedRand(self, numFlashCards):
+        if not isinstance(numFlashCards, int) or numFlashCards <= 0:
+            if(DBUG):print("numFlashCards must be a positive integer")
+            return AnkiDictionary()
+        new_dict = AnkiDictionary()
+        for word in self.words._views(SQLITE_SELECT + " WHERE tag = 1 ORDER BY random() LIMIT ?", (numFlashCards,)):
+            new_dict.addWord(word)
+        if not new_dict.words:
+            if(DBUG):print("No tagged words found.")
+        return new_dict
+
+    def taggedPositions(self):
+        return (row[0] for row in self.conn.execute("SELECT pos FROM words WHERE tag = 1 ORDER BY pos"))
+
+    def taggedWords(self):
+        return ((row[0], SqliteWordView(self, row[0], row[1:])) for row in self.conn.execute(SQLITE_SELECT + " WHERE tag = 1 ORDER BY pos"))
+
+    def _untagKnown(self, history, confidenceThreshold, knownConfidence=None):
+        if not isinstance(history, (AnkiDictionary, KnownWordIndex)):
+            if(DBUG):print("history must be an AnkiDictionary or a KnownWordIndex")
+            return
+        confident = "" if confidenceThreshold is None else " AND confidence > ?"
+        args = () if confidenceThreshold is None else (confidenceThreshold,)
+        if isinstance(history, SqliteAnkiDictionary):
+            # Looked up through the history's form indexes, one probe per candidate form. (ATTACH
+            # would join them in one UPDATE, but it is not allowed inside the open transaction.)
+            known = SqliteFormIndex(history, knownConfidence)
+        else:
+            known = _knownForms(history, knownConfidence)
+        rows = self.conn.execute(f"SELECT pos, simplified, traditional FROM words WHERE tag = 1{confident}", args).fetchall()
+        self.conn.executemany("UPDATE words SET tag = 0 WHERE pos = ?",
+                              ((pos,) for pos, simplified, traditional in rows if simplified in known or traditional in known))
+
+    def tagsAndNot(self, history):
+        self._untagKnown(history, None)
+
+    def tagsAndNotConfident(self, history, confidenceThreshold):
+        self._untagKnown(history, confidenceThreshold)
+
+    def tagsAndNotKnown(self, history, knownConfidence=KNOWN_CONFIDENCE):
+        self._untagKnown(history, None, knownConfidence)
+
+    def addWord(self, word):
+        if not isinstance(word, AnkiWord):
+            if(DBUG):print("Only AnkiWord instances can be added")
+            return
+        self.conn.execute(SQLITE_APPEND, _sqliteRow(word))
+
+    def addNewWords(self, new_words):
+        # Upsert by id: the first row with the id is replaced, otherwise the word is appended
+        if not isinstance(new_words, list):
+            if(DBUG):print("Input should be a list of AnkiWord instances")
+            return
+        assignments = ", ".join(f"{column} = ?" for column in ROW_COLUMNS)
+        for new_word in new_words:
+            if not isinstance(new_word, AnkiWord):
+                if(DBUG):print("Only AnkiWord instances can be added")
+                continue
+            row = _sqliteRow(new_word)
+            updated = self.conn.execute(f"UPDATE words SET {assignments} WHERE pos = (SELECT min(pos) FROM words WHERE id = ?)",
+                                        row + (new_word.id,)).rowcount
+            if not updated:
+                self.conn.execute(SQLITE_APPEND, row)
+
+    def loadFromFile(self, file_name, snapshot: bool = False, journal: bool = False):
+        # Bulk import of a TSV, appended after the existing rows. The database is its own
+        # persistent, transactional format, so snapshots and journals do not apply.
         if not isinstance(file_name, str):
             if(DBUG):print("file_name must be a string")
             return
         try:
-            with open(file_name, "w", encoding="utf-8") as file:
-                file.write("id\tWord1\tWord2\tPronunciation\tMeaning\tTranslation\tExtra1\tExtra2\tFalse\tconfidence\n")
-                for word in self.words:
-                    if not getattr(word, 'tag', False):
-                        continue
-                    file.write(f"{word.id}\t{word.simplified}\t{word.traditional}\t{word.pronunciation}\t{word.meaning}"
-                            f"\t{word.translation}\t{word.extra1}\t{word.extra2}\t{word.tag}\t{word.confidence}\n")
+            with open(file_name, "r", encoding="utf-8") as file:
+                size = len(self.words)
+                rows = (line.strip().split("\t") for line_num, line in enumerate(file) if line_num > 0)
+                words = (_wordFromParts(parts) for parts in rows if len(parts) == 10)
+                self.conn.executemany(SQLITE_INSERT, ((pos,) + _sqliteRow(word) for pos, word in enumerate(words, start=size)))
+            if self.stats is not None:
+                self.stats.add("rows_parsed", len(self.words) - size)
         except Exception as e:
-            if(DBUG):print(f"Error saving to file {file_name}: {e}")
+            if(DBUG):print(f"Error loading file {file_name}: {e}")
 
+    def _writeRows(self, file_name, onlyTagged):
+        # Saving to the database's own path commits; any other path gets a TSV export
+        if os.path.abspath(file_name) == os.path.abspath(self.path):
+            self.save()
+            return True
+        return super()._writeRows(file_name, onlyTagged)
 
+    def saveJournaled(self, file_name):
+        # The database is its own journal: the same path commits, another one exports a TSV
+        self._writeRows(file_name, onlyTagged=True)
 
     def __repr__(self):
-        return f"AnkiDictionary with {len(self.words)} words"
+        return f"SqliteAnkiDictionary at {self.path} with {len(self.words)} words"
+
+class KnownWordIndex:
+    """The forms of a history's words, each with the confidence last recorded for it.
+
+    Filtering a deck against a history only asks whether a form is known, so this is
+    all tagsAndNot and tagsAndNotKnown need: one dict lookup per candidate, with no
+    history rows loaded. The index is saved next to the history and, on load, brought up
+    to date by reading only the journal rows appended since; the TSV is read again only
+    after a compaction rewrote it. A form stays known once a history row carried it.
+    Through appendJournaled a session's words are also saved without loading the history,
+    in time proportional to them: the journal is the index's log, and the index itself is
+    saved again only once that log has grown past KNOWN_REFRESH_ROWS.
+    """
+
+    def __init__(self):
+        self.forms = {}  # simplified/traditional form -> confidence
+        self.words = 0  # History words, counted by simplified form; sizes the journal like len(history.words)
+        self.journalRows = 0  # Entries in the journal the forms reflect
+        self.state = None  # (TSV header, journal bytes) the forms reflect, as last loaded or saved
+
+    def __contains__(self, form):
+        return form in self.forms
+
+    def __len__(self):
+        return len(self.forms)
 
-def anki_cmdLineFlashCards(flashcards: AnkiDictionary):
+    def confidence(self, form):
+        # Confidence last recorded for form, or None if it is not known
+        return self.forms.get(form)
+
+    def record(self, word):
+        # Called for every history row added or changed, in the order they are stored
+        if word.simplified not in self.forms:
+            self.words += 1
+        self.forms[word.simplified] = word.confidence
+        if word.traditional:
+            self.forms[word.traditional] = word.confidence
+
+    def changed(self, word):
+        # Whether recording word would add a form or change a confidence
+        return (self.forms.get(word.simplified) != word.confidence
+                or bool(word.traditional) and self.forms.get(word.traditional) != word.confidence)
+
+    def _readRows(self, file_name, offset=0, journal=False):
+        # Records the rows of a history TSV (or, from byte offset, its journal). Returns the
+        # bytes read up to the last complete line and the number of rows recorded.
+        rows = 0
+        with open(file_name, "rb") as file:
+            file.seek(offset)
+            for line_num, line in enumerate(file, start=1):
+                if journal and not line.endswith(b"\n"):
+                    break  # Torn last line from a crash, skipped like replayJournal does
+                offset += len(line)
+                if line_num == 1 and not journal: continue  # Skip header
+                text = line.decode("utf-8")
+                parts = text.rstrip("\r\n").split("\t") if journal else text.strip().split("\t")
+                if len(parts) == 10:
+                    self.record(AnkiWord(parts[0], parts[1], parts[2], "", "", "", "", "", False, parts[9]))
+                    rows += 1
+        return offset, rows
+
+    @classmethod
+    def load(cls, historyFile):
+        # Returns the index of historyFile, reusing historyFile + KNOWN_SUFFIX when it is
+        # still valid and saving it again when it had to be rebuilt or extended
+        index = cls()
+        header = _historyHeader(historyFile)
+        journalFile = historyFile + JOURNAL_SUFFIX
+        offset, changed = None, True
+        try:
+            with open(historyFile + KNOWN_SUFFIX, "rb") as f:
+                savedHeader, savedOffset, journalRows, words = marshal.load(f)
+                if savedHeader == header and _fileSize(journalFile) >= savedOffset:
+                    index.forms, offset, changed = marshal.loads(f.read()), savedOffset, False
+                    index.journalRows, index.words = journalRows, words
+        except Exception as e:
+            if(DBUG):print(f"No usable known-word index for {historyFile}: {e}")
+        try:
+            if offset is None:
+                offset = 0
+                if header is not None:
+                    index._readRows(historyFile)
+            if os.path.exists(journalFile):
+                offset, rows = index._readRows(journalFile, offset, journal=True)
+                index.journalRows += rows
+                changed = changed or rows > KNOWN_REFRESH_ROWS
+            elif header is None:
+                return index  # No history yet, nothing to save an index of
+        except Exception as e:
+            if(DBUG):print(f"Error reading history {historyFile}: {e}")
+            return index
+        index.state = (header, offset)
+        if changed:
+            index.save(historyFile, index.state)
+        return index
+
+    def appendJournaled(self, historyFile, words):
+        # Saves words to the history like addNewWords and saveJournaled, without loading it:
+        # the words whose forms or confidence the index does not have yet are appended to the
+        # journal, which the next load reads past the saved index. Returns the number of rows appended, or None
+        # if the history has to be loaded instead: there is no TSV yet, the files changed since
+        # the index was read, or the journal is due for compaction.
+        journalFile = historyFile + JOURNAL_SUFFIX
+        if self.state is None or self.state[0] is None or self.state != (_historyHeader(historyFile), _fileSize(journalFile)):
+            return None
+        pending = [word for word in words if self.changed(word)]
+        if self.journalRows + len(pending) > max(JOURNAL_MIN_ENTRIES, JOURNAL_COMPACT_RATIO * self.words):
+            return None
+        if not pending:
+            return 0
+        try:
+            with open(journalFile, "a", encoding="utf-8") as file:
+                for word in pending:
+                    file.write(_rowLine(word, tag=True))
+                file.flush()
+                os.fsync(file.fileno())
+        except Exception as e:
+            if(DBUG):print(f"Error appending to journal {journalFile}: {e}")
+            return None
+        for word in pending:
+            self.record(word)
+        self.journalRows += len(pending)
+        self.state = (self.state[0], _fileSize(journalFile))
+        return len(pending)
+
+    def save(self, historyFile, state=None):
+        # Atomic like the history TSV. state: (TSV header, journal bytes) the forms reflect,
+        # by default the files as they are now, e.g. right after saveJournaled
+        if state is None:
+            state = (_historyHeader(historyFile), _fileSize(historyFile + JOURNAL_SUFFIX))
+        self.state = state
+        try:
+            with atomicWrite(historyFile + KNOWN_SUFFIX, "wb") as f:
+                marshal.dump(state + (self.journalRows, self.words), f)
+                f.write(marshal.dumps(self.forms))
+        except Exception as e:
+            if(DBUG):print(f"Error writing known-word index of {historyFile}: {e}")
+
+    def __repr__(self):
+        return f"KnownWordIndex with {len(self.forms)} known forms"
+
+def _historyHeader(file_name):
+    # Identifies the history TSV, None while there is none. Only compaction rewrites it, by
+    # replacing the file, so its size and modification time are enough to tell a new one.
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+    return (KNOWN_VERSION, tuple(sys.version_info[:2]), stat.st_size, stat.st_mtime_ns)
+
+def _fileSize(file_name):
+    # 0 for a missing file, e.g. a journal not written yet
+    try:
+        return os.path.getsize(file_name)
+    except FileNotFoundError:
+        return 0
+
+def _knownForms(history, knownConfidence=None):
+    # What a filter looks forms up in: the index itself, or a loaded history's form index.
+    # With knownConfidence, only the forms last rated at least that confident.
+    if knownConfidence is None:
+        return history.forms if isinstance(history, KnownWordIndex) else history._byForm
+    if isinstance(history, KnownWordIndex):
+        return {form for form, confidence in history.forms.items() if confidence >= knownConfidence}
+    words = history.words
+    return {form for form, positions in history._byForm.items() if words[positions[-1]].confidence >= knownConfidence}
+
+def openDictionary(file_name, compact=False):
+    # Paths ending in one of SQLITE_SUFFIXES open an SQLite store, anything else an in-memory dictionary
+    if file_name.lower().endswith(SQLITE_SUFFIXES):
+        return SqliteAnkiDictionary(file_name)
+    return CompactAnkiDictionary() if compact else AnkiDictionary()
+
+def saveLearnedWords(history, known, historyFile, words):
+    # Adds words to the history in historyFile. With a KnownWordIndex only the changed words are
+    # appended to the journal; an SQLite history (known is None), a first save or a journal due
+    # for compaction loads the full history into history instead. Returns the number of rows
+    # appended through the index, or None if history was loaded.
+    appended = None if known is None else known.appendJournaled(historyFile, words)
+    if appended is None:
+        if known is not None:
+            history.loadFromFile(historyFile, journal=True)
+            history.knownWords = known
+        history.addNewWords(words)  # Add new learned words to history
+        history.saveJournaled(historyFile)  # Append the changes to the history journal
+    return appended
+
+def _scanFile(matcher, state, file_name, chunkSize, stats=None, encoding=DEFAULT_ENCODING):
+    # Per-slot counts of one text file, or None if it cannot be read
+    try:
+        with openText(file_name, encoding) as f:
+            for chunk in iter(lambda: f.read(chunkSize), ""):
+                matcher.feed(state, chunk)
+            if stats is not None:
+                stats.add("bytes_scanned", os.path.getsize(file_name))
+            return matcher.finish(state)
+    except Exception as e:
+        if(DBUG):print(f"Error reading file {file_name}: {e}")
+        return None
+
+def _resumeScan(matcher, state, file_name, chunkSize, cache, version, stats=None, encoding=DEFAULT_ENCODING):
+    # Like _scanFile, but picks up the matcher state saved by the previous scan of this path
+    # when the bytes it covered are unchanged, so only what was appended since gets scanned.
+    # Any edit before the saved offset shows up in the prefix checksum and forces a full scan.
+    # Only plain UTF-8 files can resume: elsewhere a byte offset is no position in the text.
+    if not isPlainText(file_name, encoding):
+        return _scanFile(matcher, state, file_name, chunkSize, stats, encoding)
+    key = cache.progressKey(file_name, version)
+    saved = cache.getProgress(key)
+    try:
+        with open(file_name, "rb") as f:
+            digest, offset = hashlib.sha256(), 0
+            if saved is not None and os.fstat(f.fileno()).st_size >= saved[0]:
+                remaining = saved[0]
+                for block in iter(lambda: f.read(min(DIGEST_BLOCK, remaining)), b""):
+                    digest.update(block)
+                    remaining -= len(block)
+                if not remaining and digest.hexdigest() == saved[1]:
+                    offset = saved[0]
+                    vars(state).update(saved[2])
+                else:
+                    f.seek(0)
+                    digest = hashlib.sha256()
+            # Decodes like open(file_name, encoding="utf-8"), but keeps track of the bytes consumed
+            start = offset
+            decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf-8")(), translate=True)
+            held = b""
+            for block in iter(lambda: f.read(chunkSize), b""):
+                matcher.feed(state, decoder.decode(block))
+                buffered, flag = decoder.getstate()
+                consumed = held + block
+                held = consumed[len(consumed) - len(buffered) - (flag & 1):]  # Undecoded bytes and a trailing \r
+                digest.update(consumed[:len(consumed) - len(held)])
+                offset += len(consumed) - len(held)
+            cache.putProgress(key, offset, digest.hexdigest(), vars(state))
+            if stats is not None:
+                stats.add("bytes_scanned", offset + len(held) - start)
+                stats.add("bytes_resumed", start)
+            if held:
+                matcher.feed(state, decoder.decode(b"", final=True))
+            return matcher.finish(state)
+    except Exception as e:
+        if(DBUG):print(f"Error reading file {file_name}: {e}")
+        return None
+
+def _countsFromSlots(slotCounts, slots, countMode=COUNT_SUBSTRING):
+    if countMode != COUNT_SUBSTRING:
+        # A token is one occurrence even when both forms of the word are the same string
+        return [slotCounts[s] + (slotCounts[t] if t >= 0 and t != s else 0) for s, t in slots]
+    return [slotCounts[s] + (slotCounts[t] if t >= 0 else 0) for s, t in slots]
+
+def _slotWords(slots, countMode=COUNT_SUBSTRING):
+    # slot -> positions of the words its occurrences count for; the inverse of _countsFromSlots
+    words = {}
+    for i, (s, t) in enumerate(slots):
+        words.setdefault(s, []).append(i)
+        if t >= 0 and (t != s or countMode == COUNT_SUBSTRING):
+            words.setdefault(t, []).append(i)
+    return words
+
+def _sparseCountsFromSlots(slotCounts, slotWords):
+    # Same totals as _countsFromSlots, as word position -> count for the words that occur
+    counts = {}
+    for s in compress(range(len(slotCounts)), slotCounts):
+        c = slotCounts[s]
+        for i in slotWords.get(s, ()):
+            counts[i] = counts.get(i, 0) + c
+    return counts
+
+# Process pool workers for AnkiDictionary.countFromFiles, the matcher is shipped once per worker
+_workerMatcher = None
+_workerSlots = None
+_workerCountMode = COUNT_SUBSTRING
+_workerCache = None
+_workerVersion = None
+_workerEncoding = DEFAULT_ENCODING
+
+def _initCountWorker(matcher, slots, countMode, cache=None, version=None, encoding=DEFAULT_ENCODING):
+    global _workerMatcher, _workerSlots, _workerCountMode, _workerCache, _workerVersion, _workerEncoding
+    _workerMatcher = matcher
+    _workerSlots = slots
+    _workerCountMode = countMode
+    _workerCache = cache
+    _workerVersion = version
+    _workerEncoding = encoding
+
+def _countFileWorker(job):
+    file_name, chunkSize = job
+    state = _workerMatcher.newState(segment=_workerCountMode == COUNT_SEGMENT)
+    if _workerCache is None:
+        slotCounts = _scanFile(_workerMatcher, state, file_name, chunkSize, encoding=_workerEncoding)
+    else:
+        slotCounts = _resumeScan(_workerMatcher, state, file_name, chunkSize, _workerCache, _workerVersion, encoding=_workerEncoding)
+    return None if slotCounts is None else _countsFromSlots(slotCounts, _workerSlots, _workerCountMode)
+
+def anki_cmdLineFlashCards(flashcards: AnkiDictionary, scheduler: Scheduler = None):
     print("\n=== Flashcard Review ===")
     for i, word in enumerate(flashcards.words):
         print(f"\nCard {i+1}/{len(flashcards.words)}")
@@ -247,14 +1595,23 @@ def anki_cmdLineFlashCards(flashcards: AnkiDictionary):
             confidence = input("How confident are you you'll remember this word? (1=low, 5=high (never remind me again)): ").strip()
             if confidence in {"1", "2", "3", "4", "5"}:
                 word.confidence = int(confidence)  # store the confidence
+                if scheduler is not None:
+                    scheduler.review(word.id, word.confidence)  # and schedule the next review
                 break
             print("Please enter a number from 1 to 5.")
 
-        # You can store this confidence if needed for spaced repetition later
         print("Next...\n")
 
 
-def anki_parse(textFiles, dictionaryFile, numFlashCards, requiredCount, historyFile, disableHistoryFlag):
+def anki_parse(textFiles, dictionaryFile, numFlashCards, requiredCount, historyFile, disableHistoryFlag, chunkSize=CHUNK_SIZE, workers=1, thresholdScope=THRESHOLD_FILE,
+               cacheDir=DEFAULT_CACHE_DIR, cacheMaxBytes=DEFAULT_MAX_BYTES, disableCacheFlag=False, compact=False,
+               disableSnapshotFlag=False, importTsv=None, chapterPattern=None, chapter=None, chapterOutput=None,
+               countMode=COUNT_SUBSTRING, lemmaLanguage=None, lemmaTable=None, stats=None, sampling=SAMPLE_UNIFORM,
+               encoding=DEFAULT_ENCODING):
+    # stats: a RunStats that receives the time of each stage and the dictionary counters
+    def stage(name):
+        return nullcontext() if stats is None else stats.stage(name)
+
     # Input validation
     if not textFiles:
         raise ValueError("At least one text file must be provided.")
@@ -263,58 +1620,193 @@ def anki_parse(textFiles, dictionaryFile, numFlashCards, requiredCount, historyF
         if not os.path.isfile(path):
             raise FileNotFoundError(f"Text file not found: {path}")
 
-    if not os.path.isfile(dictionaryFile):
+    sqliteDictionary = dictionaryFile.lower().endswith(SQLITE_SUFFIXES)
+    if importTsv and not sqliteDictionary:
+        raise ValueError(f"importTsv needs an SQLite dictionary file ({', '.join(SQLITE_SUFFIXES)}).")
+
+    if importTsv and not os.path.isfile(importTsv):
+        raise FileNotFoundError(f"Dictionary file not found: {importTsv}")
+
+    if not importTsv and not os.path.isfile(dictionaryFile):
         raise FileNotFoundError(f"Dictionary file not found: {dictionaryFile}")
 
     if requiredCount < 0:
         raise ValueError("requiredCount must be non-negative.")
 
+    if chunkSize <= 0:
+        raise ValueError("chunkSize must be positive.")
+
+    if workers < 1:
+        raise ValueError("workers must be at least 1.")
+
+    if countMode not in COUNT_MODES:
+        raise ValueError(f"countMode must be one of {', '.join(COUNT_MODES)}.")
+
+    if (lemmaLanguage or lemmaTable) and countMode != COUNT_LEMMA:
+        raise ValueError(f"lemmaLanguage and lemmaTable need countMode '{COUNT_LEMMA}'.")
+
+    if lemmaLanguage and lemmaLanguage not in INFLECTORS:
+        raise ValueError(f"lemmaLanguage must be one of {', '.join(INFLECTORS)}.")
+
+    if lemmaTable and not os.path.isfile(lemmaTable):
+        raise FileNotFoundError(f"Lemma table not found: {lemmaTable}")
+
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        raise ValueError(f"Unknown text encoding: {encoding}")
+
+    if sampling not in (SAMPLE_UNIFORM, SAMPLE_FREQUENCY):
+        raise ValueError(f"sampling must be '{SAMPLE_UNIFORM}' or '{SAMPLE_FREQUENCY}'.")
+
+    if (chapter is not None or chapterOutput) and not chapterPattern:
+        raise ValueError("chapter and chapterOutput need a chapterPattern.")
+
+    if chapterPattern:
+        chapterPattern = re.compile(chapterPattern)
+
+    if thresholdScope not in (THRESHOLD_FILE, THRESHOLD_CORPUS):
+        raise ValueError(f"thresholdScope must be '{THRESHOLD_FILE}' or '{THRESHOLD_CORPUS}'.")
+
     if historyFile and not disableHistoryFlag and os.path.exists(historyFile):
         if not os.access(historyFile, os.R_OK | os.W_OK):
             raise PermissionError(f"Cannot read/write history file: {historyFile}")
 
     if(DBUG):  print(f"textFiles: {textFiles}, dictionaryFile: {dictionaryFile}, requiredCount: {requiredCount}, disableHistoryFlag: {disableHistoryFlag}")
     
-    dictionary = AnkiDictionary()
-    dictionary.loadFromFile(dictionaryFile)
-    dictionary.clearTags()
-    for textFile in textFiles:
-        dictionary.tagFromFile(textFile, requiredCount)
-
-    if(DBUG):  print(dictionary)
-
-    if historyFile and not disableHistoryFlag:
-        history = AnkiDictionary()
-        if os.path.exists(historyFile): # Check if history file exists, if not initialize an empty history
-            history.loadFromFile(historyFile)
-            dictionary.tagsAndNotConfident(history, MAXX_CONF)
-            if(DBUG):  print(history)
-            
-        else:
-            if(DBUG):  print(f"History file {historyFile} does not exist. Starting with an empty history.")
+    with ExitStack() as stores:  # SQLite decks and histories are closed however the session ends
+        with stage("load_dictionary"):
+            dictionary = openDictionary(dictionaryFile, compact or not disableSnapshotFlag)  # Snapshot columns load straight into the compact store
+            dictionary.stats = stats
+            if sqliteDictionary:
+                stores.enter_context(dictionary)
+                if importTsv:
+                    dictionary.words = []  # Replace the stored deck with the TSV
+                    dictionary.loadFromFile(importTsv)
+                    dictionary.save()  # Keeps the import; the session's tags and ratings are not saved to the deck
+            else:
+                dictionary.loadFromFile(dictionaryFile, snapshot=not disableSnapshotFlag)
+        dictionary.countMode = countMode
+        dictionary.textEncoding = encoding
+        dictionary.lemmaLanguage = lemmaLanguage
+        if lemmaTable:
+            dictionary.loadLemmaTable(lemmaTable)
+        with stage("count_text"):
+            dictionary.clearTags()
+            if chapterPattern:
+                # One pass records per-chapter counts for every word
+                chapters = dictionary.countChaptersFromFiles(textFiles, chapterPattern, chunkSize)
+                if chapter is not None and all(number != chapter for number, title, counts in chapters):
+                    raise ValueError(f"No chapter {chapter}: the chapter pattern found chapters {chapters[0][0] if chapters else 0} to {chapters[-1][0] if chapters else 0}.")
+                dictionary.tagFromChapters(chapters, requiredCount, chapter)
+                if chapterOutput:
+                    dictionary.saveChaptersToFile(chapterOutput, chapters, requiredCount)
+            else:
+                cache = None if disableCacheFlag else CountCache(cacheDir, cacheMaxBytes)
+                dictionary.tagFromFiles(textFiles, requiredCount, chunkSize, workers, thresholdScope, cache)
+        if stats is not None:
+            stats.add("dictionary_words", len(dictionary.words))
+            stats.add("tagged_words", len(dictionary.getTagged()))
+
+        if(DBUG):  print(dictionary)
 
-    # Review
-    flashcards = dictionary.getTaggedRand(numFlashCards)
-    anki_cmdLineFlashCards(flashcards)
+        history = None
+        known = None
+        with stage("filter_history"):
+            if historyFile and not disableHistoryFlag:
+                history = openDictionary(historyFile)
+                history.stats = None if stats is None else stats.prefixed("history_")
+                if isinstance(history, SqliteAnkiDictionary):
+                    stores.enter_context(history)
+                    dictionary.tagsAndNotKnown(history)  # Filtered by indexed queries, nothing to load
+                else:
+                    # Only the known forms are needed to filter; the rows are loaded when the history is saved
+                    known = KnownWordIndex.load(historyFile)
+                    dictionary.tagsAndNotKnown(known)
+                    if(DBUG):  print(known)
+        if stats is not None and history is not None:
+            if known is not None:
+                stats.add("history_known_forms", len(known))
+            stats.add("untagged_by_history", stats.counters["tagged_words"] - len(dictionary.getTagged()))
+
+        # Review: with a history, cards come from its review schedule
+        scheduler = None
+        if history is not None:
+            scheduler = Scheduler()
+            scheduler.loadFromFile(historyFile + SCHEDULE_SUFFIX)
+        with stage("review"):
+            if scheduler is not None:
+                flashcards = dictionary.getTaggedDue(numFlashCards, scheduler, weighted=sampling == SAMPLE_FREQUENCY)
+            elif sampling == SAMPLE_FREQUENCY:
+                flashcards = dictionary.getTaggedWeighted(numFlashCards)
+            else:
+                flashcards = dictionary.getTaggedRand(numFlashCards)
+            anki_cmdLineFlashCards(flashcards, scheduler)
+        if stats is not None:
+            stats.add("cards_reviewed", len(flashcards.words))
 
-    # Save The Learned Words
-    if history and not disableHistoryFlag:
-        history.addNewWords(dictionary.getTagged())  # Add new learned words to history
-        history.saveTrueToFile(historyFile)  # Save the updated history
+        # Save The Learned Words
+        if history is not None:
+            with stage("save_history"):
+                learned = dictionary.getTagged()
+                appended = saveLearnedWords(history, known, historyFile, learned)
+                scheduler.saveToFile(historyFile + SCHEDULE_SUFFIX)
+            if stats is not None:
+                if appended is None:
+                    stats.add("history_words", len(history.words))
+                else:
+                    stats.add("history_journal_rows_appended", appended)
+                stats.add("history_merged_words", len(learned))
 
     # dictionary.saveAllToFile(dictionaryFile)
 
 if __name__ == "__main__":
+    freeze_support()  # A frozen (PyInstaller) build must not rerun the CLI in each worker process
     parser = argparse.ArgumentParser(description="Tag words from a TSV file based on their presence in a text corpus.")
     parser.add_argument("text_file", nargs='+', help="Path to the text files used as the corpus.")
-    parser.add_argument("tsv_file", help="Path to the TSV wordlist file (input and output).")
+    parser.add_argument("tsv_file", help=f"Path to the TSV wordlist file (input and output). Paths ending in {', '.join(SQLITE_SUFFIXES)} are SQLite databases.")
     parser.add_argument("-cards", type=int, default=5, help="Number of words to review (default: 5)")
-    parser.add_argument("-history", type=str, default="anki_history.tsv", help="Optional path to a TSV file that stores previously learned words")
+    parser.add_argument("-history", type=str, default="anki_history.tsv", help=f"Optional path to a TSV file (or SQLite database ending in {', '.join(SQLITE_SUFFIXES)}) that stores previously learned words")
     parser.add_argument("--disable-history", action="store_true", help="Disable storing history")
     parser.add_argument("--required-count", type=int, default=1, help="Minimum number of occurrences required to tag a word. (default: 1)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help=f"Characters read from a text file per scanning step; bounds memory use on large books. (default: {CHUNK_SIZE})")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to scan the text files in parallel. (default: 1)")
+    parser.add_argument("--threshold-scope", choices=[THRESHOLD_FILE, THRESHOLD_CORPUS], default=THRESHOLD_FILE,
+                        help="'file': tag a word that reaches --required-count in any one text file; 'corpus': sum the counts over all text files first. (default: file)")
+    parser.add_argument("--cache-dir", type=str, default=DEFAULT_CACHE_DIR, help=f"Directory holding cached occurrence counts per book. (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES >> 20, help=f"Maximum size of the count cache in MB. (default: {DEFAULT_MAX_BYTES >> 20})")
+    parser.add_argument("--disable-cache", action="store_true", help="Always rescan the text files and do not store their counts")
+    parser.add_argument("--compact", action="store_true", help="Store the dictionary in compact columns; uses less memory on very large decks")
+    parser.add_argument("--disable-snapshot", action="store_true", help=f"Always parse the dictionary TSV instead of using its compiled {SNAPSHOT_SUFFIX} snapshot")
+    parser.add_argument("--import-tsv", type=str, default=None, help="Replace the contents of an SQLite tsv_file with this TSV before tagging")
+    parser.add_argument("--chapter-pattern", type=str, default=None, help="Regular expression matching the first line of each chapter, e.g. '^第.+章' or '^Chapter'")
+    parser.add_argument("--chapter", type=int, default=None, help="Only review words from this chapter number (needs --chapter-pattern)")
+    parser.add_argument("--chapter-output", type=str, default=None, help="Write the words of every chapter to this TSV, with chapter tags (ch01, ch02, ...) in Extra1")
+    parser.add_argument("--count-mode", choices=list(COUNT_MODES), default=COUNT_SUBSTRING,
+                        help="'substring': count every occurrence of a word inside the text; 'segment': split the text into the longest dictionary words and count only those tokens, so 爱 is not counted inside 爱好; "
+                             "'lemma': count whole words, case-insensitively, with inflected forms (Häuser, terram) counted for their dictionary form. (default: substring)")
+    parser.add_argument("--lemma-language", choices=sorted(INFLECTORS), default=None, help="Inflection rules used by --count-mode lemma: 'de' (German) or 'la' (Latin)")
+    parser.add_argument("--lemma-table", type=str, default=None, help="TSV of 'surface form<TAB>dictionary form' pairs used by --count-mode lemma, for irregular forms")
+    parser.add_argument("--sampling", choices=[SAMPLE_UNIFORM, SAMPLE_FREQUENCY], default=SAMPLE_UNIFORM,
+                        help="How new cards are picked from the tagged words: 'uniform' at random, or 'frequency' favoring words that occur often in the text. (default: uniform)")
+    parser.add_argument("--stats", "--profile", nargs="?", const="table", choices=["table", "json"], default=None,
+                        help="After the run, print the time of each stage, bytes scanned, rows parsed and skipped, history merge sizes and peak memory to stderr, as a table (default) or JSON")
+    parser.add_argument("--encoding", type=str, default=DEFAULT_ENCODING,
+                        help=f"Encoding of the text files, e.g. gb18030 or big5 for Chinese sources. .gz, .bz2, .xz, .zip and .epub books are read without unpacking them. (default: {DEFAULT_ENCODING})")
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
     args = parser.parse_args()
+    if (args.chapter is not None or args.chapter_output) and not args.chapter_pattern:
+        parser.error("--chapter and --chapter-output need --chapter-pattern")
 
     # Running the parse function with the arguments provided
     if(args.debug): DBUG = True
-    anki_parse(args.text_file, args.tsv_file, args.cards, args.required_count, args.history, args.disable_history)
+    stats = RunStats() if args.stats else None
+    try:
+        anki_parse(args.text_file, args.tsv_file, args.cards, args.required_count, args.history, args.disable_history, args.chunk_size,
+                   args.workers, args.threshold_scope, args.cache_dir, args.cache_size << 20, args.disable_cache,
+                   args.compact, args.disable_snapshot, args.import_tsv, args.chapter_pattern, args.chapter, args.chapter_output,
+                   args.count_mode, args.lemma_language, args.lemma_table, stats, args.sampling, args.encoding)
+    except ValueError as e:
+        parser.error(str(e))
+    if stats is not None:
+        print(stats.toJson() if args.stats == "json" else stats.toTable(), file=sys.stderr)
@@ -0,0 +1,34 @@
+import os
+import stat
+import tempfile
+from contextlib import contextmanager
+
+# Read once: os.umask can only be read by setting it, which would race with threads creating files
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def fileMode(file_name):
+    # Permissions file_name has, or the ones open() would give it if it does not exist yet
+    try:
+        return stat.S_IMODE(os.stat(file_name).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+@contextmanager
+def atomicWrite(file_name, mode="w", encoding=None):
+    # Yields a temporary file next to file_name that replaces it when the block succeeds, so an
+    # interrupted save leaves the previous file intact. A symlink is followed and its target is
+    # replaced, and the file keeps its permissions. On failure the temporary file is removed.
+    target = os.path.realpath(file_name)
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmpPath, fileMode(target))
+        os.replace(tmpPath, target)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import codecs
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import freeze_support
+
+import anki
+from anki import (openDictionary, SqliteAnkiDictionary, KnownWordIndex, CHUNK_SIZE, COUNT_MODES, COUNT_SUBSTRING, COUNT_LEMMA,
+                  _initCountWorker, _countFileWorker)
+from countcache import CountCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, fileDigest
+from lemma import INFLECTORS
+from readers import READERS, DEFAULT_ENCODING
+
+DBUG = False
+TSV_SUFFIX = ".tsv"
+PENDING_PER_WORKER = 2  # Books queued per worker process; bounds memory however long the manifest is
+
+class ManifestError(Exception):
+    """The manifest cannot be read or names missing files."""
+
+def loadManifest(file_name):
+    # Returns a list of jobs (dicts with absolute paths). The manifest is JSON:
+    #   {"output": "decks", "requiredCount": 1, "countMode": "substring", "history": null, "lemmaLanguage": null, "lemmaTable": null,
+    #    "encoding": "utf-8",
+    #    "books": [{"book": "b1.txt", "dictionary": "dict.tsv"}, {"book": "b2.txt", "dictionary": "dict.tsv", "requiredCount": 3}]}
+    # Top-level settings are defaults for every book; relative paths are relative to the manifest.
+    try:
+        with open(file_name, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except Exception as e:
+        raise ManifestError(f"Cannot read manifest {file_name}: {e}") from e
+    base = os.path.dirname(os.path.abspath(file_name))
+    resolve = lambda path: path if path is None else os.path.join(base, path)
+    defaults = {"output": ".", "requiredCount": 1, "countMode": COUNT_SUBSTRING, "history": None, "lemmaLanguage": None, "lemmaTable": None,
+                "encoding": DEFAULT_ENCODING}
+    defaults.update({key: manifest[key] for key in defaults if key in manifest})
+    jobs = []
+    for entry in manifest.get("books", []):
+        if isinstance(entry, str):
+            entry = {"book": entry}
+        job = dict(defaults, **entry)
+        if "book" not in job or "dictionary" not in job:
+            raise ManifestError(f"Every book needs a 'book' and a 'dictionary': {entry}")
+        if job["countMode"] not in COUNT_MODES:
+            raise ManifestError(f"countMode must be one of {', '.join(COUNT_MODES)}: {entry}")
+        if (job["lemmaLanguage"] or job["lemmaTable"]) and job["countMode"] != COUNT_LEMMA:
+            raise ManifestError(f"lemmaLanguage and lemmaTable need countMode '{COUNT_LEMMA}': {entry}")
+        if job["lemmaLanguage"] and job["lemmaLanguage"] not in INFLECTORS:
+            raise ManifestError(f"lemmaLanguage must be one of {', '.join(INFLECTORS)}: {entry}")
+        try:
+            codecs.lookup(job["encoding"])
+        except LookupError:
+            raise ManifestError(f"Unknown text encoding {job['encoding']}: {entry}")
+        for key in ("book", "dictionary", "history", "lemmaTable"):
+            job[key] = resolve(job[key])
+        output = resolve(job["output"])
+        if not output.endswith(TSV_SUFFIX):
+            output = os.path.join(output, _bookName(job["book"]) + TSV_SUFFIX)
+        job["output"] = output
+        job["requiredCount"] = int(job["requiredCount"])
+        jobs.append(job)
+    outputs = {}
+    for job in jobs:
+        output = os.path.normcase(os.path.normpath(job["output"]))
+        if output in outputs:
+            raise ManifestError(f"{outputs[output]} and {job['book']} would both be written to {job['output']}; give one of them its own 'output'")
+        outputs[output] = job["book"]
+    for job in jobs:
+        for key in ("book", "dictionary"):
+            if not os.path.isfile(job[key]):
+                raise ManifestError(f"{key.capitalize()} file not found: {job[key]}")
+    return jobs
+
+def _bookName(book):
+    # novel.txt, novel.txt.gz and novel.epub are all "novel"
+    name = os.path.basename(book)
+    suffix = next((suffix for suffix in READERS if name.lower().endswith(suffix)), None)
+    if suffix is None:
+        return os.path.splitext(name)[0]
+    name = name[:-len(suffix)]
+    return name[:-4] if name.lower().endswith(".txt") else name
+
+def _timedCount(job):
+    # Runs in a pool worker set up by anki._initCountWorker
+    start = time.perf_counter()
+    counts = _countFileWorker(job)
+    return counts, time.perf_counter() - start
+
+def _scanBooks(dictionary, books, chunkSize, workers, cache):
+    # Yields (book, counts, seconds) as books finish. Books found in the CountCache are
+    # not scanned; with workers > 1 at most workers * PENDING_PER_WORKER books are in flight.
+    version = dictionary.countVersion() if cache is not None else None
+    keys = {}
+    pending = []
+    for book in books:
+        if cache is not None:
+            try:
+                keys[book] = cache.key(fileDigest(book), version)
+            except Exception as e:
+                if(DBUG):print(f"Error reading file {book}: {e}")
+            else:
+                counts = cache.get(keys[book], len(dictionary.words))
+                if counts is not None:
+                    yield book, counts, 0.0
+                    continue
+        pending.append(book)
+
+    def scanned(book, counts, seconds):
+        if book in keys and counts is not None:
+            cache.put(keys[book], counts)
+        return book, counts, seconds
+
+    if workers <= 1 or len(pending) <= 1:
+        for book in pending:
+            start = time.perf_counter()
+            counts = dictionary.countFromFile(book, chunkSize, cache)
+            yield scanned(book, counts, time.perf_counter() - start)
+        return
+    initargs = (dictionary.getScanner(), dictionary._matcherSlots, dictionary.countMode, cache, version, dictionary.textEncoding)
+    with ProcessPoolExecutor(max_workers=min(workers, len(pending)), initializer=_initCountWorker, initargs=initargs) as pool:
+        queued, running = iter(pending), {}
+        while True:
+            while len(running) < workers * PENDING_PER_WORKER:
+                book = next(queued, None)
+                if book is None:
+                    break
+                running[pool.submit(_timedCount, (book, chunkSize))] = book
+            if not running:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                counts, seconds = future.result()
+                yield scanned(running.pop(future), counts, seconds)
+
+def _loadHistory(historyFile, cache):
+    # Histories are read-only in a batch run, and filtering needs only their known forms; each is loaded once
+    if historyFile not in cache:
+        history = openDictionary(historyFile)
+        if not isinstance(history, SqliteAnkiDictionary):
+            history = KnownWordIndex.load(historyFile)
+        cache[historyFile] = history
+    return cache[historyFile]
+
+def runBatch(jobs, workers: int = 1, chunkSize: int = CHUNK_SIZE, cache=None, compact=False, log=None):
+    # Tags every book of the manifest without any prompt and writes one TSV per book in the
+    # saveTrueToFile format. Each dictionary is loaded once, and its books are scanned as a
+    # stream. Returns the summary report as a dict.
+    started = time.perf_counter()
+    groups = {}
+    for job in jobs:
+        groups.setdefault((job["dictionary"], job["countMode"], job["lemmaLanguage"], job["lemmaTable"], job["encoding"]), []).append(job)
+    histories = {}
+    books = []
+
+    for (dictionaryFile, countMode, lemmaLanguage, lemmaTable, encoding), group in groups.items():
+        loadStart = time.perf_counter()
+        dictionary = openDictionary(dictionaryFile, compact)
+        if not isinstance(dictionary, SqliteAnkiDictionary):
+            dictionary.loadFromFile(dictionaryFile, snapshot=True)
+        dictionary.countMode = countMode
+        dictionary.textEncoding = encoding
+        dictionary.lemmaLanguage = lemmaLanguage
+        if lemmaTable:
+            dictionary.loadLemmaTable(lemmaTable)
+        dictionary.getScanner()
+        loadSeconds = time.perf_counter() - loadStart
+        if log:
+            log(f"{dictionaryFile}: {len(dictionary.words)} words loaded in {loadSeconds:.2f} s")
+
+        byBook = {}
+        for job in group:
+            byBook.setdefault(job["book"], []).append(job)
+        for book, counts, seconds in _scanBooks(dictionary, list(byBook), chunkSize, workers, cache):
+            for job in byBook[book]:
+                entry = {"book": book, "dictionary": dictionaryFile, "output": job["output"], "bytes": os.path.getsize(book),
+                         "seconds": round(seconds, 6), "tagged": 0, "occurrences": 0, "error": None}
+                if counts is None:
+                    entry["error"] = f"Cannot read the book (missing, damaged or not {encoding})"
+                else:
+                    dictionary.clearTags()
+                    dictionary.tagFromCounts(counts, job["requiredCount"])
+                    if job["history"]:
+                        dictionary.tagsAndNotKnown(_loadHistory(job["history"], histories))  # Words the history knows are not exported
+                    os.makedirs(os.path.dirname(job["output"]) or ".", exist_ok=True)
+                    dictionary.saveTrueToFile(job["output"])
+                    entry["tagged"] = len(dictionary.getTagged())
+                    entry["occurrences"] = sum(counts)
+                entry["megabytesPerSecond"] = round(entry["bytes"] / (1 << 20) / seconds, 3) if seconds > 0 else None
+                books.append(entry)
+                if log:
+                    log(f"{book}: {entry['error'] or str(entry['tagged']) + ' words tagged'} ({seconds:.2f} s)")
+
+        if isinstance(dictionary, SqliteAnkiDictionary):
+            dictionary.close()  # Its tags were only needed for the exports
+
+    for history in histories.values():
+        if isinstance(history, SqliteAnkiDictionary):
+            history.close()
+    elapsed = time.perf_counter() - started
+    totalBytes = sum(entry["bytes"] for entry in books)
+    return {"books": books, "summary": {
+        "books": len(books), "failed": sum(entry["error"] is not None for entry in books),
+        "dictionaries": len(groups), "bytes": totalBytes, "seconds": round(elapsed, 6),
+        "megabytesPerSecond": round(totalBytes / (1 << 20) / elapsed, 3) if elapsed > 0 else None,
+        "tagged": sum(entry["tagged"] for entry in books), "workers": workers}}
+
+def formatReport(report):
+    # The summary report as a table, one line per book
+    rows = [("book", "tagged", "MB", "seconds", "MB/s")]
+    for entry in report["books"]:
+        rows.append((os.path.basename(entry["book"]), "error" if entry["error"] else str(entry["tagged"]),
+                     f"{entry['bytes'] / (1 << 20):.2f}", f"{entry['seconds']:.2f}", f"{entry['megabytesPerSecond'] or 0:.2f}"))
+    summary = report["summary"]
+    rows.append(("total", str(summary["tagged"]), f"{summary['bytes'] / (1 << 20):.2f}", f"{summary['seconds']:.2f}",
+                 f"{summary['megabytesPerSecond'] or 0:.2f}"))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(cell.ljust(w) if i == 0 else cell.rjust(w) for i, (cell, w) in enumerate(zip(row, widths))) for row in rows)
+
+if __name__ == "__main__":
+    freeze_support()  # A frozen (PyInstaller) build must not rerun the batch in each worker process
+    parser = argparse.ArgumentParser(description="Tag a library of books without prompts and write one TSV of tagged words per book.")
+    parser.add_argument("manifest", help="JSON manifest listing the books and their dictionaries")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Books scanned in parallel. (default: number of CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help=f"Characters read per scanning step. (default: {CHUNK_SIZE})")
+    parser.add_argument("--report", type=str, default=None, help="Write the summary report as JSON to this file")
+    parser.add_argument("--cache-dir", type=str, default=DEFAULT_CACHE_DIR, help=f"Directory holding cached occurrence counts per book. (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--disable-cache", action="store_true", help="Always rescan the books and do not store their counts")
+    parser.add_argument("--compact", action="store_true", help="Store the dictionaries in compact columns")
+    parser.add_argument("--quiet", action="store_true", help="Only print the report")
+    parser.add_argument("--debug", action="store_true", help="Enable debug output")
+    args = parser.parse_args()
+
+    if(args.debug): DBUG = anki.DBUG = True
+    try:
+        jobs = loadManifest(args.manifest)
+    except ManifestError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(2)
+    cache = None if args.disable_cache else CountCache(args.cache_dir, DEFAULT_MAX_BYTES)
+    report = runBatch(jobs, max(1, args.workers), args.chunk_size, cache, args.compact,
+                      log=None if args.quiet else lambda message: print(message, file=sys.stderr))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(formatReport(report))
+    sys.exit(1 if report["summary"]["failed"] else 0)
@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import argparse
+import urllib.request
+import urllib.error
+import urllib.parse
+
+from countcache import DEFAULT_CACHE_DIR
+
+DEFAULT_URL = "http://127.0.0.1:8765"  # Where daemon.py listens by default
+TOKEN_HEADER = "X-Anki-Token"  # Carries the token daemon.py writes to tokenFile(port) when it starts
+
+def tokenFile(port):
+    # Where the service listening on port keeps its token, readable only by the user who started it
+    return os.path.join(DEFAULT_CACHE_DIR, f"daemon-{port}.token")
+
+class AnkiClientError(Exception):
+    """The service answered with an error, or could not be reached."""
+
+class AnkiClient:
+    """Thin client of daemon.py: one method per route, plain dicts in and out."""
+
+    def __init__(self, url=DEFAULT_URL, timeout: float = 600, token=None):
+        # token: by default read from tokenFile of the url's port on the first request
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.token = token
+
+    def _token(self):
+        if self.token is None:
+            try:
+                with open(tokenFile(urllib.parse.urlsplit(self.url).port or 80), encoding="utf-8") as f:
+                    self.token = f.read().strip()
+            except OSError as e:
+                raise AnkiClientError(f"No token for {self.url}; is daemon.py running? ({e})") from e
+        return self.token
+
+    def _post(self, path, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        request = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+        return self._send(request)
+
+    def _send(self, request):
+        request.add_header(TOKEN_HEADER, self._token())
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error", str(e))
+            except Exception:
+                message = str(e)
+            raise AnkiClientError(message) from e
+        except urllib.error.URLError as e:
+            raise AnkiClientError(f"Cannot reach {self.url}: {e.reason}") from e
+
+    def status(self):
+        return self._send(urllib.request.Request(self.url + "/status"))
+
+    def load(self, dictionary):
+        return self._post("/load", {"dictionary": os.path.abspath(dictionary)})
+
+    def tag(self, dictionary, text=None, files=None, requiredCount: int = 1, **options):
+        # Words of the dictionary found at least requiredCount times in text or in the files
+        return self._post("/tag", _body(dictionary, text, files, requiredCount=requiredCount, **options))["words"]
+
+    def cards(self, dictionary, text=None, files=None, history=None, cards: int = 5, requiredCount: int = 1, **options):
+        body = _body(dictionary, text, files, cards=cards, requiredCount=requiredCount, **options)
+        if history:
+            body["history"] = os.path.abspath(history)
+        return self._post("/cards", body)["cards"]
+
+    def confidence(self, dictionary, history, ratings):
+        # ratings: {word id: confidence 1-5}
+        return self._post("/confidence", {"dictionary": os.path.abspath(dictionary), "history": os.path.abspath(history),
+                                          "ratings": [{"id": id, "confidence": c} for id, c in ratings.items()]})
+
+def _body(dictionary, text, files, **options):
+    # Paths are sent absolute: the service does not share this process's working directory
+    body = {"dictionary": os.path.abspath(dictionary), **options}
+    if text is not None:
+        body["text"] = text
+    else:
+        body["files"] = [os.path.abspath(path) for path in files or []]
+    return body
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send requests to a running daemon.py.")
+    parser.add_argument("--url", default=DEFAULT_URL, help=f"Address of the service. (default: {DEFAULT_URL})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    tag = commands.add_parser("tag", help="Print the dictionary words found in text files (or stdin with -)")
+    cards = commands.add_parser("cards", help="Print review cards for text files")
+    for command in (tag, cards):
+        command.add_argument("tsv_file", help="Dictionary TSV loaded by the service")
+        command.add_argument("text_file", nargs="+", help="Text files, or - to read the text from stdin")
+        command.add_argument("--required-count", type=int, default=1, help="Minimum number of occurrences. (default: 1)")
+        command.add_argument("--count-mode", default=None, help="substring, segment or lemma (default: the service's default)")
+    cards.add_argument("-cards", type=int, default=5, help="Number of cards (default: 5)")
+    cards.add_argument("-history", type=str, default=None, help="History TSV whose known words are skipped and whose schedule is used")
+    cards.add_argument("--sampling", default=None, help="uniform or frequency")
+    rate = commands.add_parser("rate", help="Record confidence ratings, e.g. rate dict.tsv history.tsv 00042=4 00043=2")
+    rate.add_argument("tsv_file")
+    rate.add_argument("history")
+    rate.add_argument("ratings", nargs="+", help="id=confidence pairs")
+    commands.add_parser("status", help="List the dictionaries the service holds")
+    args = parser.parse_args()
+
+    client = AnkiClient(args.url)
+    try:
+        if args.command == "status":
+            result = client.status()
+        elif args.command == "rate":
+            result = client.confidence(args.tsv_file, args.history, {id: int(c) for id, c in (r.split("=", 1) for r in args.ratings)})
+        else:
+            text = sys.stdin.read() if args.text_file == ["-"] else None
+            options = {key: value for key, value in (("countMode", args.count_mode),) if value}
+            if args.command == "tag":
+                result = client.tag(args.tsv_file, text, args.text_file, args.required_count, **options)
+            else:
+                if args.sampling:
+                    options["sampling"] = args.sampling
+                result = client.cards(args.tsv_file, text, args.text_file, args.history, args.cards, args.required_count, **options)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    except AnkiClientError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
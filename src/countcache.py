@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+import tempfile
+
+DBUG = False
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "anki")
+DEFAULT_MAX_BYTES = 64 << 20  # Cache size before the least recently used entries are evicted
+DIGEST_BLOCK = 1 << 20  # Bytes hashed per read when fingerprinting a corpus file
+
+def fileDigest(file_name):
+    # sha256 of the file contents, read in blocks so memory stays flat
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(DIGEST_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class CountCache:
+    """On-disk cache of per-word occurrence counts, one JSON file per (corpus file, dictionary) pair.
+
+    Entries are keyed by the sha256 of the corpus contents plus the dictionary
+    version (see AnkiDictionary.countVersion), so editing either invalidates
+    them. It also keeps the scan progress of each file path (see progressKey),
+    so a file that only grew can be scanned from where the last scan stopped.
+    When the directory grows past maxBytes the least recently used entries
+    are removed.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, maxBytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+    def key(self, fileHash, dictionaryVersion):
+        return hashlib.sha256(f"{fileHash}:{dictionaryVersion}".encode("utf-8")).hexdigest()
+
+    def progressKey(self, file_name, dictionaryVersion):
+        # Scan progress belongs to a path rather than to its contents, which keep growing
+        path = os.path.abspath(file_name)
+        return hashlib.sha256(f"progress:{path}:{dictionaryVersion}".encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key, size: int):
+        # Returns a count list of the given size, or None on a miss
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            if entry.get("size") != size:
+                return None
+            counts = [0] * size
+            for index, count in entry["counts"]:
+                counts[index] = count
+            os.utime(path)  # Mark as recently used for eviction
+            return counts
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            if(DBUG):print(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+    def put(self, key, counts):
+        # Only non-zero counts are stored; most dictionary words never appear in a given book
+        self._write(key, {"size": len(counts), "counts": [[i, c] for i, c in enumerate(counts) if c]})
+
+    def getProgress(self, key):
+        # Returns (offset, prefix sha256, scan state attributes) saved by putProgress, or None
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            state = {}
+            for name, value in entry["state"].items():
+                if isinstance(value, dict):  # A sparse list
+                    values = [0] * value["size"]
+                    for index, item in value["items"]:
+                        values[index] = item
+                    value = values
+                state[name] = value
+            os.utime(path)
+            return entry["offset"], entry["digest"], state
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            if(DBUG):print(f"Ignoring unreadable progress entry {path}: {e}")
+            return None
+
+    def putProgress(self, key, offset: int, digest, state):
+        # state: attributes of a matcher state; its per-slot lists are stored sparsely like counts
+        entry = {"offset": offset, "digest": digest, "state": {
+            name: {"size": len(value), "items": [[i, v] for i, v in enumerate(value) if v]} if isinstance(value, list) else value
+            for name, value in state.items()}}
+        self._write(key, entry)
+
+    def _write(self, key, entry):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmpPath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f, separators=(",", ":"))
+            os.replace(tmpPath, self._path(key))
+        except Exception as e:
+            if(DBUG):print(f"Error writing cache entry {key}: {e}")
+            return
+        self.evict()
+
+    def evict(self):
+        try:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+        except FileNotFoundError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        maxBytes, self.maxBytes = self.maxBytes, -1
+        self.evict()
+        self.maxBytes = maxBytes
+
+    def __repr__(self):
+        return f"CountCache at {self.directory} (max {self.maxBytes} bytes)"
@@ -0,0 +1,253 @@
+import os
+import sys
+import re
+import json
+import math
+import heapq
+import codecs
+import time
+import argparse
+
+import anki
+from anki import (openDictionary, SqliteAnkiDictionary, KnownWordIndex, CHUNK_SIZE, JOURNAL_SUFFIX, COUNT_MODES, COUNT_SEGMENT, COUNT_LEMMA,
+                  SNAPSHOT_SUFFIX, MINN_CONF, MAXX_CONF, KNOWN_CONFIDENCE)
+from lemma import INFLECTORS
+from readers import DEFAULT_ENCODING
+
+DBUG = False
+DEFAULT_TARGET = 95.0  # Percent of the tokens known, about where a text reads without a dictionary
+WHOLE_BOOK = re.compile(r"(?!)")  # Matches no line: without a chapter pattern the book is one chapter
+LIST_LIMIT = 50  # Words to learn printed in the table; the JSON report has all of them
+KNOWN, LEARNING, UNKNOWN = 0, 1, 2
+STATUS_NAMES = ("known", "learning", "unknown")
+
+def loadKnown(historyFile):
+    # The history's forms and their confidence. A TSV history is read through its .known index;
+    # an SQLite one is read once. A missing history knows nothing.
+    if not historyFile or not (os.path.exists(historyFile) or os.path.exists(historyFile + JOURNAL_SUFFIX)):
+        return KnownWordIndex()
+    history = openDictionary(historyFile)
+    if not isinstance(history, SqliteAnkiDictionary):
+        return KnownWordIndex.load(historyFile)
+    index = KnownWordIndex()
+    with history:
+        for word in history.words:
+            index.record(word)
+    return index
+
+def wordStatus(dictionary, known, knownConfidence: int = KNOWN_CONFIDENCE):
+    # Per word of the dictionary: KNOWN, LEARNING or UNKNOWN, from the highest confidence either
+    # of its forms was last rated with. A word repeating the forms of an earlier one gets None,
+    # so the tokens of a form are counted once.
+    status, seen = [], set()
+    for forms in dictionary.forms():
+        if forms in seen:
+            status.append(None)
+            continue
+        seen.add(forms)
+        confidence = max((known.confidence(form) or 0 for form in forms if form), default=0)
+        status.append(KNOWN if confidence >= knownConfidence else LEARNING if confidence else UNKNOWN)
+    return status
+
+class ChapterCoverage:
+    """Known, learning and unknown tokens of a book's chapters.
+
+    Built from the (number, title, counts) list of AnkiDictionary.countChaptersFromFiles, so the
+    book is matched once. The per-chapter totals are kept as prefix sums: the coverage of any
+    run of chapters, e.g. everything read so far, is one subtraction.
+    """
+
+    def __init__(self, chapters, status):
+        self.chapters = chapters
+        self.status = status
+        self.prefix = [(0, 0, 0)]  # prefix[k]: tokens of the first k chapters by status
+        for number, title, counts in chapters:
+            totals = [0, 0, 0]
+            for i, c in counts.items():
+                if status[i] is not None:
+                    totals[status[i]] += c
+            self.prefix.append(tuple(p + t for p, t in zip(self.prefix[-1], totals)))
+
+    def index(self, number):
+        # Position in self.chapters of chapter number; numbers are consecutive
+        i = number - self.chapters[0][0] if self.chapters else -1
+        if not 0 <= i < len(self.chapters):
+            raise ValueError(f"The book has no chapter {number}.")
+        return i
+
+    def totals(self, first: int = 0, last: int = None):
+        # (known, learning, unknown) tokens of chapters first..last, positions in self.chapters
+        last = len(self.chapters) - 1 if last is None else last
+        return tuple(b - a for a, b in zip(self.prefix[first], self.prefix[last + 1]))
+
+    def coverage(self, first: int = 0, last: int = None):
+        # Percent of the tokens of chapters first..last that are known, None if there are none
+        totals = self.totals(first, last)
+        return 100.0 * totals[KNOWN] / sum(totals) if sum(totals) else None
+
+    def wordsToLearn(self, target: float = DEFAULT_TARGET, first: int = 0, last: int = None):
+        # Fewest words not known yet whose tokens lift the coverage of chapters first..last to
+        # target percent, as (word position, tokens) pairs, most frequent first. Every word adds
+        # only its own tokens, so taking the most frequent first is optimal; a heap yields them
+        # without sorting the whole vocabulary.
+        last = len(self.chapters) - 1 if last is None else last
+        totals = self.totals(first, last)
+        missing = math.ceil(sum(totals) * target / 100) - totals[KNOWN]
+        if missing <= 0:
+            return []
+        status = self.status
+        counts = {}
+        for number, title, chapterCounts in self.chapters[first:last + 1]:
+            for i, c in chapterCounts.items():
+                if status[i] is not None and status[i] != KNOWN:
+                    counts[i] = counts.get(i, 0) + c
+        heap = [(-c, i) for i, c in counts.items()]
+        heapq.heapify(heap)
+        picked = []
+        while heap and missing > 0:
+            c, i = heapq.heappop(heap)
+            picked.append((i, -c))
+            missing += c
+        return picked
+
+def coverageReport(dictionary, chapters, known, target: float = DEFAULT_TARGET, knownConfidence: int = KNOWN_CONFIDENCE,
+                   first=None, last=None):
+    # The report as a dict: coverage per chapter (and through it) and the words to learn to reach
+    # target over chapters first..last (chapter numbers; by default the whole book)
+    status = wordStatus(dictionary, known, knownConfidence)
+    book = ChapterCoverage(chapters, status)
+    percent = lambda value: None if value is None else round(value, 2)
+    rows = []
+    for i, (number, title, counts) in enumerate(chapters):
+        totals = book.totals(i, i)
+        tokens = sum(totals)
+        rows.append({"number": number, "title": title, "tokens": tokens,
+                     **{name: percent(100.0 * n / tokens if tokens else None) for name, n in zip(STATUS_NAMES, totals)},
+                     "coverage": percent(book.coverage(i, i)), "coverageSoFar": percent(book.coverage(0, i)),
+                     "wordsToTarget": len(book.wordsToLearn(target, i, i))})
+
+    if not chapters:
+        return {"chapters": rows, "scope": {"first": None, "last": None, "tokens": 0, "coverage": None, "target": target, "words": []}}
+    firstIndex = 0 if first is None else book.index(first)
+    lastIndex = len(chapters) - 1 if last is None else book.index(last)
+    if firstIndex > lastIndex:
+        raise ValueError(f"Chapter {first} comes after chapter {last}.")
+    totals = book.totals(firstIndex, lastIndex)
+    words, knownTokens = [], totals[KNOWN]
+    for i, c in book.wordsToLearn(target, firstIndex, lastIndex):
+        word = dictionary.words[i]
+        knownTokens += c
+        words.append({"id": word.id, "simplified": word.simplified, "traditional": word.traditional, "meaning": word.meaning,
+                      "status": STATUS_NAMES[status[i]], "tokens": c, "coverage": percent(100.0 * knownTokens / sum(totals))})
+    return {"chapters": rows, "scope": {"first": chapters[firstIndex][0], "last": chapters[lastIndex][0], "tokens": sum(totals),
+                                        "coverage": percent(book.coverage(firstIndex, lastIndex)), "target": target, "words": words}}
+
+def runCoverage(textFiles, dictionaryFile, historyFile=None, chapterPattern=None, target: float = DEFAULT_TARGET,
+                knownConfidence: int = KNOWN_CONFIDENCE, first=None, last=None, countMode=COUNT_SEGMENT, lemmaLanguage=None,
+                lemmaTable=None, chunkSize: int = CHUNK_SIZE, encoding=DEFAULT_ENCODING, compact=False, disableSnapshotFlag=False):
+    # Loads the dictionary, matches the book once and returns coverageReport with the time it took
+    for path in textFiles:
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Text file not found: {path}")
+    if not os.path.isfile(dictionaryFile):
+        raise FileNotFoundError(f"Dictionary file not found: {dictionaryFile}")
+    if not 0 < target <= 100:
+        raise ValueError("target must be a percentage above 0 and at most 100.")
+    if not MINN_CONF <= knownConfidence <= MAXX_CONF:
+        raise ValueError(f"knownConfidence must be from {MINN_CONF} to {MAXX_CONF}.")
+    if countMode not in COUNT_MODES:
+        raise ValueError(f"countMode must be one of {', '.join(COUNT_MODES)}.")
+    if (lemmaLanguage or lemmaTable) and countMode != COUNT_LEMMA:
+        raise ValueError(f"lemmaLanguage and lemmaTable need countMode '{COUNT_LEMMA}'.")
+    if lemmaLanguage and lemmaLanguage not in INFLECTORS:
+        raise ValueError(f"lemmaLanguage must be one of {', '.join(INFLECTORS)}.")
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        raise ValueError(f"Unknown text encoding: {encoding}")
+
+    started = time.perf_counter()
+    dictionary = openDictionary(dictionaryFile, compact or not disableSnapshotFlag)
+    if not isinstance(dictionary, SqliteAnkiDictionary):
+        dictionary.loadFromFile(dictionaryFile, snapshot=not disableSnapshotFlag)
+    dictionary.countMode = countMode
+    dictionary.textEncoding = encoding
+    dictionary.lemmaLanguage = lemmaLanguage
+    if lemmaTable:
+        dictionary.loadLemmaTable(lemmaTable)
+    try:
+        chapters = dictionary.countChaptersFromFiles(textFiles, chapterPattern or WHOLE_BOOK, chunkSize)
+        report = coverageReport(dictionary, chapters, loadKnown(historyFile), target, knownConfidence, first, last)
+    finally:
+        if isinstance(dictionary, SqliteAnkiDictionary):
+            dictionary.close()
+    report["seconds"] = round(time.perf_counter() - started, 6)
+    if(DBUG):print(f"{dictionary}: {len(chapters)} chapters in {report['seconds']:.2f} s")
+    return report
+
+def formatReport(report, limit: int = LIST_LIMIT):
+    # The report as a table, one line per chapter, followed by the words to learn
+    rows = [("chapter", "tokens", "known%", "learning%", "unknown%", "so far%", "to target")]
+    show = lambda value: "-" if value is None else f"{value:.1f}"
+    for entry in report["chapters"]:
+        label = f"{entry['number']} {entry['title']}".strip()
+        rows.append((label, str(entry["tokens"]), show(entry["known"]), show(entry["learning"]), show(entry["unknown"]),
+                     show(entry["coverageSoFar"]), str(entry["wordsToTarget"])))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = ["  ".join(cell.ljust(w) if i == 0 else cell.rjust(w) for i, (cell, w) in enumerate(zip(row, widths))) for row in rows]
+
+    scope = report["scope"]
+    chapters = f"chapter {scope['first']}" if scope["first"] == scope["last"] else f"chapters {scope['first']}-{scope['last']}"
+    words = scope["words"]
+    lines.append("")
+    lines.append(f"Coverage of {chapters}: {show(scope['coverage'])}% of {scope['tokens']} tokens known. "
+                 f"{len(words)} words to learn to reach {scope['target']:g}%" + (":" if words else "."))
+    for word in words[:limit]:
+        lines.append(f"  {word['simplified']}\t{word['tokens']}\t{show(word['coverage'])}%\t{word['status']}\t{word['meaning']}")
+    if len(words) > limit:
+        lines.append(f"  ... and {len(words) - limit} more (see --report)")
+    return "\n".join(lines)
+
+def _chapterRange(value):
+    # "7" or "3-7"
+    first, _, last = value.partition("-")
+    try:
+        return int(first), int(last or first)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a chapter number or a range like 3-7, got {value!r}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report how much of each chapter of a book the words in the history already cover.")
+    parser.add_argument("text_file", nargs="+", help="Text files of the book, read in order")
+    parser.add_argument("tsv_file", help="Dictionary TSV (or SQLite database) whose words are counted")
+    parser.add_argument("-history", type=str, default="anki_history.tsv", help="History whose rated words are known or being learned (default: anki_history.tsv)")
+    parser.add_argument("--chapter-pattern", type=str, default=None, help="Regular expression matching the first line of each chapter, e.g. '^第.+章'. Without it the book is one chapter")
+    parser.add_argument("--chapters", type=_chapterRange, default=None, help="Chapter number or range (e.g. 3-7) the words to learn are picked for. (default: the whole book)")
+    parser.add_argument("--target", type=float, default=DEFAULT_TARGET, help=f"Percent of the tokens that should be known. (default: {DEFAULT_TARGET:g})")
+    parser.add_argument("--known-confidence", type=int, default=KNOWN_CONFIDENCE,
+                        help=f"Lowest confidence at which a history word counts as known; lower rated words are still being learned. (default: {KNOWN_CONFIDENCE})")
+    parser.add_argument("--count-mode", choices=list(COUNT_MODES), default=COUNT_SEGMENT,
+                        help="How tokens are counted, as in anki.py. 'segment' (the default) counts each piece of text once, so the shares add up.")
+    parser.add_argument("--lemma-language", choices=sorted(INFLECTORS), default=None, help="Inflection rules used by --count-mode lemma")
+    parser.add_argument("--lemma-table", type=str, default=None, help="TSV of 'surface form<TAB>dictionary form' pairs used by --count-mode lemma")
+    parser.add_argument("--encoding", type=str, default=DEFAULT_ENCODING, help=f"Encoding of the text files. (default: {DEFAULT_ENCODING})")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help=f"Characters read per scanning step. (default: {CHUNK_SIZE})")
+    parser.add_argument("--compact", action="store_true", help="Store the dictionary in compact columns")
+    parser.add_argument("--disable-snapshot", action="store_true", help=f"Always parse the dictionary TSV instead of using its {SNAPSHOT_SUFFIX} snapshot")
+    parser.add_argument("--report", type=str, default=None, help="Write the full report as JSON to this file")
+    parser.add_argument("--debug", action="store_true", help="Enable debug output")
+    args = parser.parse_args()
+
+    if(args.debug): DBUG = anki.DBUG = True
+    first, last = args.chapters or (None, None)
+    try:
+        report = runCoverage(args.text_file, args.tsv_file, args.history, args.chapter_pattern, args.target, args.known_confidence,
+                             first, last, args.count_mode, args.lemma_language, args.lemma_table, args.chunk_size, args.encoding,
+                             args.compact, args.disable_snapshot)
+    except (ValueError, FileNotFoundError, re.error) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(2)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(formatReport(report))
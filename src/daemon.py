@@ -0,0 +1,349 @@
+import os
+import hmac
+import json
+import codecs
+import secrets
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from anki import (AnkiWord, AnkiDictionary, SqliteAnkiDictionary, openDictionary, CHUNK_SIZE, MAXX_CONF, MINN_CONF, JOURNAL_SUFFIX,
+                  SQLITE_SUFFIXES, COUNT_MODES, COUNT_SUBSTRING, SAMPLE_UNIFORM, SAMPLE_FREQUENCY)
+from countcache import CountCache, DEFAULT_CACHE_DIR
+from scheduler import Scheduler, SCHEDULE_SUFFIX
+from readers import DEFAULT_ENCODING
+from client import TOKEN_HEADER, tokenFile
+
+DBUG = False
+DEFAULT_HOST = "127.0.0.1"  # Local connections only
+DEFAULT_PORT = 8765
+MAX_REQUEST_BYTES = 64 << 20  # Largest request body accepted (inline text included)
+LOCAL_HOSTS = {"127.0.0.1", "localhost", "::1"}  # Host header values accepted besides the address listened on
+
+class DaemonError(Exception):
+    """A request the service cannot serve; answered with HTTP 400 and the message."""
+
+class LoadedDictionary:
+    """A dictionary kept in memory by the service, reloaded when its TSV changes on disk."""
+
+    def __init__(self, path, compact=False):
+        self.path = path
+        self.compact = compact
+        self.lock = threading.RLock()  # Requests on one dictionary run one at a time; tags are shared state
+        self.dictionary = None
+        self.stamp = None
+
+    def get(self):
+        # Call with self.lock held
+        stamp = _stamp(self.path)
+        if self.dictionary is None or stamp != self.stamp:
+            dictionary = openDictionary(self.path, self.compact)
+            dictionary.loadFromFile(self.path, snapshot=True)
+            dictionary.getMatcher()  # Built once here rather than inside the first tag request
+            self.dictionary, self.stamp = dictionary, stamp
+        return self.dictionary
+
+class LoadedHistory:
+    """A history kept in memory by the service, so every /cards request filters against the same
+    form index and /confidence updates it in place. Reloaded when its TSV or journal changes on
+    disk through someone else. SQLite histories are not held; only the lock is used for them."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()  # Serializes the history's read-modify-write
+        self.history = None
+        self.stamp = None
+
+    def get(self):
+        # Call with self.lock held
+        stamp = _historyStamp(self.path)
+        if self.history is None or stamp != self.stamp:
+            history = AnkiDictionary()
+            if stamp != (None, None):
+                history.loadFromFile(self.path, journal=True)
+            self.history, self.stamp = history, stamp
+        return self.history
+
+    def save(self):
+        # Call with self.lock held, after changing the history returned by get()
+        self.history.saveJournaled(self.path)
+        self.stamp = _historyStamp(self.path)
+
+class AnkiService:
+    """Tag, card selection and confidence updates against dictionaries held in memory.
+
+    Every method takes and returns plain JSON-ready values, so the HTTP handler
+    below is only transport. In-memory (TSV) dictionaries are loaded once and
+    kept with their matcher; SQLite stores are opened per request because a
+    sqlite3 connection belongs to the thread that made it.
+    """
+
+    def __init__(self, compact=False, cacheDir=DEFAULT_CACHE_DIR):
+        self.compact = compact
+        self.cache = CountCache(cacheDir) if cacheDir else None
+        self._loaded = {}  # Absolute TSV path -> LoadedDictionary
+        self._histories = {}  # Absolute history path -> LoadedHistory
+        self._lock = threading.Lock()
+
+    def _entry(self, path):
+        path = os.path.abspath(_required(path, "dictionary"))
+        if not os.path.isfile(path):
+            raise DaemonError(f"Dictionary file not found: {path}")
+        with self._lock:
+            if path not in self._loaded:
+                self._loaded[path] = LoadedDictionary(path, self.compact)
+            return self._loaded[path]
+
+    def _history(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            if path not in self._histories:
+                self._histories[path] = LoadedHistory(path)
+            return self._histories[path]
+
+    def _withDictionary(self, path, work):
+        # Runs work(dictionary) with the dictionary loaded and locked
+        if str(path).lower().endswith(SQLITE_SUFFIXES):
+            with SqliteAnkiDictionary(path) as dictionary:  # Tags set by the request are dropped on close
+                return work(dictionary)
+        entry = self._entry(path)
+        with entry.lock:
+            return work(entry.get())
+
+    def load(self, request):
+        # Loads (or reloads) a dictionary ahead of the first tag request
+        def work(dictionary):
+            return {"dictionary": request["dictionary"], "words": len(dictionary.words)}
+        return self._withDictionary(request.get("dictionary"), work)
+
+    def status(self, request=None):
+        with self._lock:
+            entries = list(self._loaded.values())
+        return {"dictionaries": [{"path": e.path, "words": len(e.dictionary.words) if e.dictionary else None} for e in entries]}
+
+    def tag(self, request):
+        # {"dictionary", "text" or "files", "requiredCount", "countMode"} -> words reaching requiredCount
+        requiredCount = int(request.get("requiredCount", 1))
+        def work(dictionary):
+            counts = self._count(dictionary, request)
+            return {"words": [_wordJson(word, count) for word, count in zip(dictionary.words, counts) if count >= requiredCount]}
+        return self._withDictionary(request.get("dictionary"), work)
+
+    def cards(self, request):
+        # {"dictionary", "text" or "files", "requiredCount", "history", "cards", "sampling"} -> cards to review
+        requiredCount = int(request.get("requiredCount", 1))
+        numCards = int(request.get("cards", 5))
+        sampling = request.get("sampling", SAMPLE_UNIFORM)
+        if sampling not in (SAMPLE_UNIFORM, SAMPLE_FREQUENCY):
+            raise DaemonError(f"sampling must be '{SAMPLE_UNIFORM}' or '{SAMPLE_FREQUENCY}'.")
+        historyFile = request.get("history")
+
+        def work(dictionary):
+            counts = self._count(dictionary, request)
+            dictionary.clearTags()
+            dictionary.tagFromCounts(counts, requiredCount)
+            dictionary.wordCounts = counts
+            if not historyFile:
+                picked = dictionary.getTaggedWeighted(numCards) if sampling == SAMPLE_FREQUENCY else dictionary.getTaggedRand(numCards)
+            else:
+                entry = self._history(historyFile)
+                with entry.lock:
+                    if historyFile.lower().endswith(SQLITE_SUFFIXES):
+                        with SqliteAnkiDictionary(historyFile) as history:
+                            dictionary.tagsAndNotKnown(history)
+                    else:
+                        dictionary.tagsAndNotKnown(entry.get())
+                    scheduler = Scheduler()
+                    scheduler.loadFromFile(historyFile + SCHEDULE_SUFFIX)
+                picked = dictionary.getTaggedDue(numCards, scheduler, weighted=sampling == SAMPLE_FREQUENCY)
+            return {"cards": [_wordJson(word) for word in picked.words]}
+        return self._withDictionary(request.get("dictionary"), work)
+
+    def confidence(self, request):
+        # {"dictionary", "history", "ratings": [{"id", "confidence"}]}: stores the ratings in the
+        # history and its review schedule, like the end of a command line session
+        historyFile = _required(request.get("history"), "history")
+        ratings = request.get("ratings") or []
+
+        def work(dictionary):
+            learned = []
+            for rating in ratings:
+                word = dictionary.wordFromId(str(rating.get("id")))
+                if word is None:
+                    raise DaemonError(f"Unknown word id: {rating.get('id')}")
+                confidence = min(max(int(rating.get("confidence", MINN_CONF)), MINN_CONF), MAXX_CONF)
+                learned.append((AnkiWord(word.id, word.simplified, word.traditional, word.pronunciation, word.meaning,
+                                         word.translation, word.extra1, word.extra2, True, confidence), confidence))
+            entry = self._history(historyFile)
+            with entry.lock:
+                if historyFile.lower().endswith(SQLITE_SUFFIXES):
+                    with SqliteAnkiDictionary(historyFile) as history:
+                        history.addNewWords([word for word, _ in learned])
+                        history.saveJournaled(historyFile)
+                else:
+                    entry.get().addNewWords([word for word, _ in learned])
+                    entry.save()
+                scheduler = Scheduler()
+                scheduler.loadFromFile(historyFile + SCHEDULE_SUFFIX)
+                for word, confidence in learned:
+                    scheduler.review(word.id, confidence)
+                scheduler.saveToFile(historyFile + SCHEDULE_SUFFIX)
+            return {"recorded": len(learned)}
+        return self._withDictionary(request.get("dictionary"), work)
+
+    def _count(self, dictionary, request):
+        countMode = request.get("countMode", COUNT_SUBSTRING)
+        if countMode not in COUNT_MODES:
+            raise DaemonError(f"countMode must be one of {', '.join(COUNT_MODES)}.")
+        dictionary.countMode = countMode
+        dictionary.lemmaLanguage = request.get("lemmaLanguage")
+        encoding = request.get("encoding", DEFAULT_ENCODING)
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            raise DaemonError(f"Unknown text encoding: {encoding}")
+        dictionary.textEncoding = encoding
+        if "text" in request:
+            return dictionary.countFromText(str(request["text"]))
+        files = request.get("files")
+        if not files:
+            raise DaemonError("Send either text or files.")
+        for path in files:
+            if not os.path.isfile(path):
+                raise DaemonError(f"Text file not found: {path}")
+        perFile = [counts for counts in dictionary.countFromFiles(files, CHUNK_SIZE, 1, self.cache) if counts is not None]
+        return [sum(column) for column in zip(*perFile)] if perFile else [0] * len(dictionary.words)
+
+def _required(value, name):
+    if not value:
+        raise DaemonError(f"Missing '{name}'.")
+    return value
+
+def _stamp(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _historyStamp(path):
+    # Stamps of a history TSV and its journal, None for a file that does not exist (yet)
+    return tuple(_stamp(p) if os.path.exists(p) else None for p in (path, path + JOURNAL_SUFFIX))
+
+def _wordJson(word, count=None):
+    entry = {"id": word.id, "simplified": word.simplified, "traditional": word.traditional,
+             "pronunciation": word.pronunciation, "meaning": word.meaning, "translation": word.translation,
+             "extra1": word.extra1, "extra2": word.extra2, "confidence": word.confidence}
+    if count is not None:
+        entry["count"] = count
+    return entry
+
+ROUTES = {"/tag": "tag", "/cards": "cards", "/confidence": "confidence", "/load": "load", "/status": "status"}
+
+class AnkiRequestHandler(BaseHTTPRequestHandler):
+    """JSON over HTTP: POST a JSON object to one of ROUTES, get a JSON object back."""
+
+    service = None  # AnkiService, set by makeServer()
+    token = None  # Secret every request must carry in TOKEN_HEADER, set by makeServer()
+
+    def _authorized(self):
+        # A page rebinding its DNS name to this address would be same-origin here, so the Host header
+        # must name this machine. The token keeps out everything that cannot read the user's token file.
+        host = self.headers.get("Host", "")
+        name = host[1:host.find("]")] if host.startswith("[") else host.rsplit(":", 1)[0]
+        if name.lower() not in LOCAL_HOSTS | {self.server.server_address[0]}:
+            self._reply(403, {"error": f"Host {host} is not allowed"})
+            return False
+        if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, "").encode(), self.token.encode()):
+            self._reply(403, {"error": f"Missing or wrong {TOKEN_HEADER}"})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path == "/status":
+            self._reply(200, self.service.status())
+        else:
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        method = ROUTES.get(self.path)
+        if method is None:
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+            return
+        # A cross-origin JSON POST needs a preflight this server never answers
+        if self.headers.get("Content-Type", "").split(";")[0].strip() != "application/json":
+            self._reply(415, {"error": "Content-Type must be application/json"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_BYTES:
+            self._reply(413, {"error": "Request too large"})
+            return
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise DaemonError("The request must be a JSON object.")
+            self._reply(200, getattr(self.service, method)(request))
+        except (DaemonError, ValueError, TypeError) as e:
+            self._reply(400, {"error": str(e)})
+        except Exception as e:
+            if(DBUG):print(f"Error serving {self.path}: {e}")
+            self._reply(500, {"error": str(e)})
+
+    def _reply(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if(DBUG):super().log_message(format, *args)
+
+def makeServer(service, host=DEFAULT_HOST, port=DEFAULT_PORT, token=None):
+    # Returns a ThreadingHTTPServer for service; port 0 picks a free port (see server.server_address).
+    # Requests must carry token (by default a new random one, see server.token) in TOKEN_HEADER.
+    token = token or secrets.token_urlsafe(32)
+    handler = type("BoundAnkiRequestHandler", (AnkiRequestHandler,), {"service": service, "token": token})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.token = token
+    return server
+
+def writeToken(file_name, token):
+    # Only the user running the service may read it
+    os.makedirs(os.path.dirname(file_name), mode=0o700, exist_ok=True)
+    fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.chmod(file_name, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(token)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep dictionaries in memory and serve tagging requests on a local HTTP port.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Address to listen on. (default: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on. (default: {DEFAULT_PORT})")
+    parser.add_argument("--preload", nargs="*", default=[], help="Dictionary TSV files to load before serving")
+    parser.add_argument("--compact", action="store_true", help="Store the dictionaries in compact columns")
+    parser.add_argument("--cache-dir", type=str, default=DEFAULT_CACHE_DIR, help=f"Count cache used for text files. (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--debug", action="store_true", help="Enable debug output")
+    args = parser.parse_args()
+
+    if(args.debug): DBUG = True
+    service = AnkiService(args.compact, args.cache_dir)
+    for path in args.preload:
+        print(f"Loaded {path}: {service.load({'dictionary': path})['words']} words")
+    server = makeServer(service, args.host, args.port)
+    token = tokenFile(server.server_address[1])
+    writeToken(token, server.token)
+    print(f"Serving on http://{server.server_address[0]}:{server.server_address[1]} (token in {token})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.remove(token)
+        except OSError:
+            pass
@@ -1,10 +1,87 @@
-from tkinter import Tk, Label, Button
+import os
+import queue
+import threading
+from multiprocessing import freeze_support
+from tkinter import Tk, Label, Button, Text, Scale, HORIZONTAL
+from tkinter.ttk import Progressbar
 from tkinterdnd2 import DND_FILES, TkinterDnD
 import tkinter.messagebox as messagebox
 
 # Assuming these classes are defined in anki.py
-from anki import AnkiWord, AnkiDictionary, anki_parse
+from anki import AnkiWord, AnkiDictionary, KnownWordIndex, anki_parse, saveLearnedWords, JOURNAL_SUFFIX
+from pager import TextPager
+from readers import openText, bytesRead, readerFor, isPlainText
+from scheduler import Scheduler, SCHEDULE_SUFFIX
 DBUG = True
+HISTORY_FILE = "anki_history.tsv"  # Same default as the command line; known words in it are not shown
+SCAN_CHUNK_SIZE = 1 << 16  # Characters scanned between progress updates and cancellation checks
+POLL_MS = 50  # How often the Tk loop collects messages from the worker
+
+class TaggingCancelled(Exception):
+    pass
+
+class TagWorker(threading.Thread):
+    """Loads the dictionary, tags it from the text and filters out known words off the Tk thread.
+
+    Tk may only be touched from the main thread, so the worker never calls it:
+    it puts ("status", text), ("progress", fraction), ("done", dictionary, flashcards, scheduler, known),
+    ("error", message) or ("cancelled",) on self.messages, which FlashcardApp
+    drains from a root.after callback.
+    """
+
+    def __init__(self, textFile, dictionaryFile, historyFile=HISTORY_FILE, numFlashCards=5):
+        super().__init__(daemon=True)
+        self.textFile = textFile
+        self.dictionaryFile = dictionaryFile
+        self.historyFile = historyFile
+        self.numFlashCards = numFlashCards
+        self.messages = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _check(self):
+        if self.cancelled.is_set():
+            raise TaggingCancelled()
+
+    def run(self):
+        try:
+            self.messages.put(("done",) + self._work())
+        except TaggingCancelled:
+            self.messages.put(("cancelled",))
+        except Exception as e:
+            self.messages.put(("error", str(e)))
+
+    def _work(self):
+        self.messages.put(("status", "Loading dictionary..."))
+        dictionary = AnkiDictionary()
+        dictionary.loadFromFile(self.dictionaryFile, snapshot=True)
+        self._check()
+
+        # Same single pass as tagFromFile, fed in small pieces so progress and cancel stay live
+        self.messages.put(("status", "Tagging words in the text..."))
+        matcher = dictionary.getScanner()
+        state = dictionary.newMatchState()
+        total = max(os.path.getsize(self.textFile), 1)
+        with openText(self.textFile) as f:
+            for chunk in iter(lambda: f.read(SCAN_CHUNK_SIZE), ""):
+                self._check()
+                matcher.feed(state, chunk)
+                self.messages.put(("progress", min(bytesRead(f) / total, 1.0)))
+        dictionary.clearTags()
+        dictionary.tagFromCounts(dictionary.countsFromSlots(matcher.finish(state)), 1)
+        self._check()
+
+        known = KnownWordIndex()  # Empty until the history exists; the first rating then writes it
+        if os.path.exists(self.historyFile) or os.path.exists(self.historyFile + JOURNAL_SUFFIX):
+            self.messages.put(("status", "Filtering known words..."))
+            known = KnownWordIndex.load(self.historyFile)
+            dictionary.tagsAndNotKnown(known)
+            self._check()
+        scheduler = Scheduler()
+        scheduler.loadFromFile(self.historyFile + SCHEDULE_SUFFIX)
+        return dictionary, dictionary.getTaggedDue(self.numFlashCards, scheduler), scheduler, known
 
 class FlashcardApp:
     def __init__(self, root):
@@ -17,6 +94,12 @@ class FlashcardApp:
         self.flashcards = []  # Start with an empty list for flashcards
         self.flashcardIdx = 0
         self.dictionary = AnkiDictionary()  # Create an AnkiDictionary instance
+        self.historyFile = HISTORY_FILE  # Rated words are added to it, and their schedule saved next to it
+        self.scheduler = Scheduler()  # Review schedule, saved after every rating
+        self.known = KnownWordIndex()  # Known words of historyFile, as loaded by the TagWorker
+        self.worker = None  # TagWorker while a dictionary is being loaded and tagged
+        self.pager = None  # TextPager over the dropped text; only the visible page is in memory
+        self.page = ("", 0, 0)  # (text, start byte, end byte) of the page in the preview
 
         # Initializing the UI elements
         self.label = Label(root, text="Step 1: Drag a text file here!", width=40, height=10)
@@ -28,6 +111,20 @@ class FlashcardApp:
         self.text_area = Label(root, text="", width=40, height=10)
         self.text_area.pack(padx=10, pady=10)
 
+        # Preview of the text file, one page at a time: Page Up/Down or the wheel to scroll, the slider to seek
+        self.preview = Text(root, width=50, height=12, wrap="word", state="disabled")
+        self.preview.tag_config("tagged", background="yellow")
+        self.preview.bind("<Next>", lambda event: self.scroll_preview(1))
+        self.preview.bind("<Prior>", lambda event: self.scroll_preview(-1))
+        self.preview.bind("<MouseWheel>", lambda event: self.scroll_preview(-1 if event.delta > 0 else 1))
+        self.preview.bind("<Button-4>", lambda event: self.scroll_preview(-1))
+        self.preview.bind("<Button-5>", lambda event: self.scroll_preview(1))
+        self.seek_bar = Scale(root, from_=0, to=1000, orient=HORIZONTAL, showvalue=False, command=self.seek_preview)
+
+        # Shown only while a TagWorker runs
+        self.progress = Progressbar(root, length=300, maximum=1.0)
+        self.cancel_button = Button(root, text="Cancel", command=self.cancel_tagging)
+
         # Register drag and drop
         self.label.drop_target_register(DND_FILES)
         self.label.dnd_bind('<<Drop>>', self.drop_file)
@@ -43,11 +140,11 @@ class FlashcardApp:
     def drop_file(self, event):
         dropped_path = event.data
         if self.step == 0:  # Waiting for the text file first
-            if dropped_path.endswith('.txt'):
+            if dropped_path.endswith('.txt') or readerFor(dropped_path) is not None:
                 self.read_text_file(dropped_path)
                 self.step = 1
             else:
-                messagebox.showerror("Error", "Please drop a valid .txt file first.")
+                messagebox.showerror("Error", "Please drop a valid .txt file (or a .gz, .bz2, .xz, .zip or .epub book) first.")
         elif self.step == 1:  # Waiting for the dictionary .tsv file
             if dropped_path.endswith('.tsv'):
                 self.read_dict_file(dropped_path)
@@ -55,37 +152,117 @@ class FlashcardApp:
                 messagebox.showerror("Error", "Please drop a valid .tsv file with dictionary data.")
     
     def read_text_file(self, textFilePath):
+        # Only the first page is read now; the rest is read as the preview scrolls
         self.textFile = textFilePath
+        if not isPlainText(textFilePath):
+            # Packed books are only read while tagging; byte offsets in them are no positions in the text
+            self.pager = None
+            self.text_area.config(text=f"Book loaded successfully! ({os.path.getsize(textFilePath):,} bytes, no preview)")
+            self.label.config(text="Step 2: Now drop the dictionary .tsv file here!")
+            return
         try:
-            with open(textFilePath, 'r', encoding='utf-8') as file:
-                content = file.read()
-                self.text_area.config(text=f"Text file loaded successfully!\n\n{content}")
-                self.label.config(text="Step 2: Now drop the dictionary .tsv file here!")
+            self.pager = TextPager(textFilePath)
+            self.show_page(self.pager.page(0))
+            self.preview.pack(padx=10, pady=5)
+            self.seek_bar.pack(fill="x", padx=10)
+            self.text_area.config(text=f"Text file loaded successfully! ({self.pager.size:,} bytes)")
+            self.label.config(text="Step 2: Now drop the dictionary .tsv file here!")
         except Exception as e:
             self.text_area.config(text=f"Error reading text file: {e}")
 
+    def show_page(self, page):
+        """Put one page into the preview, with the tagged words in it highlighted."""
+        self.page = page
+        text = page[0]
+        self.preview.config(state="normal")
+        self.preview.delete("1.0", "end")
+        self.preview.insert("1.0", text)
+        if self.dictionary.words:
+            for start, end in self.dictionary.taggedSpans(text):
+                self.preview.tag_add("tagged", f"1.0+{start}c", f"1.0+{end}c")
+        self.preview.config(state="disabled")
+
+    def scroll_preview(self, direction):
+        if self.pager is None:
+            return "break"
+        if direction > 0:
+            start = self.pager.next(self.page[2])
+            if start is not None:
+                self.show_page(self.pager.page(start))
+        else:
+            page = self.pager.previous(self.page[1])
+            if page is not None:
+                self.show_page(page)
+        return "break"
+
+    def seek_preview(self, value):
+        if self.pager is not None:
+            self.show_page(self.pager.page(self.pager.seek(int(value) / 1000)))
+
     def read_dict_file(self, dictionaryFilePath):
+        # Loading and tagging run on a TagWorker; the window keeps responding meanwhile
         self.dictionaryFile = dictionaryFilePath
-        try:
-            # Load dictionary data into AnkiDictionary instance
-            self.dictionary.loadFromFile(dictionaryFilePath)
-            self.dictionary.clearTags()
-            self.dictionary.tagFromFile(self.textFile, 1)
-
+        if self.worker is not None:
+            self.worker.cancel()
+        self.worker = TagWorker(self.textFile, dictionaryFilePath, self.historyFile)
+        self.button.config(state="disabled")
+        self.progress.config(mode="indeterminate")
+        self.progress.pack(padx=10, pady=5)
+        self.progress.start()
+        self.cancel_button.pack(padx=10, pady=5)
+        self.worker.start()
+        self.root.after(POLL_MS, self.poll_worker, self.worker)
+
+    def poll_worker(self, worker):
+        """Apply the messages of a TagWorker on the Tk thread, until it finishes."""
+        if worker is not self.worker:
+            return  # Replaced by a newer worker
+        while True:
+            try:
+                message = worker.messages.get_nowait()
+            except queue.Empty:
+                break
+            kind = message[0]
+            if kind == "status":
+                self.label.config(text=message[1])
+            elif kind == "progress":
+                if str(self.progress.cget("mode")) != "determinate":
+                    self.progress.stop()
+                    self.progress.config(mode="determinate")
+                self.progress.config(value=message[1])
+            else:
+                self.finish_tagging(message)
+                return
+        self.root.after(POLL_MS, self.poll_worker, worker)
+
+    def finish_tagging(self, message):
+        self.worker = None
+        self.progress.stop()
+        self.progress.pack_forget()
+        self.cancel_button.pack_forget()
+        self.button.config(state="normal")
+        kind = message[0]
+        if kind == "cancelled":
+            self.label.config(text="Tagging cancelled. Drop a dictionary .tsv file to try again.")
+        elif kind == "error":
+            self.label.config(text="Step 2: Drag a dictionary .tsv file here!")
+            messagebox.showerror("Error", f"Error reading dictionary file: {message[1]}")
+        else:
+            self.dictionary, self.flashcards, self.scheduler, self.known = message[1:5]
+            self.show_page(self.page)  # Highlight the tagged words in view
             if(DBUG):  print(self.dictionary)
-
-            
-            # Get 5 random tagged flashcards
-            self.flashcards = self.dictionary.getTaggedRand(5)
             if(DBUG):  print(self.flashcards)
 
-            if not self.flashcards:
+            if not self.flashcards.words:
                 messagebox.showwarning("No Data", "The dictionary file is empty or improperly formatted.")
             else:
                 self.flashcardIdx = 0
                 self.label.config(text="Flashcards are ready! Press 'Next' to start.")
-        except Exception as e:
-            messagebox.showerror("Error", f"Error reading dictionary file: {e}")
+
+    def cancel_tagging(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.label.config(text="Cancelling...")
 
     def display_flashcard(self):
         """Display the current flashcard."""
@@ -133,7 +310,7 @@ class FlashcardApp:
 
             # Remove any existing confidence buttons if they exist
             for widget in self.root.winfo_children():
-                if isinstance(widget, Button) and widget not in [self.button]:
+                if isinstance(widget, Button) and widget not in [self.button, self.cancel_button]:
                     widget.destroy()
 
             # Create 5 buttons for the user to rate their confidence (1 to 5)
@@ -146,6 +323,9 @@ class FlashcardApp:
         if self.flashcards.words:
             word = self.flashcards.words[self.flashcardIdx]
             word.confidence = confidence  # Save the confidence level
+            self.scheduler.review(word.id, confidence)
+            saveLearnedWords(AnkiDictionary(), self.known, self.historyFile, [word])  # Like the command line, reviewed words join the history
+            self.scheduler.saveToFile(self.historyFile + SCHEDULE_SUFFIX)
             
             # Move to the next flashcard
             self.next_flashcard()  # Go to the next flashcard
@@ -170,11 +350,14 @@ class FlashcardApp:
 
 
 
-# Create the main window
-root = TkinterDnD.Tk()
-root.title("Flashcard App")
-root.geometry("400x400")
+if __name__ == "__main__":
+    freeze_support()  # A frozen (PyInstaller) build must not open a window in each worker process
+
+    # Create the main window
+    root = TkinterDnD.Tk()
+    root.title("Flashcard App")
+    root.geometry("400x400")
 
-app = FlashcardApp(root)
+    app = FlashcardApp(root)
 
-root.mainloop()
+    root.mainloop()
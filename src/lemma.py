@@ -0,0 +1,161 @@
+import re
+
+DBUG = False
+LETTERS = re.compile(r"[^\W\d_]+")  # A token is a run of letters
+UMLAUTS = {"a": "ä", "o": "ö", "u": "ü", "A": "Ä", "O": "Ö", "U": "Ü"}
+
+# Suffix rules: each lemma expands to its likely surface forms once, when the index is built
+GERMAN_NOUN_ENDINGS = ("e", "en", "er", "ern", "n", "s", "es", "em")
+GERMAN_VERB_ENDINGS = ("e", "st", "t", "et", "en", "te", "test", "ten", "tet", "end")
+LATIN_A_ENDINGS = ("a", "ae", "am", "arum", "is", "as")  # terra
+LATIN_US_ENDINGS = ("us", "i", "o", "um", "orum", "is", "os", "e")  # amicus
+LATIN_UM_ENDINGS = ("um", "i", "o", "a", "orum", "is")  # vinum
+LATIN_THIRD_ENDINGS = ("is", "i", "em", "e", "es", "um", "ibus", "ium", "a")  # imperator, civitas
+LATIN_VERB_ENDINGS = {
+    "are": ("o", "as", "at", "amus", "atis", "ant", "abam", "abat", "abant", "avi", "avit", "atum", "ans", "antem"),
+    "ere": ("o", "eo", "es", "et", "emus", "etis", "ent", "it", "imus", "itis", "unt", "ebat", "ebant", "i", "it"),
+    "ire": ("io", "is", "it", "imus", "itis", "iunt", "iebat", "ivi", "ivit", "itum"),
+}
+
+def _umlauted(stem):
+    # Haus -> Häus, Apfel -> Äpfel: umlaut the last a/o/u (au -> äu)
+    for i in range(len(stem) - 1, -1, -1):
+        if stem[i] in UMLAUTS:
+            if stem[i] in "uU" and i and stem[i - 1] in "aA":
+                i -= 1
+            return stem[:i] + UMLAUTS[stem[i]] + stem[i + 1:]
+    return None
+
+def germanForms(lemma):
+    forms = {lemma}
+    forms.update(lemma + ending for ending in GERMAN_NOUN_ENDINGS)
+    umlauted = _umlauted(lemma)
+    if umlauted:
+        forms.update(umlauted + ending for ending in ("", "e", "er", "en", "ern"))
+    if lemma.endswith("en") or lemma.endswith("ern") or lemma.endswith("eln"):
+        stem = lemma[:-2] if lemma.endswith("en") else lemma[:-1]
+        forms.update(stem + ending for ending in GERMAN_VERB_ENDINGS)
+        forms.update(("ge" + stem + "t", "ge" + stem + "en", "ge" + lemma))
+        # Strong verbs change their stem vowel in the present: laufen -> läuft, sprechen -> spricht
+        vowelChanged = [_umlauted(stem)]
+        e = stem.rfind("e")
+        if e >= 0:
+            vowelChanged += [stem[:e] + "i" + stem[e + 1:], stem[:e] + "ie" + stem[e + 1:]]
+        for changed in filter(None, vowelChanged):
+            forms.update((changed + "st", changed + "t"))
+    forms.update((lemma + "st", lemma + "ste", lemma + "sten", lemma + "ster"))  # schnell -> schnellste
+    return forms
+
+def latinForms(lemma):
+    forms = {lemma}
+    for infinitive, endings in LATIN_VERB_ENDINGS.items():
+        if lemma.endswith(infinitive):
+            forms.update(lemma[:-3] + ending for ending in endings)
+            return forms
+    if lemma.endswith("a"):
+        forms.update(lemma[:-1] + ending for ending in LATIN_A_ENDINGS)
+    elif lemma.endswith("um"):
+        forms.update(lemma[:-2] + ending for ending in LATIN_UM_ENDINGS)
+    elif lemma.endswith("us"):
+        forms.update(lemma[:-2] + ending for ending in LATIN_US_ENDINGS)
+        forms.update(lemma[:-2] + "or" + ending for ending in LATIN_THIRD_ENDINGS)  # corpus -> corporis
+    elif lemma.endswith("as"):
+        forms.update(lemma[:-1] + "t" + ending for ending in LATIN_THIRD_ENDINGS)  # civitas -> civitatem
+    elif lemma.endswith("x"):
+        forms.update(lemma[:-1] + "c" + ending for ending in LATIN_THIRD_ENDINGS)  # pax -> pacis
+    elif lemma.endswith("is") or lemma.endswith("es"):
+        forms.update(lemma[:-2] + ending for ending in LATIN_THIRD_ENDINGS)  # navis -> navem
+    elif lemma.endswith("men"):
+        forms.update(lemma[:-2] + "in" + ending for ending in LATIN_THIRD_ENDINGS)  # lumen -> luminis
+    else:
+        forms.update(lemma + ending for ending in LATIN_THIRD_ENDINGS)  # imperator -> imperatorem
+    return forms
+
+INFLECTORS = {"de": germanForms, "la": latinForms}
+
+def loadLemmaTable(file_name):
+    # Bundled/local inflection table: one "surface<TAB>lemma" pair per line
+    table = {}
+    try:
+        with open(file_name, encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) >= 2 and parts[0] and parts[1]:
+                    table.setdefault(parts[0], []).append(parts[1])
+    except Exception as e:
+        if(DBUG):print(f"Error loading lemma table {file_name}: {e}")
+    return table
+
+class LemmaMatcher:
+    """Token counter for inflected languages, used in place of AnkiMatcher.
+
+    When it is built, every dictionary form is expanded through the language's
+    suffix rules (and an optional surface -> lemma table) into one hash map from
+    case-folded surface form to matcher slots. Counting then costs one lookup per
+    token of the text. A surface form that is itself a dictionary form only
+    counts for that form.
+    """
+
+    def __init__(self, patterns, language=None, table=None):
+        self.patterns = patterns  # Slot -> dictionary form, as in AnkiMatcher
+        exact = {}
+        for slot, pattern in enumerate(patterns):
+            if pattern:
+                exact.setdefault(pattern.casefold(), set()).add(slot)
+        generated = {}
+        inflect = INFLECTORS.get(language)
+        if inflect:
+            for slot, pattern in enumerate(patterns):
+                if pattern:
+                    for form in inflect(pattern.casefold()):
+                        generated.setdefault(form, set()).add(slot)
+        for surface, lemmas in (table or {}).items():
+            for lemma in lemmas:
+                generated.setdefault(surface.casefold(), set()).update(exact.get(lemma.casefold(), ()))
+        self.index = {surface: tuple(sorted(slots)) for surface, slots in generated.items() if slots and surface not in exact}
+        self.index.update((surface, tuple(sorted(slots))) for surface, slots in exact.items())
+
+    def newState(self, segment=False):
+        return LemmaState(len(self.patterns))
+
+    def _count(self, text, counts, final):
+        # Counts complete tokens; without final the token touching the end may continue
+        # in the next piece, so it is left unconsumed. Returns how much text was consumed.
+        index = self.index
+        for token in LETTERS.finditer(text):
+            if not final and token.end() == len(text):
+                return token.start()
+            for slot in index.get(token.group().casefold(), ()):
+                counts[slot] += 1
+        return len(text)
+
+    def feed(self, state, text):
+        state.pos += len(text)
+        text = state.pending + text
+        state.pending = text[self._count(text, state.counts, final=False):]
+        return state
+
+    def endText(self, state):
+        self._count(state.pending, state.counts, final=True)
+        state.pending = ""
+        return state
+
+    def finish(self, state):
+        counts = list(state.counts)
+        self._count(state.pending, counts, final=True)
+        return counts
+
+    def count(self, text, segment=False):
+        return self.finish(self.feed(self.newState(), text))
+
+    def __repr__(self):
+        return f"LemmaMatcher with {len(self.patterns)} patterns and {len(self.index)} surface forms"
+
+
+class LemmaState:
+    """Position of a LemmaMatcher scan; pending holds a token that may continue in the next piece."""
+
+    def __init__(self, size):
+        self.pos = 0
+        self.counts = [0] * size
+        self.pending = ""
@@ -0,0 +1,205 @@
+from collections import deque
+
+class AnkiMatcher:
+    """Aho-Corasick automaton over every simplified/traditional form of a dictionary.
+
+    One pass over the text counts all forms at once. Counts follow the same
+    rules as str.count: occurrences of a single form never overlap and are
+    taken greedily from the left, so the totals are identical to calling
+    text.count() once per form.
+    """
+
+    def __init__(self, patterns):
+        # patterns: list of strings, duplicates allowed. Each distinct string gets one slot.
+        self.patterns = []  # Distinct pattern strings, indexed by slot
+        self.slotOf = {}  # Pattern string -> slot
+        self.goto = [{}]  # Trie transitions per node
+        self.fail = [0]  # Failure link per node
+        self.out = [-1]  # Slot of the pattern ending exactly at this node, or -1
+        self.outLink = [0]  # Next node on the failure chain that ends a pattern (0 = none)
+        self.emptySlot = -1  # Slot of the empty pattern, counted like "".count
+
+        for pattern in patterns:
+            if pattern in self.slotOf:
+                continue
+            slot = len(self.patterns)
+            self.slotOf[pattern] = slot
+            self.patterns.append(pattern)
+            if pattern == "":
+                self.emptySlot = slot
+                continue
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(-1)
+                    self.outLink.append(0)
+                node = nxt
+            self.out[node] = slot
+
+        self.lengths = [len(p) for p in self.patterns]
+        self.maxLength = max(self.lengths, default=0)
+        self._buildLinks()
+
+    def _buildLinks(self):
+        # Breadth-first so every failure target is finished before it is used
+        goto, fail, out, outLink = self.goto, self.fail, self.out, self.outLink
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in goto[node].items():
+                queue.append(child)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(ch, 0)
+                outLink[child] = fail[child] if out[fail[child]] >= 0 else outLink[fail[child]]
+
+    def toParts(self):
+        # Plain lists and dicts only, so the automaton can be stored with marshal
+        return (self.patterns, self.goto, self.fail, self.out, self.outLink)
+
+    @classmethod
+    def fromParts(cls, parts):
+        matcher = cls.__new__(cls)
+        matcher.patterns, matcher.goto, matcher.fail, matcher.out, matcher.outLink = parts
+        matcher.slotOf = {pattern: slot for slot, pattern in enumerate(matcher.patterns)}
+        matcher.emptySlot = matcher.slotOf.get("", -1)
+        matcher.lengths = [len(p) for p in matcher.patterns]
+        matcher.maxLength = max(matcher.lengths, default=0)
+        return matcher
+
+    def newState(self, segment=False):
+        # segment=True counts tokens of a longest-match segmentation instead of substrings
+        return SegmentState(len(self.patterns)) if segment else MatchState(len(self.patterns))
+
+    def feed(self, state, text):
+        # Scan the next piece of a stream. Matches that cross piece boundaries are
+        # found because the automaton node and overlap bookkeeping live in state.
+        if isinstance(state, SegmentState):
+            return self._segmentFeed(state, text)
+        goto, fail, out, outLink, lengths = self.goto, self.fail, self.out, self.outLink, self.lengths
+        counts, nextFree = state.counts, state.nextFree
+        node = state.node
+        for pos, ch in enumerate(text, start=state.pos):
+            while True:
+                nxt = goto[node].get(ch)
+                if nxt is not None:
+                    node = nxt
+                    break
+                if not node:
+                    break
+                node = fail[node]
+            hit = node if out[node] >= 0 else outLink[node]
+            while hit:
+                slot = out[hit]
+                if pos - lengths[slot] + 1 >= nextFree[slot]:
+                    counts[slot] += 1
+                    nextFree[slot] = pos + 1
+                hit = outLink[hit]
+        state.node = node
+        state.pos += len(text)
+        return state
+
+    def matches(self, text):
+        # Every occurrence of every pattern as (start, end, slot), overlaps included,
+        # in order of end position; used to highlight words rather than to count them
+        goto, fail, out, outLink, lengths = self.goto, self.fail, self.out, self.outLink, self.lengths
+        node = 0
+        for pos, ch in enumerate(text):
+            while True:
+                nxt = goto[node].get(ch)
+                if nxt is not None:
+                    node = nxt
+                    break
+                if not node:
+                    break
+                node = fail[node]
+            hit = node if out[node] >= 0 else outLink[node]
+            while hit:
+                slot = out[hit]
+                yield pos - lengths[slot] + 1, pos + 1, slot
+                hit = outLink[hit]
+
+    def _segment(self, text, counts, final):
+        # Maximal munch over the trie: at each position take the longest dictionary form
+        # starting there and jump past it, otherwise skip one character. Without final,
+        # stops where a longer form could still continue into the next piece, and returns
+        # how many characters were consumed.
+        goto, out = self.goto, self.out
+        n = len(text)
+        limit = n if final else n - self.maxLength + 1
+        i = 0
+        while i < limit:
+            node, j, best, bestSlot = 0, i, i, -1
+            while j < n:
+                node = goto[node].get(text[j])
+                if node is None:
+                    break
+                j += 1
+                if out[node] >= 0:
+                    best, bestSlot = j, out[node]
+            if bestSlot >= 0:
+                counts[bestSlot] += 1
+                i = best
+            else:
+                i += 1
+        return i
+
+    def _segmentFeed(self, state, text):
+        state.pos += len(text)
+        text = state.pending + text
+        state.pending = text[self._segment(text, state.counts, final=False):]
+        return state
+
+    def endText(self, state):
+        # The text ends here: nothing may match across this point
+        if isinstance(state, SegmentState):
+            self._segment(state.pending, state.counts, final=True)
+            state.pending = ""
+        else:
+            state.node = 0
+        return state
+
+    def finish(self, state):
+        # Returns a list of occurrence counts indexed by slot, leaving state untouched
+        counts = list(state.counts)
+        if isinstance(state, SegmentState):
+            self._segment(state.pending, counts, final=True)
+        elif self.emptySlot >= 0:
+            counts[self.emptySlot] = state.pos + 1
+        return counts
+
+    def count(self, text, segment=False):
+        return self.finish(self.feed(self.newState(segment), text))
+
+    def countChunks(self, chunks, segment=False):
+        state = self.newState(segment)
+        for chunk in chunks:
+            self.feed(state, chunk)
+        return self.finish(state)
+
+    def __repr__(self):
+        return f"AnkiMatcher with {len(self.patterns)} patterns and {len(self.goto)} nodes"
+
+
+class MatchState:
+    """Position of an AnkiMatcher scan, so a stream can be fed in pieces."""
+
+    def __init__(self, size):
+        self.node = 0  # Current automaton node
+        self.pos = 0  # Characters consumed so far
+        self.counts = [0] * size  # Occurrences per slot
+        self.nextFree = [0] * size  # First position a new match of each slot may start at
+
+
+class SegmentState(MatchState):
+    """MatchState of a longest-match segmentation; pending holds text whose tokens are not yet decided."""
+
+    def __init__(self, size):
+        super().__init__(size)
+        self.pending = ""
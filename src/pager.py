@@ -0,0 +1,69 @@
+import os
+import codecs
+
+PAGE_BYTES = 1 << 13  # Bytes read per page; a page ends at the last line break that fits
+LINE_SEARCH_BYTES = 1 << 12  # How far a seek looks for the next line start
+
+class TextPager:
+    """Random access to pages of a UTF-8 text file, without reading the rest of it.
+
+    Pages are addressed by byte offset. page() reads at most pageBytes from an
+    offset, so opening or seeking in a book of any size costs one small read.
+    """
+
+    def __init__(self, file_name, pageBytes: int = PAGE_BYTES):
+        self.file_name = file_name
+        self.pageBytes = pageBytes
+        self.size = os.path.getsize(file_name)
+
+    def page(self, start: int, limit: int = None):
+        # Returns (text, start, end) of the page beginning at byte start and ending
+        # no later than limit (default: start + pageBytes)
+        cutAtLine = limit is None
+        limit = min(self.size, start + self.pageBytes if limit is None else limit)
+        with open(self.file_name, "rb") as f:
+            f.seek(start)
+            data = f.read(limit - start)
+        if cutAtLine and start + len(data) < self.size:
+            cut = data.rfind(b"\n")
+            if cut >= 0:
+                data = data[:cut + 1]
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        text = decoder.decode(data)
+        held = decoder.getstate()[0]  # A character cut in half at the end waits for the next page
+        return text, start, start + len(data) - len(held)
+
+    def next(self, end: int):
+        # Start of the page after the one ending at end, or None at the end of the file
+        return end if end < self.size else None
+
+    def previous(self, start: int):
+        # (text, start, end) of the page just before byte start, or None at the top of the file
+        if start <= 0:
+            return None
+        offset = self.align(max(0, start - self.pageBytes), start)
+        return self.page(offset, start)
+
+    def seek(self, fraction: float):
+        # Start of the page at fraction (0.0 - 1.0) of the file
+        return self.align(int(self.size * min(max(fraction, 0.0), 1.0)))
+
+    def align(self, offset: int, limit: int = None):
+        # Moves offset forward to the next line start, or at least to a character start,
+        # without passing limit
+        if offset <= 0:
+            return 0
+        limit = self.size if limit is None else limit
+        with open(self.file_name, "rb") as f:
+            f.seek(offset - 1)
+            data = f.read(min(LINE_SEARCH_BYTES, limit - offset + 1))
+        newline = data.find(b"\n")
+        if newline >= 0:
+            return offset + newline
+        skip = 1
+        while skip < len(data) and 0x80 <= data[skip] < 0xC0:  # UTF-8 continuation bytes
+            skip += 1
+        return min(offset + skip - 1, limit)
+
+    def __repr__(self):
+        return f"TextPager over {self.file_name} ({self.size} bytes)"
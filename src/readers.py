@@ -0,0 +1,160 @@
+import io
+import bz2
+import gzip
+import lzma
+import codecs
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote
+from html.parser import HTMLParser
+
+DEFAULT_ENCODING = "utf-8"
+MEMBER_BLOCK = 1 << 16  # Bytes read from an archive member at a time
+TEXT_MEMBER_SUFFIXES = (".txt",)  # Zip members holding the book's text, read in name order
+BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "blockquote", "pre", "title"}
+SKIPPED_TAGS = {"script", "style", "head"}
+
+class TextReader(io.TextIOWrapper):
+    """Text stream over a decompressed or extracted book, read like open(file_name, encoding=...).
+
+    source is the file on disk, so source.tell() is how far into it the
+    reading got, e.g. for a progress bar. Closing the reader closes it too.
+    """
+
+    def __init__(self, stream, source, encoding):
+        super().__init__(stream, encoding=encoding)
+        self.source = source
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.source.close()
+
+class _BlockStream(io.RawIOBase):
+    # Read-only byte stream over an iterator of byte blocks, for readers that produce text as they go
+    def __init__(self, blocks):
+        self._blocks = iter(blocks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            self._pending = next(self._blocks, None)
+            if self._pending is None:
+                self._pending = b""
+                return 0
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+def _zipBlocks(source):
+    # The text members of a zip one after the other, streamed out of the archive
+    with zipfile.ZipFile(source) as archive:
+        names = sorted(name for name in archive.namelist() if name.lower().endswith(TEXT_MEMBER_SUFFIXES))
+        for i, name in enumerate(names):
+            if i:
+                yield b"\n"
+            with archive.open(name) as member:
+                yield from iter(lambda: member.read(MEMBER_BLOCK), b"")
+
+class _XhtmlText(HTMLParser):
+    # Collects the readable text of (X)HTML fed to it, one line per block element
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+    def take(self):
+        text, self.parts = "".join(self.parts), []
+        return text
+
+def _epubSpine(archive):
+    # Paths of the book's documents in reading order, from the package file named in container.xml
+    container = ET.fromstring(archive.read("META-INF/container.xml"))
+    rootfile = next(e for e in container.iter() if e.tag.endswith("rootfile")).get("full-path")
+    package = ET.fromstring(archive.read(rootfile))
+    base = posixpath.dirname(rootfile)
+    manifest = {e.get("id"): e.get("href") for e in package.iter() if e.tag.endswith("}item") or e.tag == "item"}
+    spine = [e.get("idref") for e in package.iter() if e.tag.endswith("itemref")]
+    return [posixpath.normpath(posixpath.join(base, unquote(manifest[idref]))) for idref in spine if idref in manifest]
+
+def _epubBlocks(source):
+    # UTF-8 text of the spine documents, extracted from each member as it is decompressed
+    with zipfile.ZipFile(source) as archive:
+        for name in _epubSpine(archive):
+            parser = _XhtmlText()
+            decoder = codecs.getincrementaldecoder("utf-8")("replace")
+            with archive.open(name) as member:
+                for block in iter(lambda: member.read(MEMBER_BLOCK), b""):
+                    parser.feed(decoder.decode(block))
+                    yield parser.take().encode("utf-8")
+            parser.feed(decoder.decode(b"", final=True))
+            parser.close()
+            yield (parser.take() + "\n").encode("utf-8")
+
+# suffix -> (opener, encoding). An opener turns the file on disk into a stream of bytes; the encoding,
+# if given, is the one the opener produces (e.g. text extracted from XHTML) and replaces the requested one.
+READERS = {
+    ".gz": (lambda source: gzip.GzipFile(fileobj=source), None),
+    ".bz2": (lambda source: bz2.BZ2File(source), None),
+    ".xz": (lambda source: lzma.LZMAFile(source), None),
+    ".lzma": (lambda source: lzma.LZMAFile(source), None),
+    ".zip": (lambda source: io.BufferedReader(_BlockStream(_zipBlocks(source)), MEMBER_BLOCK), None),
+    ".epub": (lambda source: io.BufferedReader(_BlockStream(_epubBlocks(source)), MEMBER_BLOCK), DEFAULT_ENCODING),
+}
+
+def registerReader(suffix, opener, encoding=None):
+    # Adds or replaces the reader used for file names ending in suffix
+    READERS[suffix.lower()] = (opener, encoding)
+
+def readerFor(file_name):
+    # The (opener, encoding) registered for file_name, or None for a plain text file
+    lower = file_name.lower()
+    for suffix, reader in READERS.items():
+        if lower.endswith(suffix):
+            return reader
+    return None
+
+def isPlainText(file_name, encoding=DEFAULT_ENCODING):
+    # Plain UTF-8 files are the ones whose byte offsets are offsets into the text itself
+    return readerFor(file_name) is None and codecs.lookup(encoding).name == DEFAULT_ENCODING
+
+def openText(file_name, encoding=DEFAULT_ENCODING):
+    # Opens a book for reading as text, decompressing or extracting it on the fly. Nothing is
+    # written to disk and only the blocks being read are in memory. Decoding is incremental in
+    # any codec Python knows, e.g. gb18030 or big5 for Chinese sources.
+    reader = readerFor(file_name)
+    if reader is None:
+        return open(file_name, encoding=encoding)
+    opener, produced = reader
+    source = open(file_name, "rb")
+    try:
+        return TextReader(opener(source), source, produced or encoding)
+    except Exception:
+        source.close()
+        raise
+
+def bytesRead(f):
+    # How far into the file on disk a stream from openText got, e.g. for a progress bar
+    return f.source.tell() if isinstance(f, TextReader) else f.buffer.tell()
@@ -0,0 +1,80 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource  # Not available on Windows; peak memory is then left out
+except ImportError:
+    resource = None
+
+class RunStats:
+    """Wall time per stage and named counters of one run.
+
+    Attach an instance to a dictionary (dictionary.stats = RunStats()) to have
+    its loads, scans and history merges counted; with stats left at None the
+    dictionary only pays one attribute check per call.
+    """
+
+    def __init__(self):
+        self.stages = {}  # Stage name -> seconds, in the order the stages first ran
+        self.counters = {}  # Counter name -> value
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def add(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def prefixed(self, prefix):
+        # The same stats, with counter names prefixed, e.g. for the history dictionary
+        return PrefixedStats(self, prefix)
+
+    def peakMemory(self):
+        # Peak resident set size of this process in bytes, or None where it cannot be read
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # ru_maxrss is in bytes on macOS, KB elsewhere
+
+    def toDict(self):
+        return {"stages": {name: round(seconds, 6) for name, seconds in self.stages.items()},
+                "total_seconds": round(sum(self.stages.values()), 6),
+                "counters": dict(self.counters),
+                "peak_memory_bytes": self.peakMemory()}
+
+    def toJson(self):
+        return json.dumps(self.toDict(), indent=2)
+
+    def toTable(self):
+        report = self.toDict()
+        rows = [(name, f"{seconds:.3f} s") for name, seconds in report["stages"].items()]
+        rows.append(("total", f"{report['total_seconds']:.3f} s"))
+        rows.append(("", ""))
+        rows += [(name, f"{value:,}") for name, value in report["counters"].items()]
+        if report["peak_memory_bytes"] is not None:
+            rows.append(("peak memory", f"{report['peak_memory_bytes'] / (1 << 20):.1f} MB"))
+        width = max(len(name) for name, _ in rows)
+        return "\n".join(f"{name:<{width}}  {value:>14}" if name else "" for name, value in rows)
+
+    def __repr__(self):
+        return f"RunStats with {len(self.stages)} stages and {len(self.counters)} counters"
+
+
+class PrefixedStats:
+    """View of a RunStats that prefixes the counter names it adds."""
+
+    def __init__(self, stats, prefix):
+        self.stats = stats
+        self.prefix = prefix
+
+    def stage(self, name):
+        return self.stats.stage(name)
+
+    def add(self, name, amount=1):
+        self.stats.add(self.prefix + name, amount)
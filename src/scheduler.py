@@ -0,0 +1,148 @@
+import heapq
+import os
+import time
+
+from atomicfile import atomicWrite
+
+DBUG = False
+DAY = 86400.0  # Seconds per interval day
+MIN_EASE = 1.3  # SM-2 lower bound of the ease factor
+START_EASE = 2.5
+PASS_RATING = 3  # Ratings below this (on the 1-5 confidence scale) restart the word's intervals
+SCHEDULE_SUFFIX = ".schedule"  # Review schedule of a history, written next to the history TSV
+SCHEDULE_HEADER = "id\tdue\tinterval\tease\treps\n"
+SCHEDULE_MIN_ROWS = 1000  # Reviews are appended to the schedule file until it holds more rows than this
+SCHEDULE_COMPACT_RATIO = 2  # ... and more than this many rows per scheduled word; then it is rewritten
+
+class ReviewState:
+    """SM-2 schedule of one word: when it is due (epoch seconds), its interval in days, ease and streak."""
+
+    __slots__ = ("due", "interval", "ease", "reps")
+
+    def __init__(self, due=0.0, interval=0.0, ease=START_EASE, reps=0):
+        self.due = due
+        self.interval = interval
+        self.ease = ease
+        self.reps = reps
+
+class Scheduler:
+    """Spaced-repetition schedule of words by id, updated SM-2 style from 1-5 confidence ratings.
+
+    A heap of (due, id) is kept alongside the per-word states, so the earliest
+    due cards are popped in O(log n) each instead of sorting or shuffling every
+    candidate. Heap entries left behind by a later review are skipped lazily.
+    Saving appends the words reviewed since the file was read; a later row for
+    an id replaces the earlier ones, and the file is rewritten once it grows large.
+    """
+
+    def __init__(self):
+        self.states = {}  # id -> ReviewState
+        self._heap = []  # (due, id), possibly with stale entries
+        self._reviewed = set()  # Ids reviewed since the last load or save
+        self._file = None  # Schedule file the states were read from or saved to, and its rows
+        self._rows = 0
+
+    def __contains__(self, id):
+        return id in self.states
+
+    def __len__(self):
+        return len(self.states)
+
+    def review(self, id, rating: int, now: float = None):
+        # Applies one rating (1 = forgotten ... 5 = perfect) and schedules the next review
+        now = time.time() if now is None else now
+        state = self.states.get(id) or ReviewState()
+        quality = min(max(int(rating), 1), 5)
+        if quality < PASS_RATING:
+            state.reps = 0
+            state.interval = 1.0
+        else:
+            state.reps += 1
+            if state.reps == 1:
+                state.interval = 1.0
+            elif state.reps == 2:
+                state.interval = 6.0
+            else:
+                state.interval = round(state.interval * state.ease)
+        state.ease = max(MIN_EASE, state.ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+        state.due = now + state.interval * DAY
+        self.states[id] = state
+        self._reviewed.add(id)
+        heapq.heappush(self._heap, (state.due, id))
+        return state
+
+    def due(self, numCards: int, accept=None, now: float = None):
+        # Ids of up to numCards words due by now, earliest first. accept(id) can reject
+        # words (e.g. not tagged in this text); rejected words stay scheduled.
+        now = time.time() if now is None else now
+        heap, states = self._heap, self.states
+        picked, popped = [], []
+        while heap and len(picked) < numCards and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            state = states.get(entry[1])
+            if state is None or state.due != entry[0]:
+                continue  # Superseded by a later review
+            popped.append(entry)
+            if accept is None or accept(entry[1]):
+                picked.append(entry[1])
+        for entry in popped:
+            heapq.heappush(heap, entry)  # Still due until they are reviewed
+        return picked
+
+    def loadFromFile(self, file_name):
+        self._file, self._rows = file_name, 0
+        try:
+            with open(file_name, "r", encoding="utf-8") as file:
+                for line_num, line in enumerate(file, start=1):
+                    if line_num == 1: continue  # Skip header
+                    self._rows += 1
+                    if not line.endswith("\n"):
+                        self._file = None  # Torn last row from a crash: rewrite instead of appending to it
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) != 5:
+                        continue
+                    try:
+                        self.states[parts[0]] = ReviewState(float(parts[1]), float(parts[2]), float(parts[3]), int(parts[4]))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            if(DBUG):print(f"Error loading schedule {file_name}: {e}")
+        self._heap = [(state.due, id) for id, state in self.states.items()]
+        heapq.heapify(self._heap)
+
+    def saveToFile(self, file_name):
+        # Appends the words reviewed since the file was read, in time proportional to them.
+        # A new or grown file is rewritten atomically like the history TSV: written to a
+        # temporary file and renamed over file_name.
+        rows = self._rows + len(self._reviewed)
+        if self._file == file_name and os.path.exists(file_name) and rows <= max(SCHEDULE_MIN_ROWS, SCHEDULE_COMPACT_RATIO * len(self.states)):
+            try:
+                with open(file_name, "a", encoding="utf-8") as file:
+                    for id in self._reviewed:
+                        file.write(_stateLine(id, self.states[id]))
+                    file.flush()
+                    os.fsync(file.fileno())
+            except Exception as e:
+                if(DBUG):print(f"Error appending to schedule {file_name}: {e}")
+                return False
+        else:
+            try:
+                with atomicWrite(file_name, "w", encoding="utf-8") as file:
+                    file.write(SCHEDULE_HEADER)
+                    for id, state in self.states.items():
+                        file.write(_stateLine(id, state))
+            except Exception as e:
+                if(DBUG):print(f"Error saving schedule {file_name}: {e}")
+                return False
+            rows = len(self.states)
+        self._file, self._rows = file_name, rows
+        self._reviewed.clear()
+        return True
+
+    def __repr__(self):
+        return f"Scheduler with {len(self.states)} scheduled words"
+
+def _stateLine(id, state):
+    return f"{id}\t{state.due:.0f}\t{state.interval:g}\t{state.ease:.3f}\t{state.reps}\n"
@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))) # Add the source directory to the Python path
+from anki import (AnkiDictionary, CompactAnkiDictionary, KnownWordIndex, MAXX_CONF, MINN_CONF, SNAPSHOT_SUFFIX, TSV_HEADER, CHUNK_SIZE,
+                  JOURNAL_SUFFIX, KNOWN_SUFFIX)
+
+ASSETS = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'assets'))
+ASSET_PAIRS = [("chineseDictionary.tsv", "chineseText1.txt"), ("germanDictionary.tsv", "germanText.txt"),
+               ("latinDictionary.tsv", "latinText.txt")]
+BACKENDS = {"list": AnkiDictionary, "compact": CompactAnkiDictionary}
+CJK_FIRST, CJK_LAST = 0x4E00, 0x9FFF  # Synthetic words are drawn from the CJK Unified Ideographs block
+FILLER = "，。的了是在我有他这"  # Corpus text between dictionary words
+CORPUS_BLOCK = 1 << 20  # Characters per generated corpus block; blocks are reused to reach large sizes
+CORPUS_BLOCKS = 8
+HISTORY_FRACTION = 0.2  # Share of the dictionary already in the history
+CARDS = 20
+
+def parseSize(text):
+    # "100K", "10M", "1G" or a plain number
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def parseCount(text):
+    # "1k", "100k", "1m" or a plain number
+    units = {"K": 1000, "M": 1000000}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def synthWords(entries, rng):
+    # Distinct words of one to four characters, a third of them with a traditional variant
+    words, seen = [], set()
+    while len(words) < entries:
+        word = "".join(chr(rng.randint(CJK_FIRST, CJK_LAST)) for _ in range(rng.choice((1, 2, 2, 3, 4))))
+        if word in seen:
+            continue
+        seen.add(word)
+        traditional = ""
+        if rng.random() < 0.33:
+            traditional = word[:-1] + chr(rng.randint(CJK_FIRST, CJK_LAST))
+        words.append((word, traditional))
+    return words
+
+def writeDictionary(path, words, rng, confidence=False):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(TSV_HEADER)
+        for i, (simplified, traditional) in enumerate(words):
+            conf = rng.randint(MINN_CONF, MAXX_CONF) if confidence else MINN_CONF
+            f.write(f"{i:07d}\t{simplified}\t{traditional}\tpin{i % 5}\tmeaning {i}\ttranslation {i}\t\t\tFalse\t{conf}\n")
+
+def writeCorpus(path, words, size, rng):
+    # Blocks of dictionary words (Zipf-like: early words are far more frequent) and filler,
+    # repeated until the file holds size bytes
+    weights = [1.0 / (rank + 1) for rank in range(len(words))]
+    blocks = []
+    for _ in range(min(CORPUS_BLOCKS, max(1, size // CORPUS_BLOCK))):
+        picks = rng.choices(words, weights, k=CORPUS_BLOCK // 4)
+        blocks.append("".join(simplified + rng.choice(FILLER) for simplified, _ in picks).encode("utf-8"))
+    written = 0
+    with open(path, "wb") as f:
+        while written < size:
+            block = blocks[(written // len(blocks[0])) % len(blocks)][:size - written]
+            if len(block) < len(blocks[0]):
+                block = block.decode("utf-8", "ignore").encode("utf-8")  # Never end inside a character
+                if not block:
+                    break
+            f.write(block)
+            written += len(block)
+
+def cached(workdir, name, build):
+    # Generated inputs are kept in workdir and reused by later runs with the same parameters
+    path = os.path.join(workdir, name)
+    if not os.path.exists(path):
+        build(path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return path
+
+def timed(timings, name, repeat, run, setup=None):
+    # Best of repeat runs; setup (untimed) returns the argument passed to run
+    best, result = None, None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        result = run(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    timings[name] = round(best, 6)
+    return result
+
+def benchPipeline(backend, dictionaryFile, corpusFiles, historyFile, outputDir, repeat):
+    # Times each step of anki_parse on one dictionary; returns {step name: seconds}
+    cls = BACKENDS[backend]
+    timings = {}
+
+    def freshLoad(_):
+        d = cls()
+        d.loadFromFile(dictionaryFile)
+        return d
+
+    def snapshotLoad(_):
+        d = cls()
+        d.loadFromFile(dictionaryFile, snapshot=True)
+        return d
+
+    def dropSnapshot():
+        if os.path.exists(dictionaryFile + SNAPSHOT_SUFFIX):
+            os.remove(dictionaryFile + SNAPSHOT_SUFFIX)
+
+    dictionary = timed(timings, "loadFromFile", repeat, freshLoad)
+    timed(timings, "loadFromFile_snapshot_cold", 1, snapshotLoad, dropSnapshot)
+    timed(timings, "loadFromFile_snapshot_warm", repeat, snapshotLoad)
+    timed(timings, "getMatcher", 1, lambda _: dictionary.getMatcher())
+    for corpusName, corpusFile in corpusFiles:
+        timed(timings, f"tagFromFile[{corpusName}]", repeat,
+              lambda _: dictionary.tagFromFile(corpusFile, 1, CHUNK_SIZE), dictionary.clearTags)
+
+    history = cls()
+    timed(timings, "loadFromFile_history", repeat, lambda h: h.loadFromFile(historyFile), lambda: cls())
+    history.loadFromFile(historyFile)
+    tags = [word.tag for word in dictionary.words]
+
+    def restoreTags():
+        for word, tag in zip(dictionary.words, tags):
+            word.tag = tag
+
+    timed(timings, "tagsAndNotConfident", repeat, lambda _: dictionary.tagsAndNotConfident(history, MAXX_CONF), restoreTags)
+    tagged = dictionary.getTagged()
+    timings["tagged_words"] = len(tagged)
+
+    def historyCopy():
+        h = cls()
+        h.loadFromFile(historyFile)
+        return h
+
+    timed(timings, "addNewWords", repeat, lambda h: h.addNewWords(tagged), historyCopy)
+
+    # Saving a session's reviewed cards, as anki_parse does through the history's known-word index
+    sessionFile = os.path.join(outputDir, f"history_{backend}.tsv")
+
+    def sessionIndex():
+        shutil.copyfile(historyFile, sessionFile)
+        for suffix in (JOURNAL_SUFFIX, KNOWN_SUFFIX):
+            if os.path.exists(sessionFile + suffix):
+                os.remove(sessionFile + suffix)
+        return KnownWordIndex.load(sessionFile)
+
+    timed(timings, "saveHistory", repeat, lambda index: index.appendJournaled(sessionFile, tagged[:CARDS]), sessionIndex)
+    for suffix in ("", JOURNAL_SUFFIX, KNOWN_SUFFIX):
+        os.remove(sessionFile + suffix)
+    timed(timings, "getTaggedRand", repeat, lambda _: dictionary.getTaggedRand(CARDS))
+    outputFile = os.path.join(outputDir, f"tagged_{backend}.tsv")
+    timed(timings, "saveTrueToFile", repeat, lambda _: dictionary.saveTrueToFile(outputFile))
+    os.remove(outputFile)
+    return timings
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def runBenchmarks(args):
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), "anki-benchmark")
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+
+    for entries in map(parseCount, args.dict_sizes.split(",")):
+        rng = random.Random(f"{args.seed}:{entries}")
+        words = synthWords(entries, rng)
+        dictionaryFile = cached(workdir, f"dict_{entries}_{args.seed}.tsv", lambda p: writeDictionary(p, words, rng))
+        historyWords = words[:int(entries * HISTORY_FRACTION)]
+        historyFile = cached(workdir, f"history_{entries}_{args.seed}.tsv", lambda p: writeDictionary(p, historyWords, rng, confidence=True))
+        corpusFiles = []
+        for size in map(parseSize, args.corpus_sizes.split(",")):
+            corpusFiles.append((f"{size}B", cached(workdir, f"corpus_{entries}_{size}_{args.seed}.txt",
+                                                  lambda p: writeCorpus(p, words, size, rng))))
+        for backend in args.backends.split(","):
+            print(f"synthetic: {entries} entries, {backend}", file=sys.stderr)
+            results.append({"case": "synthetic", "backend": backend, "dictionary_entries": entries,
+                            "corpus_bytes": [os.path.getsize(path) for _, path in corpusFiles],
+                            "timings": benchPipeline(backend, dictionaryFile, corpusFiles, historyFile, workdir, args.repeat)})
+
+    if not args.skip_assets:
+        historyFile = os.path.join(ASSETS, "ankihistory.tsv")
+        for dictionaryName, textName in ASSET_PAIRS:
+            # Snapshots are written to the working directory, not next to the bundled assets
+            dictionaryFile = os.path.join(workdir, dictionaryName)
+            with open(os.path.join(ASSETS, dictionaryName), "rb") as src, open(dictionaryFile, "wb") as dst:
+                dst.write(src.read())
+            for backend in args.backends.split(","):
+                print(f"assets: {dictionaryName}, {backend}", file=sys.stderr)
+                results.append({"case": f"assets/{dictionaryName}", "backend": backend,
+                                "timings": benchPipeline(backend, dictionaryFile, [(textName, os.path.join(ASSETS, textName))],
+                                                         historyFile, workdir, args.repeat)})
+
+    return {"commit": gitCommit(), "python": platform.python_version(), "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "repeat": args.repeat, "seed": args.seed, "results": results}
+
+def compareReports(baseline, current, tolerance):
+    # Prints current/baseline ratios for matching (case, backend, entries, step); returns the regressions
+    def index(report):
+        return {(r["case"], r["backend"], r.get("dictionary_entries"), step): seconds
+                for r in report["results"] for step, seconds in r["timings"].items() if isinstance(seconds, float)}
+
+    old, new = index(baseline), index(current)
+    regressions = []
+    for key in sorted(new.keys() & old.keys(), key=str):
+        ratio = new[key] / old[key] if old[key] else float("inf")
+        flag = ""
+        if ratio > tolerance and new[key] - old[key] > 0.001:  # Ignore noise on sub-millisecond steps
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{'/'.join(str(k) for k in key if k is not None):70s} {old[key]:10.4f}s -> {new[key]:10.4f}s  x{ratio:.2f}{flag}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the dictionary loading, tagging and history steps on synthetic and bundled data.")
+    parser.add_argument("--dict-sizes", default="1k,10k,100k", help="Comma separated dictionary sizes, e.g. 1k,100k,1m (default: 1k,10k,100k)")
+    parser.add_argument("--corpus-sizes", default="100K,10M", help="Comma separated corpus sizes in bytes, e.g. 100K,10M,1G (default: 100K,10M)")
+    parser.add_argument("--backends", default="list,compact", help=f"Comma separated dictionary classes: {', '.join(BACKENDS)} (default: list,compact)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per step; the fastest is reported (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data (default: 0)")
+    parser.add_argument("--workdir", default=None, help="Where generated data is kept between runs (default: a directory in the system temp dir)")
+    parser.add_argument("--skip-assets", action="store_true", help="Do not benchmark the files in assets/")
+    parser.add_argument("--output", "-o", default=None, help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", default=None, help="JSON report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="Slowdown ratio reported as a regression by --compare (default: 1.2)")
+    args = parser.parse_args()
+
+    report = runBenchmarks(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compareReports(json.load(f), report, args.tolerance)
+        sys.exit(1 if regressions else 0)
@@ -2,10 +2,29 @@ import unittest
 from unittest.mock import patch, mock_open
 import sys
 import os
+import tempfile
 from io import StringIO
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))) # Add the root directory to the Python path
-from anki import AnkiWord, AnkiDictionary, anki_parse
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))) # Add the source directory to the Python path
+from anki import AnkiWord, AnkiDictionary, CompactAnkiDictionary, SqliteAnkiDictionary, KnownWordIndex, anki_parse, saveLearnedWords, KNOWN_CONFIDENCE, MINN_CONF, THRESHOLD_FILE, THRESHOLD_CORPUS, COUNT_SEGMENT, COUNT_LEMMA
+from matcher import AnkiMatcher
+from countcache import CountCache
+from lemma import LemmaMatcher
+from runstats import RunStats
+from pager import TextPager
+from scheduler import Scheduler, DAY
+from daemon import AnkiService, makeServer
+from client import AnkiClient, AnkiClientError
+from batch import loadManifest, runBatch, ManifestError
+from readers import openText
+from coverage import ChapterCoverage, runCoverage, KNOWN, LEARNING, UNKNOWN
+import gzip, bz2, lzma, zipfile
+import json
+import threading
+import urllib.request, urllib.error
+
+ASSETS = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'assets'))
 
 class TestAnkiDictionary(unittest.TestCase):
 
@@ -70,6 +89,24 @@ class TestAnkiDictionary(unittest.TestCase):
         found = self.d.wordFromId("001")
         self.assertEqual(found, self.w1)
 
+    def test_addNewWords_keeps_indexes(self):
+        # Replacing a word by id moves its forms in the form index
+        replacement = AnkiWord("001", "您", "", "nín", "", "", "", "", False)
+        self.d.addNewWords([replacement, AnkiWord("003", "是", "", "", "", "", "", "", False)])
+        self.assertEqual(len(self.d.words), 3)
+        self.assertIs(self.d.wordFromId("001"), replacement)
+        self.assertFalse(self.d.hasForm("你"))
+        self.assertFalse(self.d.hasForm("妳"))
+        self.assertEqual(self.d.wordsFromForm("您"), [replacement])
+        self.assertEqual(self.d.wordFromId("003").simplified, "是")
+
+    def test_tagsOr_does_not_duplicate(self):
+        history = AnkiDictionary()
+        self.w1.tag = True
+        self.d.tagsOr(history)
+        self.d.tagsOr(history)
+        self.assertEqual(history.words, [self.w1])
+
     def test_loadFromFile_and_saveAllToFile(self):
         # Test loading from and saving to a file
         self.d.saveAllToFile("test_output.tsv")
@@ -87,6 +124,1117 @@ class TestAnkiDictionary(unittest.TestCase):
             self.assertNotIn("好", contents)
 
 
+class TestAnkiMatcher(unittest.TestCase):
+
+    def naiveCounts(self, dictionary, text):
+        # The original str.count path of tagFromFile
+        counts = []
+        for word in dictionary.words:
+            total = text.count(word.simplified)
+            if word.traditional != "":
+                total += text.count(word.traditional)
+            counts.append(total)
+        return counts
+
+    def test_overlapping_forms(self):
+        # Repeated and nested forms are counted like str.count (no overlaps within a form)
+        matcher = AnkiMatcher(["哈哈", "哈", "aa", "aaa", "ab", "b", ""])
+        text = "哈哈哈哈哈 aaaaab"
+        self.assertEqual(matcher.count(text), [text.count(p) for p in matcher.patterns])
+
+    def test_matches_str_count_on_assets(self):
+        # Every asset dictionary against every asset text, plus all texts joined
+        texts = {}
+        for name in os.listdir(ASSETS):
+            if name.endswith(".txt"):
+                with open(os.path.join(ASSETS, name), encoding="utf-8") as f:
+                    texts[name] = f.read()
+        texts["all"] = "\n".join(texts.values())
+        for dictName in ["chineseDictionary.tsv", "germanDictionary.tsv", "latinDictionary.tsv"]:
+            d = AnkiDictionary()
+            d.loadFromFile(os.path.join(ASSETS, dictName))
+            for name, text in texts.items():
+                self.assertEqual(d.countFromText(text), self.naiveCounts(d, text), f"{dictName} on {name}")
+
+    def test_tagging_matches_str_count(self):
+        d = AnkiDictionary()
+        d.loadFromFile(os.path.join(ASSETS, "chineseDictionary.tsv"))
+        text = "".join(w.simplified + w.traditional for w in d.words[::7]) * 2
+        expected = self.naiveCounts(d, text)
+        with patch("builtins.open", mock_open(read_data=text)):
+            d.tagFromFile("temp.txt", requiredCount=3)
+        self.assertEqual([w.tag for w in d.words], [c >= 3 for c in expected])
+
+    def test_matcher_rebuilt_when_words_change(self):
+        d = AnkiDictionary()
+        d.words = [AnkiWord("001", "你", "妳", "", "", "", "", "", False)]
+        self.assertEqual(d.countFromText("你好妳"), [2])
+        d.addWord(AnkiWord("002", "好", "", "", "", "", "", "", False))
+        self.assertEqual(d.countFromText("你好妳"), [2, 1])
+
+    def test_chunked_file_matches_whole_text(self):
+        # Matches spanning chunk boundaries are neither lost nor counted twice
+        d = AnkiDictionary()
+        d.loadFromFile(os.path.join(ASSETS, "chineseDictionary.tsv"))
+        with open(os.path.join(ASSETS, "chineseText3.txt"), encoding="utf-8") as f:
+            text = f.read() * 3
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "book.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            expected = self.naiveCounts(d, text)
+            for chunkSize in [1, 2, 3, 7, 64, len(text) + 1]:
+                self.assertEqual(d.countFromFile(path, chunkSize), expected, f"chunkSize={chunkSize}")
+
+
+class TestTagFromFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = []
+        for i, text in enumerate(["你好", "你好", "你"]):
+            path = os.path.join(self.tmp.name, f"chapter{i}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            self.files.append(path)
+        self.d = AnkiDictionary()
+        self.d.words = [AnkiWord("001", "你", "妳", "", "", "", "", "", False),
+                        AnkiWord("002", "好", "", "", "", "", "", "", False)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_per_file_threshold(self):
+        # No single file holds 好 twice, but 你 appears 3 times only across files
+        self.d.tagFromFiles(self.files, 2, thresholdScope=THRESHOLD_FILE)
+        self.assertEqual([w.tag for w in self.d.words], [False, False])
+
+    def test_corpus_threshold(self):
+        self.d.tagFromFiles(self.files, 3, thresholdScope=THRESHOLD_CORPUS)
+        self.assertEqual([w.tag for w in self.d.words], [True, False])
+
+    def test_parallel_counts_match_serial(self):
+        serial = self.d.countFromFiles(self.files, workers=1)
+        parallel = self.d.countFromFiles(self.files, workers=2)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial, [[1, 1], [1, 1], [1, 0]])
+
+    def test_warm_cache_skips_scanning(self):
+        cache = CountCache(os.path.join(self.tmp.name, "cache"))
+        cold = self.d.countFromFiles(self.files, cache=cache)
+        with patch.object(AnkiDictionary, "countFromFile", side_effect=AssertionError("scanned")):
+            warm = self.d.countFromFiles(self.files, cache=cache)
+        self.assertEqual(cold, warm)
+
+    def test_cache_invalidated_by_edits(self):
+        cache = CountCache(os.path.join(self.tmp.name, "cache"))
+        self.d.countFromFiles(self.files, cache=cache)
+        with open(self.files[2], "a", encoding="utf-8") as f:
+            f.write("好好")
+        self.assertEqual(self.d.countFromFiles(self.files, cache=cache)[2], [1, 2])
+        self.d.words[1].simplified = "你"  # A different dictionary version
+        self.assertEqual(self.d.countFromFiles(self.files, cache=cache)[2], [1, 1])
+
+    def test_grown_file_scans_only_new_text(self):
+        cache = CountCache(os.path.join(self.tmp.name, "cache"))
+        d = AnkiDictionary()
+        d.words = [AnkiWord("001", "你好", "", "", "", "", "", "", False),
+                   AnkiWord("002", "好", "", "", "", "", "", "", False)]
+        book = os.path.join(self.tmp.name, "book.txt")
+        with open(book, "w", encoding="utf-8") as f:
+            f.write("第一章 你好。你")
+        self.assertEqual(d.countFromFile(book, cache=cache), [1, 1])
+        with open(book, "a", encoding="utf-8") as f:
+            f.write("好\r\n第二章 好")  # Completes a match across the old end of the file
+        fed = []
+        feed = AnkiMatcher.feed
+        with patch.object(AnkiMatcher, "feed", lambda m, state, text: fed.append(text) or feed(m, state, text)):
+            grown = d.countFromFile(book, chunkSize=4, cache=cache)
+        self.assertEqual("".join(fed), "好\n第二章 好")
+        self.assertEqual(grown, d.countFromFile(book))
+        self.assertEqual(grown, [2, 3])
+        for mode in (COUNT_SEGMENT, COUNT_LEMMA):
+            d.countMode = mode
+            self.assertEqual(d.countFromFile(book, chunkSize=3, cache=cache), d.countFromFile(book), mode)
+
+    def test_edited_prefix_rescans(self):
+        cache = CountCache(os.path.join(self.tmp.name, "cache"))
+        self.d.countFromFile(self.files[0], cache=cache)
+        with open(self.files[0], "w", encoding="utf-8") as f:
+            f.write("好好你")
+        self.assertEqual(self.d.countFromFile(self.files[0], cache=cache), [1, 2])
+
+    def test_cache_eviction(self):
+        cache = CountCache(os.path.join(self.tmp.name, "cache"), maxBytes=0)
+        self.d.countFromFiles(self.files, cache=cache)
+        self.assertEqual(os.listdir(cache.directory), [])
+
+
+class TestCompactAnkiDictionary(unittest.TestCase):
+
+    def setUp(self):
+        self.plain = AnkiDictionary()
+        self.plain.loadFromFile(os.path.join(ASSETS, "chineseDictionary.tsv"))
+        self.compact = CompactAnkiDictionary()
+        self.compact.loadFromFile(os.path.join(ASSETS, "chineseDictionary.tsv"))
+        self.history = AnkiDictionary()
+        self.history.words = [AnkiWord(w.id, w.simplified, w.traditional, "", "", "", "", "", True, 5) for w in self.plain.words[::5]]
+        for i, word in enumerate(self.plain.words):
+            word.confidence = i % 5 + 1
+            self.compact.words[i].confidence = i % 5 + 1
+
+    def tagged(self, d):
+        return [w.id for w in d.getTagged()]
+
+    def test_bulk_tag_operations_match_plain(self):
+        counts = [i % 4 for i in range(len(self.plain.words))]
+        for d in (self.plain, self.compact):
+            d.clearTags()
+            d.tagFromCounts(counts, 2)
+        self.assertEqual(self.tagged(self.plain), self.tagged(self.compact))
+        for d in (self.plain, self.compact):
+            d.tagsAndNotConfident(self.history, 3)
+        self.assertEqual(self.tagged(self.plain), self.tagged(self.compact))
+        for d in (self.plain, self.compact):
+            d.tagsAndNot(self.history)
+        self.assertEqual(self.tagged(self.plain), self.tagged(self.compact))
+
+    def test_views_write_through(self):
+        view = self.compact.words[3]
+        view.tag = True
+        view.confidence = 9
+        view.meaning = "changed"
+        self.assertTrue(self.compact.words[3].tag)
+        self.assertEqual(self.compact.words[3].confidence, 5)
+        self.assertEqual(self.compact.words[3].meaning, "changed")
+        self.assertIsInstance(view, AnkiWord)
+
+    def test_getTaggedRand_and_history_merge(self):
+        self.compact.clearTags()
+        self.compact.tagFromCounts([1] * len(self.compact.words), 1)
+        cards = self.compact.getTaggedRand(5)
+        self.assertEqual(len(cards.words), 5)
+        self.assertEqual(len({w.id for w in cards.words}), 5)
+        history = AnkiDictionary()
+        history.addNewWords(cards.words)
+        self.assertEqual({w.id for w in history.words}, {w.id for w in cards.words})
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.tsv = os.path.join(self.tmp.name, "deck.tsv")
+        with open(os.path.join(ASSETS, "germanDictionary.tsv"), encoding="utf-8") as src, open(self.tsv, "w", encoding="utf-8") as dst:
+            dst.write(src.read())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def load(self, cls=AnkiDictionary):
+        d = cls()
+        d.loadFromFile(self.tsv, snapshot=True)
+        return d
+
+    def rows(self, d):
+        return [(w.id, w.simplified, w.traditional, w.pronunciation, w.meaning, w.translation, w.extra1, w.extra2, w.tag, w.confidence) for w in d.words]
+
+    def test_snapshot_reused_when_tsv_unchanged(self):
+        parsed = self.load()
+        self.assertTrue(os.path.exists(self.tsv + ".snap"))
+        for cls in (AnkiDictionary, CompactAnkiDictionary):
+            with patch.object(AnkiDictionary, "saveSnapshot", side_effect=AssertionError("parsed again")):
+                loaded = self.load(cls)
+            self.assertEqual(self.rows(loaded), self.rows(parsed))
+            with patch("anki.AnkiMatcher.__init__", side_effect=AssertionError("matcher rebuilt")):
+                self.assertEqual(loaded.countFromText("Haus Apfel Haus"), parsed.countFromText("Haus Apfel Haus"))
+            self.assertEqual(loaded.wordFromId("2").simplified, "Haus")
+
+    def test_snapshot_checks_contents_only_when_tsv_touched(self):
+        parsed = self.load()
+        unhashed = patch("anki.fileDigest", side_effect=AssertionError("hashed"))
+        reused = patch.object(AnkiDictionary, "saveSnapshot", side_effect=AssertionError("parsed again"))
+        with unhashed, reused:
+            self.assertEqual(self.rows(self.load(CompactAnkiDictionary)), self.rows(parsed))
+        stat = os.stat(self.tsv)
+        os.utime(self.tsv, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        with reused:
+            self.assertEqual(self.rows(self.load()), self.rows(parsed))
+        with unhashed, reused:
+            self.assertEqual(self.rows(self.load()), self.rows(parsed))  # Restamped with the new mtime
+
+    def test_snapshot_rebuilt_when_tsv_changes(self):
+        self.load()
+        with open(self.tsv, "a", encoding="utf-8") as f:
+            f.write("999\tBaum\t\tbowm\tTree\tBaum\t\t\tFalse\t3\n")
+        self.assertEqual(self.load().words[-1].simplified, "Baum")
+        with patch.object(AnkiDictionary, "saveSnapshot", side_effect=AssertionError("parsed again")):
+            self.assertEqual(self.load().words[-1].simplified, "Baum")
+
+
+class TestHistoryJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "history.tsv")
+        history = AnkiDictionary()
+        history.addNewWords([AnkiWord(str(i), f"字{i}", "", "", "", "", "", "", True, 1) for i in range(20)])
+        history.saveJournaled(self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def load(self):
+        history = AnkiDictionary()
+        history.loadFromFile(self.path, journal=True)
+        return history
+
+    def test_save_appends_only_changes(self):
+        self.assertFalse(os.path.exists(self.path + ".journal"))
+        with open(self.path, encoding="utf-8") as f:
+            before = f.read()
+        history = self.load()
+        history.addNewWords([AnkiWord("3", "字3", "", "", "", "", "", "", True, 4), AnkiWord("5", "字5", "", "", "", "", "", "", True, 1),
+                             AnkiWord("new", "新", "", "", "", "", "", "", True, 2)])
+        history.saveJournaled(self.path)
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual(f.read(), before)
+        with open(self.path + ".journal", encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 2)  # 字5 did not change
+        reloaded = self.load()
+        self.assertEqual(reloaded.wordFromId("3").confidence, 4)
+        self.assertEqual(reloaded.wordFromId("new").simplified, "新")
+        self.assertEqual(len(reloaded.words), 21)
+
+    def test_torn_journal_line_is_ignored(self):
+        history = self.load()
+        history.addNewWords([AnkiWord("3", "字3", "", "", "", "", "", "", True, 4)])
+        history.saveJournaled(self.path)
+        with open(self.path + ".journal", "a", encoding="utf-8") as f:
+            f.write("4\t字4\t\t\t\t")
+        self.assertEqual(self.load().wordFromId("3").confidence, 4)
+        self.assertEqual(self.load().wordFromId("4").confidence, 1)
+
+    def test_compaction(self):
+        stats = RunStats()
+        with patch("anki.JOURNAL_MIN_ENTRIES", 0):
+            history = self.load()
+            history.stats = stats.prefixed("history_")
+            history.addNewWords([AnkiWord(str(i), f"字{i}", "", "", "", "", "", "", True, 3) for i in range(15)])
+            history.saveJournaled(self.path)
+        self.assertFalse(os.path.exists(self.path + ".journal"))
+        self.assertEqual(stats.counters["history_rows_rewritten"], 20)
+        reloaded = AnkiDictionary()
+        reloaded.loadFromFile(self.path)
+        self.assertEqual([w.confidence for w in reloaded.words], [3] * 15 + [1] * 5)
+
+    def test_save_keeps_mode_and_symlink(self):
+        os.chmod(self.path, 0o644)
+        link = os.path.join(self.tmp.name, "link.tsv")
+        os.symlink(self.path, link)
+        history = AnkiDictionary()
+        history.loadFromFile(link)
+        history.addNewWords([AnkiWord("new", "新", "", "", "", "", "", "", True, 2)])
+        history.saveAllToFile(link)
+        Scheduler().saveToFile(link + ".schedule")
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+        reloaded = AnkiDictionary()
+        reloaded.loadFromFile(self.path)
+        self.assertEqual(reloaded.wordFromId("new").simplified, "新")
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(link + ".schedule").st_mode & 0o777, 0o666 & ~umask)
+        self.assertEqual([name for name in os.listdir(self.tmp.name) if name.endswith(".tmp")], [])
+
+
+class TestKnownWordIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "history.tsv")
+        history = AnkiDictionary()
+        history.addNewWords([AnkiWord(str(i), f"字{i}", f"字{i}t" if i % 2 else "", "", "", "", "", "", True, 1 + i % 5) for i in range(20)])
+        history.saveJournaled(self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_built_from_history_and_reused(self):
+        index = KnownWordIndex.load(self.path)
+        self.assertEqual(len(index), 30)
+        self.assertEqual(index.confidence("字3t"), 4)
+        self.assertTrue(os.path.exists(self.path + ".known"))
+        with patch.object(KnownWordIndex, "_readRows", side_effect=AssertionError("history read again")):
+            self.assertEqual(KnownWordIndex.load(self.path).forms, index.forms)
+
+    def test_only_journal_tail_is_read(self):
+        KnownWordIndex.load(self.path)
+        history = AnkiDictionary()
+        history.loadFromFile(self.path, journal=True)
+        history.addNewWords([AnkiWord("new", "新", "", "", "", "", "", "", True, 2)])
+        history.saveJournaled(self.path)  # No index attached, so the saved one is now behind
+        reads = []
+        original = KnownWordIndex._readRows
+        def readRows(index, file_name, offset=0, journal=False):
+            reads.append((os.path.basename(file_name), offset))
+            return original(index, file_name, offset, journal)
+        with patch.object(KnownWordIndex, "_readRows", readRows), patch.object(KnownWordIndex, "save", side_effect=AssertionError("short tail saved")):
+            index = KnownWordIndex.load(self.path)
+        self.assertEqual(reads, [("history.tsv.journal", 0)])
+        self.assertIn("新", index)
+        with patch("anki.KNOWN_REFRESH_ROWS", 0):
+            KnownWordIndex.load(self.path)  # A longer tail is saved into the index
+        with patch.object(KnownWordIndex, "_readRows", side_effect=AssertionError("journal read again")):
+            self.assertIn("新", KnownWordIndex.load(self.path))
+
+    def test_saved_with_history(self):
+        history = AnkiDictionary()
+        history.loadFromFile(self.path, journal=True)
+        history.knownWords = KnownWordIndex.load(self.path)
+        history.addNewWords([AnkiWord("new", "新", "舊", "", "", "", "", "", True, 2)])
+        history.saveJournaled(self.path)
+        with patch.object(KnownWordIndex, "_readRows", side_effect=AssertionError("index out of date")):
+            index = KnownWordIndex.load(self.path)
+        self.assertIn("舊", index)
+        with patch("anki.JOURNAL_MIN_ENTRIES", 0), patch("anki.JOURNAL_COMPACT_RATIO", 0):
+            history.addNewWords([AnkiWord("0", "字0", "", "", "", "", "", "", True, 5)])
+            history.saveJournaled(self.path)
+        self.assertFalse(os.path.exists(self.path + ".journal"))
+        with patch.object(KnownWordIndex, "_readRows", side_effect=AssertionError("index out of date")):
+            self.assertEqual(KnownWordIndex.load(self.path).confidence("字0"), 5)
+
+    def test_filters_like_history(self):
+        history = AnkiDictionary()
+        history.loadFromFile(self.path, journal=True)
+        index = KnownWordIndex.load(self.path)
+        for cls in (AnkiDictionary, CompactAnkiDictionary):
+            results = []
+            for known in (history, index):
+                dictionary = cls()
+                dictionary.addNewWords([AnkiWord(str(i), f"字{i}", f"字{i}t" if i % 3 == 0 else "", "", "", "", "", "", True, 1 + i % 5) for i in range(40)])
+                dictionary.tagsAndNotConfident(known, 3)
+                results.append([w.id for w in dictionary.getTagged()])
+            self.assertEqual(results[0], results[1])
+            self.assertLess(len(results[1]), 40)
+
+    def test_known_rule(self):
+        # Known means last rated at least KNOWN_CONFIDENCE in the history, whatever the deck holds
+        history = AnkiDictionary()
+        history.loadFromFile(self.path, journal=True)
+        historyStore = SqliteAnkiDictionary(os.path.join(self.tmp.name, "history.db"))
+        historyStore.addNewWords(history.words)
+        expected = [str(i) for i in range(40) if i >= 20 or 1 + i % 5 < KNOWN_CONFIDENCE]
+        try:
+            for cls in (AnkiDictionary, CompactAnkiDictionary, SqliteAnkiDictionary):
+                for known in (history, KnownWordIndex.load(self.path), historyStore):
+                    dictionary = SqliteAnkiDictionary(os.path.join(self.tmp.name, "deck.db")) if cls is SqliteAnkiDictionary else cls()
+                    dictionary.words = [AnkiWord(str(i), f"字{i}", "", "", "", "", "", "", True, MINN_CONF) for i in range(40)]
+                    if cls is not SqliteAnkiDictionary and isinstance(known, SqliteAnkiDictionary):
+                        known = KnownWordIndex.load(self.path)
+                    dictionary.tagsAndNotKnown(known)
+                    self.assertEqual([w.id for w in dictionary.getTagged()], expected)
+                    if cls is SqliteAnkiDictionary:
+                        dictionary.close()
+        finally:
+            historyStore.close()
+
+    @patch("anki.anki_cmdLineFlashCards")
+    def test_anki_parse_skips_known_words(self, mock_review):
+        deck = os.path.join(self.tmp.name, "deck.tsv")
+        dictionary = AnkiDictionary()
+        dictionary.words = [AnkiWord(str(i), f"字{i}", "", "", "", "", "", "", False, MINN_CONF) for i in range(5)]
+        dictionary.saveAllToFile(deck)
+        book = os.path.join(self.tmp.name, "book.txt")
+        with open(book, "w", encoding="utf-8") as f:
+            f.write("".join(f"字{i}" for i in range(5)))
+        anki_parse([book], deck, 10, 1, self.path, False, disableCacheFlag=True)
+        reviewed = mock_review.call_args[0][0]
+        self.assertEqual(sorted(w.id for w in reviewed.words), ["0", "1", "2"])  # 字3 and 字4 were rated 4 and 5
+
+    @patch("builtins.input", return_value="5")
+    def test_anki_parse_saves_without_loading_history(self, mock_input):
+        deck = os.path.join(self.tmp.name, "deck.tsv")
+        dictionary = AnkiDictionary()
+        dictionary.words = [AnkiWord(str(i), f"字{i}", "", "", "", "", "", "", False, MINN_CONF) for i in (0, 1, 2, 3, 4, 30)]
+        dictionary.saveAllToFile(deck)
+        book = os.path.join(self.tmp.name, "book.txt")
+        with open(book, "w", encoding="utf-8") as f:
+            f.write("".join(w.simplified for w in dictionary.words))
+        journal, schedule = self.path + ".journal", self.path + ".schedule"
+        for session, appended in enumerate((4, 0)):  # 字0-2 and 字30 are rated 5; then every word is known
+            stats = RunStats()
+            tsvBefore, journalBefore = os.path.getmtime(self.path), os.path.getsize(journal) if os.path.exists(journal) else 0
+            with patch("sys.stdout", new=StringIO()), patch("anki.fileDigest", side_effect=AssertionError("history hashed")):
+                anki_parse([book], deck, 10, 1, self.path, False, disableCacheFlag=True, disableSnapshotFlag=True, stats=stats)
+            self.assertNotIn("history_rows_parsed", stats.counters)
+            self.assertNotIn("history_journal_rows_replayed", stats.counters)
+            self.assertEqual(stats.counters["history_journal_rows_appended"], appended)
+            self.assertEqual(os.path.getmtime(self.path), tsvBefore)
+            if session:
+                self.assertEqual(os.path.getmtime(self.path + ".known"), knownBefore)  # The journal tail is read past it
+            knownBefore = os.path.getmtime(self.path + ".known")
+            with open(journal, "rb") as f:
+                f.seek(journalBefore)
+                self.assertEqual(len(f.readlines()), appended)
+            with open(schedule, encoding="utf-8") as f:
+                self.assertEqual(len(f.readlines()), 1 + 4)  # Header and the four reviews of the first session
+        history = AnkiDictionary()
+        history.loadFromFile(self.path, journal=True)
+        self.assertEqual([(history.wordFromId(id).confidence) for id in ("0", "1", "2", "30")], [5] * 4)
+        saved = KnownWordIndex.load(self.path)
+        os.remove(self.path + ".known")
+        rebuilt = KnownWordIndex.load(self.path)
+        self.assertEqual((rebuilt.forms, rebuilt.words, rebuilt.journalRows), (saved.forms, saved.words, saved.journalRows))
+
+    def test_words_saved_one_at_a_time(self):
+        # As the GUI does after each rating: the first save writes the history, later ones append through the index
+        path = os.path.join(self.tmp.name, "gui.tsv")
+        known = KnownWordIndex()
+        self.assertIsNone(saveLearnedWords(AnkiDictionary(), known, path, [AnkiWord("a", "甲", "", "", "", "", "", "", True, 2)]))
+        with patch.object(AnkiDictionary, "loadFromFile", side_effect=AssertionError("history loaded")):
+            self.assertEqual(saveLearnedWords(AnkiDictionary(), known, path, [AnkiWord("b", "乙", "", "", "", "", "", "", True, 5)]), 1)
+        history = AnkiDictionary()
+        history.loadFromFile(path, journal=True)
+        self.assertEqual([(w.id, w.confidence) for w in history.words], [("a", 2), ("b", 5)])
+        self.assertEqual(KnownWordIndex.load(path).forms, known.forms)
+
+    def test_missing_history(self):
+        index = KnownWordIndex.load(os.path.join(self.tmp.name, "none.tsv"))
+        self.assertEqual(len(index), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "none.tsv.known")))
+
+
+class TestSqliteAnkiDictionary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.tsv = os.path.join(ASSETS, "chineseDictionary.tsv")
+        self.plain = AnkiDictionary()
+        self.plain.loadFromFile(self.tsv)
+        self.store = SqliteAnkiDictionary(os.path.join(self.tmp.name, "deck.db"))
+        self.store.loadFromFile(self.tsv)
+        historyWords = [AnkiWord(w.id, w.simplified, w.traditional, "", "", "", "", "", True, 5) for w in self.plain.words[::5]]
+        self.history = AnkiDictionary()
+        self.history.words = historyWords
+        self.historyStore = SqliteAnkiDictionary(os.path.join(self.tmp.name, "history.db"))
+        self.historyStore.addNewWords(historyWords)
+
+    def tearDown(self):
+        self.store.close()
+        self.historyStore.close()
+        self.tmp.cleanup()
+
+    def tagged(self, d):
+        return [w.id for w in d.getTagged()]
+
+    def test_import_and_lookups(self):
+        self.assertEqual(len(self.store.words), len(self.plain.words))
+        self.assertEqual(self.store.forms(), [(s, t) for s, t in self.plain.forms()])
+        self.assertEqual(self.store.wordFromId("2").simplified, "爱好")
+        self.assertTrue(self.store.hasForm("愛好"))
+        self.assertFalse(self.store.hasForm("not a word"))
+        text = "我的爸爸非常爱我。我喜欢在白天跑步。"
+        self.assertEqual(self.store.countFromText(text), self.plain.countFromText(text))
+
+    def test_history_filters_match_plain(self):
+        counts = [i % 3 for i in range(len(self.plain.words))]
+        for history in (self.history, self.historyStore):
+            for d in (self.plain, self.store):
+                d.clearTags()
+                d.tagFromCounts(counts, 1)
+                d.tagsAndNotConfident(history, 0)
+            self.assertEqual(self.tagged(self.plain), self.tagged(self.store))
+        # In-memory dictionary filtered against the SQLite history
+        self.plain.clearTags()
+        self.plain.tagFromCounts(counts, 1)
+        self.plain.tagsAndNot(self.historyStore)
+        self.store.tagsAndNot(self.historyStore)
+        self.assertEqual(self.tagged(self.plain), self.tagged(self.store))
+
+    def test_upsert_and_explicit_save(self):
+        self.historyStore.addNewWords([AnkiWord("1", "爱", "愛", "ài", "", "", "", "", True, 2), AnkiWord("new", "新", "", "", "", "", "", "", True, 3)])
+        self.assertEqual(self.historyStore.wordFromId("1").confidence, 2)
+        self.assertEqual(self.historyStore.wordFromId("new").simplified, "新")
+        self.assertEqual(len(self.historyStore.words), len(self.history.words) + 1)
+        self.historyStore.addWord(AnkiWord("dup", "新", "", "", "", "", "", "", True, 3))
+        self.assertEqual([w._pos for w in self.historyStore.words], list(range(len(self.history.words) + 2)))
+        self.store.save()
+        self.store.clearTags()
+        self.store.words[0].tag = True
+        cards = self.store.getTaggedRand(5)
+        self.assertEqual(len(cards.words), 1)
+        cards.words[0].confidence = 4
+        self.assertEqual(self.store.wordFromId(cards.words[0].id).confidence, 4)
+        with SqliteAnkiDictionary(self.store.path) as other:  # The session's tag and rating are not in the database yet
+            self.assertEqual((other.getTagged(), other.wordFromId(cards.words[0].id).confidence), ([], self.plain.words[0].confidence))
+        self.store.saveJournaled(self.store.path)
+        with SqliteAnkiDictionary(self.store.path) as other:
+            self.assertEqual([(w.id, w.confidence) for w in other.getTagged()], [(cards.words[0].id, 4)])
+
+    def test_weighted_draw_is_one_query(self):
+        self.store.tagFromCounts([1] * len(self.plain.words), 1)
+        queries = []
+        self.store.conn.set_trace_callback(queries.append)
+        cards = self.store.getTaggedWeighted(5, counts=[i % 7 for i in range(len(self.plain.words))])
+        self.store.conn.set_trace_callback(None)
+        self.assertEqual(len(cards.words), 5)
+        self.assertEqual(len(queries), 1)
+
+    @patch("anki.anki_cmdLineFlashCards")
+    def test_anki_parse_saves_history_only(self, mock_review):
+        def rate(flashcards, scheduler):
+            for word in flashcards.words:
+                word.confidence = 5
+                scheduler.review(word.id, 5)
+        mock_review.side_effect = rate
+        book = os.path.join(self.tmp.name, "book.txt")
+        with open(book, "w", encoding="utf-8") as f:
+            f.write("我的爸爸非常爱我。")
+        self.store.save()
+        self.store.close()
+        closed = []
+        original = SqliteAnkiDictionary.close
+        def close(store):
+            closed.append(os.path.basename(store.path))
+            original(store)
+        with patch.object(SqliteAnkiDictionary, "close", close):
+            anki_parse([book], self.store.path, 3, 1, os.path.join(self.tmp.name, "new.db"), False, disableCacheFlag=True)
+        self.assertEqual(sorted(closed), ["deck.db", "new.db"])
+        self.store = SqliteAnkiDictionary(self.store.path)
+        self.assertEqual(self.store.getTagged(), [])  # The deck keeps what was saved before the session
+        self.assertEqual([w.confidence for w in self.store.words], [w.confidence for w in self.plain.words])
+        with SqliteAnkiDictionary(os.path.join(self.tmp.name, "new.db")) as history:
+            self.assertTrue(len(history.words) >= 3 and all(w.tag for w in history.words))
+            self.assertEqual(sorted(w.confidence for w in history.words)[-3:], [5, 5, 5])
+
+    def test_export_matches_plain(self):
+        self.plain.words[2].tag = True
+        self.store.words[2].tag = True
+        for d, name in ((self.plain, "plain.tsv"), (self.store, "store.tsv")):
+            d.saveAllToFile(os.path.join(self.tmp.name, name))
+        with open(os.path.join(self.tmp.name, "plain.tsv"), encoding="utf-8") as a, open(os.path.join(self.tmp.name, "store.tsv"), encoding="utf-8") as b:
+            self.assertEqual(a.read(), b.read())
+
+
+class TestChapters(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.d = AnkiDictionary()
+        self.d.loadFromFile(os.path.join(ASSETS, "chineseDictionary.tsv"))
+        self.parts = []
+        for name in ["chineseText1.txt", "chineseText2.txt", "chineseText3.txt"]:
+            with open(os.path.join(ASSETS, name), encoding="utf-8") as f:
+                self.parts.append(f.read().rstrip("\n") + "\n")
+        self.book = os.path.join(self.tmp.name, "book.txt")
+        with open(self.book, "w", encoding="utf-8") as f:
+            f.write("序言\n" + "".join(f"第{n}章\n{text}" for n, text in zip("一二三", self.parts)))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_per_chapter_counts_match_separate_files(self):
+        chapters = self.d.countChaptersFromFiles([self.book], r"^第.+章", chunkSize=16)
+        self.assertEqual([(n, t) for n, t, _ in chapters], [(0, ""), (1, "第一章"), (2, "第二章"), (3, "第三章")])
+        for (number, title, counts), text in zip(chapters[1:], self.parts):
+            expected = self.d.countFromText(f"{title}\n{text}")
+            self.assertEqual([counts.get(i, 0) for i in range(len(self.d.words))], expected)
+        self.d.countMode = COUNT_SEGMENT
+        chapters = self.d.countChaptersFromFiles([self.book], r"^第.+章", chunkSize=16)
+        for (number, title, counts), text in zip(chapters[1:], self.parts):
+            self.assertEqual([counts.get(i, 0) for i in range(len(self.d.words))], self.d.countFromText(f"{title}\n{text}"))
+
+    def test_chapter_tags_and_selection(self):
+        chapters = self.d.countChaptersFromFiles([self.book], r"^第.+章")
+        output = os.path.join(self.tmp.name, "chapters.tsv")
+        self.d.saveChaptersToFile(output, chapters, 1)
+        loaded = AnkiDictionary()
+        loaded.loadFromFile(output)
+        perChapter = [self.d.countFromText("序言\n")] + [self.d.countFromText(f"第{n}章\n{text}") for n, text in zip("一二三", self.parts)]
+        expected = [[f"ch0{n}" for n in range(4) if perChapter[n][i]] for i in range(len(self.d.words))]
+        self.assertEqual([w.id for w in loaded.words], [w.id for w, labels in zip(self.d.words, expected) if labels])
+        for word in loaded.words:
+            original = self.d.wordFromId(word.id)
+            self.assertEqual(word.extra1.split(), original.extra1.split() + expected[self.d.words.index(original)])
+        self.d.clearTags()
+        self.d.tagFromChapters(chapters, 1, chapter=2)
+        expected = self.d.countFromText("第二章\n" + self.parts[1])
+        self.assertEqual([w.tag for w in self.d.words], [c >= 1 for c in expected])
+
+    @patch("builtins.input", return_value="5")
+    def test_anki_parse_chapter_output(self, mock_input):
+        deck = os.path.join(self.tmp.name, "deck.tsv")
+        self.d.saveAllToFile(deck)
+        output = os.path.join(self.tmp.name, "chapters.tsv")
+        with patch("sys.stdout", new=StringIO()):
+            anki_parse([self.book], deck, 0, 1, None, True, chapterPattern=r"^第.+章", chapter=2, chapterOutput=output)
+        loaded = AnkiDictionary()
+        loaded.loadFromFile(output)
+        self.assertTrue(loaded.words)
+        self.assertTrue(all(w.tag for w in loaded.words))
+        self.assertTrue(all(any(label.startswith("ch0") for label in w.extra1.split()) for w in loaded.words))
+        with self.assertRaises(ValueError):
+            anki_parse([self.book], deck, 0, 1, None, True, chapterPattern=r"^第.+章", chapter=9)
+
+
+class TestSegmentation(unittest.TestCase):
+
+    def naiveSegment(self, patterns, text):
+        # Reference maximal munch: longest pattern at each position, else skip a character
+        counts = {p: 0 for p in patterns if p}
+        i = 0
+        while i < len(text):
+            best = max((p for p in counts if text.startswith(p, i)), key=len, default=None)
+            if best:
+                counts[best] += 1
+                i += len(best)
+            else:
+                i += 1
+        return counts
+
+    def test_longest_match_tokens(self):
+        patterns = ["爱", "爱好", "好", "爱好者", "我", "喜欢"]
+        matcher = AnkiMatcher(patterns)
+        text = "我爱好。我是爱好者，我喜欢爱。爱好爱" * 3
+        expected = self.naiveSegment(patterns, text)
+        for chunkSize in [1, 2, 3, 5, len(text)]:
+            state = matcher.newState(segment=True)
+            for i in range(0, len(text), chunkSize):
+                matcher.feed(state, text[i:i + chunkSize])
+            counts = matcher.finish(state)
+            self.assertEqual({p: counts[matcher.slotOf[p]] for p in patterns}, expected, f"chunkSize={chunkSize}")
+
+    def test_segment_mode_on_dictionary(self):
+        d = AnkiDictionary()
+        d.loadFromFile(os.path.join(ASSETS, "chineseDictionary.tsv"))
+        ai = d.words.index(d.wordsFromForm("爱")[0])
+        hobby = d.words.index(d.wordsFromForm("爱好")[0])
+        self.assertEqual([d.countFromText("我的爱好")[i] for i in (ai, hobby)], [1, 1])
+        d.countMode = COUNT_SEGMENT
+        self.assertEqual([d.countFromText("我的爱好")[i] for i in (ai, hobby)], [0, 1])
+        drink = d.words.index(d.wordsFromForm("喝")[0])  # Same simplified and traditional form
+        self.assertEqual(d.countFromText("喝")[drink], 1)
+
+class TestLemma(unittest.TestCase):
+
+    def countsOf(self, dictionaryFile, language, textFile):
+        d = AnkiDictionary()
+        d.loadFromFile(os.path.join(ASSETS, dictionaryFile))
+        d.countMode = COUNT_LEMMA
+        d.lemmaLanguage = language
+        counts = d.countFromFile(os.path.join(ASSETS, textFile), chunkSize=7)
+        return {word.simplified: count for word, count in zip(d.words, counts) if count}
+
+    def test_german_inflections(self):
+        counts = self.countsOf("germanDictionary.tsv", "de", "germanText.txt")
+        self.assertEqual(counts["laufen"], 3)  # läuft
+        self.assertEqual(counts["sprechen"], 3)  # spricht
+        self.assertEqual(counts["schnell"], 5)  # schneller
+        self.assertEqual(counts["Haus"], 3)
+        self.assertNotIn("Freundschaft", counts)
+
+    def test_latin_inflections(self):
+        counts = self.countsOf("latinDictionary.tsv", "la", "latinText.txt")
+        for lemma in ("terra", "pulchra", "civitas", "sapientia", "discipulus", "amare"):
+            self.assertEqual(counts[lemma], 1, lemma)
+
+    def test_exact_form_wins_and_chunks(self):
+        matcher = LemmaMatcher(["Haus", "Häuser", "Katze"], "de")
+        text = "Häuser, haus; KATZEN Hausen"
+        expected = matcher.count(text)
+        self.assertEqual(expected, [2, 1, 1])
+        for chunkSize in (1, 2, 3):
+            state = matcher.newState()
+            for i in range(0, len(text), chunkSize):
+                matcher.feed(state, text[i:i + chunkSize])
+            self.assertEqual(matcher.finish(state), expected, f"chunkSize={chunkSize}")
+
+    def test_table(self):
+        matcher = LemmaMatcher(["esse", "ire"], table={"est": ["esse"], "it": ["ire"], "sunt": ["esse"]})
+        self.assertEqual(matcher.count("Est, sunt et it. Estne?"), [2, 1])
+
+class TestRunStats(unittest.TestCase):
+
+    def test_dictionary_counters(self):
+        stats = RunStats()
+        d = AnkiDictionary()
+        d.stats = stats
+        with tempfile.TemporaryDirectory() as tmp:
+            tsv = os.path.join(tmp, "dict.tsv")
+            with open(tsv, "w", encoding="utf-8") as f:
+                f.write("header\n001\t你\t\t\t\t\t\t\tFalse\t1\nbroken line\n002\t好\t\t\t\t\t\t\tFalse\t1\n")
+            text = os.path.join(tmp, "text.txt")
+            with open(text, "w", encoding="utf-8") as f:
+                f.write("你好你")
+            with stats.stage("load"):
+                d.loadFromFile(tsv)
+            d.tagFromFile(text, 1)
+        report = stats.toDict()
+        self.assertEqual(report["counters"], {"rows_parsed": 2, "rows_skipped": 1, "bytes_scanned": 9,
+                                              "files_scanned": 1, "word_occurrences": 3})
+        self.assertEqual(list(report["stages"]), ["load"])
+        self.assertIn("rows_parsed", stats.toTable())
+
+class TestPreview(unittest.TestCase):
+
+    def test_pages_cover_file(self):
+        text = "".join(f"第{i}行，你好世界。\n" for i in range(200))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "book.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            pager = TextPager(path, pageBytes=100)
+            pages, start = [], 0
+            while start is not None:
+                page = pager.page(start)
+                pages.append(page)
+                start = pager.next(page[2])
+            self.assertEqual("".join(p[0] for p in pages), text)
+            self.assertTrue(all(p[0].endswith("\n") for p in pages))
+            for before, page in zip(pages, pages[1:]):
+                self.assertEqual(pager.previous(page[1])[2], page[1])
+            middle = pager.page(pager.seek(0.5))
+            self.assertTrue(middle[0].startswith("第"))
+            self.assertIsNone(pager.previous(0))
+
+    def test_tagged_spans(self):
+        d = AnkiDictionary()
+        d.words = [AnkiWord("001", "你好", "妳好", "", "", "", "", "", True),
+                   AnkiWord("002", "好", "", "", "", "", "", "", False)]
+        self.assertEqual(d.taggedSpans("妳好，你好"), [(0, 2), (3, 5)])
+        self.assertEqual(sorted(AnkiMatcher(["你好", "好"]).matches("你好")), [(0, 2, 0), (1, 2, 1)])
+
+class TestScheduler(unittest.TestCase):
+
+    def test_sm2_intervals(self):
+        scheduler = Scheduler()
+        intervals = [scheduler.review("001", 5, now=0).interval for _ in range(4)]
+        self.assertEqual(intervals[:3], [1, 6, 16])
+        self.assertGreater(intervals[3], intervals[2])
+        state = scheduler.review("001", 1, now=0)
+        self.assertEqual((state.interval, state.reps, state.due), (1, 0, DAY))
+        self.assertGreaterEqual(state.ease, 1.3)
+
+    def test_due_cards_first(self):
+        scheduler = Scheduler()
+        d = AnkiDictionary()
+        d.words = [AnkiWord(f"{i:03d}", f"字{i}", "", "", "", "", "", "", True) for i in range(50)]
+        d.words[7].tag = False
+        for i, rating in [(3, 5), (5, 2), (7, 1), (9, 5)]:
+            scheduler.review(f"{i:03d}", rating, now=0)
+        scheduler.review("009", 5, now=0)  # Due after 6 days now; the old heap entry is stale
+        cards = d.getTaggedDue(4, scheduler, now=2 * DAY)
+        ids = [w.id for w in cards.words]
+        self.assertEqual(ids[:2], ["003", "005"])  # 007 is due but not tagged, 009 is not due yet
+        self.assertEqual(len(set(ids)), 4)
+        self.assertTrue(all(i not in ("007", "009") for i in ids[2:]))
+        compact = CompactAnkiDictionary()
+        compact.words = d.words
+        self.assertEqual([w.id for w in compact.getTaggedDue(2, scheduler, now=2 * DAY).words], ["003", "005"])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "history.tsv.schedule")
+            scheduler.saveToFile(path)
+            loaded = Scheduler()
+            loaded.loadFromFile(path)
+            self.assertEqual(loaded.due(10, now=2 * DAY), ["003", "005", "007"])
+
+    def test_save_appends_reviews(self):
+        scheduler = Scheduler()
+        for i in range(10):
+            scheduler.review(f"{i:03d}", 5, now=0)
+            scheduler.review(f"{i:03d}", 5, now=0)  # Due in 6 days
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "history.tsv.schedule")
+            scheduler.saveToFile(path)
+            loaded = Scheduler()
+            loaded.loadFromFile(path)
+            loaded.review("003", 1, now=0)
+            loaded.review("new", 2, now=0)
+            with patch("scheduler.atomicWrite", side_effect=AssertionError("schedule rewritten")):
+                loaded.saveToFile(path)
+            with open(path, encoding="utf-8") as f:
+                self.assertEqual(len(f.readlines()), 1 + 10 + 2)
+            again = Scheduler()
+            again.loadFromFile(path)
+            self.assertEqual(again.due(20, now=DAY), ["003", "new"])
+            self.assertEqual(len(again), 11)
+            with patch("scheduler.SCHEDULE_MIN_ROWS", 0), patch("scheduler.SCHEDULE_COMPACT_RATIO", 1):
+                again.review("004", 1, now=0)
+                again.saveToFile(path)
+            with open(path, encoding="utf-8") as f:
+                self.assertEqual(len(f.readlines()), 1 + 11)
+
+    def test_new_cards_drawn_uniformly(self):
+        # Tagged words after a long untagged gap must not be favored
+        scheduler = Scheduler()
+        d = AnkiDictionary()
+        d.words = [AnkiWord(f"{i:03d}", f"字{i}", "", "", "", "", "", "", i == 5 or 190 <= i < 199) for i in range(200)]
+        compact = CompactAnkiDictionary()
+        compact.words = d.words
+        for dictionary in (d, compact):
+            picks = {}
+            for _ in range(3000):
+                for word in dictionary.getTaggedDue(2, scheduler, now=0).words:
+                    picks[word.id] = picks.get(word.id, 0) + 1
+            self.assertEqual(len(picks), 10)
+            self.assertTrue(all(450 <= n <= 750 for n in picks.values()), picks)  # 600 expected each
+
+class TestWeightedSampling(unittest.TestCase):
+
+    def test_frequent_words_preferred(self):
+        words = [AnkiWord(f"{i:03d}", f"字{i}", "", "", "", "", "", "", i != 3) for i in range(6)]
+        counts = [1, 1, 1000, 5000, 1, 0]
+        for d in (AnkiDictionary(), CompactAnkiDictionary()):
+            d.words = list(words)
+            d.wordCounts = counts
+            picks = [d.getTaggedWeighted(1).words[0].id for _ in range(300)]
+            self.assertGreater(picks.count("002"), 250)
+            self.assertNotIn("003", picks)  # Not tagged
+            cards = [w.id for w in d.getTaggedWeighted(5).words]
+            self.assertEqual(sorted(cards), ["000", "001", "002", "004", "005"])
+            self.assertEqual(cards[-1], "005")  # Never seen in the text: only drawn when nothing else is left
+
+    def test_due_fill_is_weighted(self):
+        d = AnkiDictionary()
+        d.words = [AnkiWord(f"{i:03d}", f"字{i}", "", "", "", "", "", "", True) for i in range(4)]
+        d.wordCounts = [0, 0, 100, 0]
+        scheduler = Scheduler()
+        scheduler.review("002", 5, now=0)  # Scheduled but not due: never a new card
+        self.assertNotIn("002", [w.id for w in d.getTaggedDue(3, scheduler, now=0, weighted=True).words])
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dictionary = os.path.join(self.tmp.name, "dict.tsv")
+        d = AnkiDictionary()
+        d.words = [AnkiWord("001", "你好", "", "nǐ hǎo", "hello", "", "", "", False),
+                   AnkiWord("002", "世界", "", "shì jiè", "world", "", "", "", False),
+                   AnkiWord("003", "猫", "貓", "māo", "cat", "", "", "", False)]
+        d.saveAllToFile(self.dictionary)
+        self.server = makeServer(AnkiService(cacheDir=None), port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = AnkiClient(f"http://127.0.0.1:{self.server.server_address[1]}", token=self.server.token)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_tag_concurrently(self):
+        results = []
+        def tag():
+            results.append(sorted((w["id"], w["count"]) for w in self.client.tag(self.dictionary, text="你好，世界！貓和猫。你好")))
+        threads = [threading.Thread(target=tag) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[("001", 2), ("002", 1), ("003", 2)]] * 8)
+        self.assertEqual(self.client.status()["dictionaries"][0]["words"], 3)
+
+    def test_cards_and_confidence(self):
+        history = os.path.join(self.tmp.name, "history.tsv")
+        cards = self.client.cards(self.dictionary, text="你好世界", history=history, cards=5)
+        self.assertEqual(sorted(c["id"] for c in cards), ["001", "002"])
+        self.client.confidence(self.dictionary, history, {"001": 5})
+        h = AnkiDictionary()
+        h.loadFromFile(history, journal=True)
+        self.assertEqual((h.wordFromId("001").confidence, len(h.words)), (5, 1))
+        self.assertEqual([c["id"] for c in self.client.cards(self.dictionary, text="你好世界", history=history)], ["002"])
+        with self.assertRaises(AnkiClientError):
+            self.client.confidence(self.dictionary, history, {"999": 3})
+
+    def test_requests_need_local_host_and_token(self):
+        url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        with self.assertRaises(AnkiClientError):
+            AnkiClient(url, token="wrong").tag(self.dictionary, text="你好")
+        # A rebound DNS name reaches the same address, but with a foreign Host header
+        request = urllib.request.Request(url + "/tag", data=json.dumps({"dictionary": self.dictionary, "text": "你好"}).encode(),
+                                         headers={"Content-Type": "application/json", "Host": "attacker.example", "X-Anki-Token": self.server.token})
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            urllib.request.urlopen(request)
+        self.assertEqual(raised.exception.code, 403)
+        raised.exception.close()
+        self.assertEqual(AnkiClient(f"http://localhost:{self.server.server_address[1]}", token=self.server.token).status()["dictionaries"], [])
+
+class TestReaders(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.d = AnkiDictionary()
+        self.d.words = [AnkiWord("001", "你好", "", "", "", "", "", "", False),
+                        AnkiWord("002", "猫", "貓", "", "", "", "", "", False)]
+        self.text = "第一章\n你好，貓！\r\n第二章\n猫和你好。你好\n"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_compressed(self):
+        data = self.text.encode("utf-8")
+        for name, compress in (("book.txt.gz", gzip.compress), ("book.txt.bz2", bz2.compress), ("book.txt.xz", lzma.compress)):
+            with open(self.path(name), "wb") as f:
+                f.write(compress(data))
+            with openText(self.path(name)) as f:
+                self.assertEqual(f.read(), self.text.replace("\r\n", "\n"))
+            self.assertEqual(self.d.countFromFile(self.path(name), chunkSize=3), [3, 2])
+            self.assertEqual(self.d.countFromFile(self.path(name), cache=CountCache(self.path("cache"))), [3, 2])
+
+    def test_chinese_encodings(self):
+        for encoding in ("gb18030", "big5"):
+            text = "你好，貓！猫" if encoding == "gb18030" else "你好，貓！"
+            with open(self.path(encoding + ".txt"), "wb") as f:
+                f.write(text.encode(encoding))
+            self.d.textEncoding = encoding
+            self.assertEqual(self.d.countFromFile(self.path(encoding + ".txt"), chunkSize=1), [1, 2 if encoding == "gb18030" else 1])
+        self.d.textEncoding = "utf-8"
+        self.assertIsNone(self.d.countFromFile(self.path("big5.txt")))
+
+    def test_zip_and_epub(self):
+        with zipfile.ZipFile(self.path("book.zip"), "w") as z:
+            z.writestr("02.txt", "猫和你好。你好")
+            z.writestr("01.txt", "你好，貓！")
+            z.writestr("cover.jpg", b"\xff\xd8")
+        self.assertEqual(self.d.countFromFile(self.path("book.zip")), [3, 2])
+        with zipfile.ZipFile(self.path("book.epub"), "w") as z:
+            z.writestr("mimetype", "application/epub+zip")
+            z.writestr("META-INF/container.xml", '<?xml version="1.0"?><container xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                       '<rootfiles><rootfile full-path="OEBPS/content.opf"/></rootfiles></container>')
+            z.writestr("OEBPS/content.opf", '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf"><manifest>'
+                       '<item id="c1" href="ch1.xhtml"/><item id="c2" href="text/ch2.xhtml"/></manifest>'
+                       '<spine><itemref idref="c1"/><itemref idref="c2"/></spine></package>')
+            z.writestr("OEBPS/ch1.xhtml", "<html><head><title>你好</title></head><body><h1>第一章</h1><p>你&#22909;，貓！</p></body></html>")
+            z.writestr("OEBPS/text/ch2.xhtml", "<html><body><h1>第二章</h1><p>猫和你好</p><script>你好</script></body></html>")
+        with openText(self.path("book.epub")) as f:
+            self.assertEqual([line for line in f.read().split("\n") if line], ["第一章", "你好，貓！", "第二章", "猫和你好"])
+        chapters = self.d.countChaptersFromFiles([self.path("book.epub")], "^第.章")
+        self.assertEqual([(number, title, counts) for number, title, counts in chapters], [(1, "第一章", {0: 1, 1: 1}), (2, "第二章", {0: 1, 1: 1})])
+
+class TestCoverage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dictionary = os.path.join(self.tmp.name, "dict.tsv")
+        d = AnkiDictionary()
+        d.addNewWords([AnkiWord("1", "我", "", "", "I", "", "", "", False), AnkiWord("2", "喜欢", "喜歡", "", "like", "", "", "", False),
+                       AnkiWord("3", "茶", "", "", "tea", "", "", "", False), AnkiWord("4", "咖啡", "", "", "coffee", "", "", "", False),
+                       AnkiWord("5", "茶", "", "", "tea (again)", "", "", "", False)])
+        d.saveAllToFile(self.dictionary)
+        self.history = os.path.join(self.tmp.name, "history.tsv")
+        h = AnkiDictionary()
+        h.addNewWords([AnkiWord("1", "我", "", "", "", "", "", "", True, 5), AnkiWord("2", "喜歡", "", "", "", "", "", "", True, 2)])
+        h.saveJournaled(self.history)
+        self.book = os.path.join(self.tmp.name, "book.txt")
+        with open(self.book, "w", encoding="utf-8") as f:
+            f.write("第一章\n我喜欢茶。我喜欢茶。\n第二章\n我喜歡咖啡咖啡咖啡茶。\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_prefix_sums_and_greedy_words(self):
+        chapters = [(1, "", {0: 4, 1: 1}), (2, "", {0: 1, 1: 2, 2: 5}), (3, "", {})]
+        book = ChapterCoverage(chapters, [KNOWN, LEARNING, UNKNOWN])
+        self.assertEqual(book.totals(), (5, 3, 5))
+        self.assertEqual(book.totals(1, 1), (1, 2, 5))
+        self.assertEqual(book.totals(0, 0), (4, 1, 0))
+        self.assertEqual(book.coverage(0, 0), 80.0)
+        self.assertIsNone(book.coverage(2, 2))
+        self.assertEqual(book.wordsToLearn(80, 0, 0), [])
+        self.assertEqual(book.wordsToLearn(50), [(2, 5)])
+        self.assertEqual(book.wordsToLearn(100), [(2, 5), (1, 3)])
+
+    def test_report(self):
+        report = runCoverage([self.book], self.dictionary, self.history, r"^第.+章", target=75)
+        one, two = report["chapters"]
+        # Chapter one: 我 x2 known, 喜欢 x2 learning (rated 2 as 喜歡), 茶 x2 unknown, counted once for both entries
+        self.assertEqual((one["tokens"], one["known"], one["learning"], one["unknown"]), (6, 33.33, 33.33, 33.33))
+        self.assertEqual((two["tokens"], two["coverage"], two["coverageSoFar"]), (6, 16.67, 25.0))
+        self.assertEqual(two["wordsToTarget"], 2)  # 咖啡 x3 and one more reach 5 of 6
+        scope = report["scope"]
+        self.assertEqual((scope["first"], scope["last"], scope["tokens"]), (1, 2, 12))
+        # 9 of 12 tokens are needed: two of 喜欢, 茶 and 咖啡 (3 each), ties going to the earlier word
+        self.assertEqual([(w["simplified"], w["status"], w["tokens"]) for w in scope["words"]], [("喜欢", "learning", 3), ("茶", "unknown", 3)])
+        self.assertEqual(scope["words"][-1]["coverage"], 75.0)
+        report = runCoverage([self.book], self.dictionary, self.history, r"^第.+章", target=75, knownConfidence=2, first=1, last=1)
+        self.assertEqual((report["scope"]["coverage"], [w["simplified"] for w in report["scope"]["words"]]), (66.67, ["茶"]))
+        with self.assertRaises(ValueError):
+            runCoverage([self.book], self.dictionary, self.history, r"^第.+章", first=3)
+
+    def test_without_history_or_chapters(self):
+        report = runCoverage([self.book], self.dictionary, os.path.join(self.tmp.name, "none.tsv"), target=50)
+        self.assertEqual(len(report["chapters"]), 1)
+        self.assertEqual((report["scope"]["tokens"], report["scope"]["coverage"]), (12, 0.0))
+        self.assertEqual(sum(w["tokens"] for w in report["scope"]["words"]), 6)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "none.tsv.known")))
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        d = AnkiDictionary()
+        d.words = [AnkiWord("001", "你好", "", "nǐ hǎo", "hello", "", "", "", False),
+                   AnkiWord("002", "世界", "", "shì jiè", "world", "", "", "", False),
+                   AnkiWord("003", "猫", "貓", "māo", "cat", "", "", "", False)]
+        d.saveAllToFile(os.path.join(self.tmp.name, "dict.tsv"))
+        for name, text in (("a.txt", "你好世界"), ("b.txt", "貓和猫，你好"), ("c.txt", "世界")):
+            with open(os.path.join(self.tmp.name, name), "w", encoding="utf-8") as f:
+                f.write(text)
+        self.manifest = os.path.join(self.tmp.name, "manifest.json")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def writeManifest(self, manifest):
+        with open(self.manifest, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+    def test_batch(self):
+        self.writeManifest({"output": "decks", "books": [{"book": "a.txt", "dictionary": "dict.tsv"},
+                                                         {"book": "b.txt", "dictionary": "dict.tsv", "requiredCount": 2},
+                                                         {"book": "c.txt", "dictionary": "dict.tsv", "output": "c_deck.tsv"}]})
+        for workers in (1, 2):
+            report = runBatch(loadManifest(self.manifest), workers=workers)
+            self.assertEqual(sorted((os.path.basename(b["book"]), b["tagged"]) for b in report["books"]), [("a.txt", 2), ("b.txt", 1), ("c.txt", 1)])
+            self.assertEqual((report["summary"]["dictionaries"], report["summary"]["failed"]), (1, 0))
+            deck = AnkiDictionary()
+            deck.loadFromFile(os.path.join(self.tmp.name, "decks", "b.tsv"))
+            self.assertEqual([(w.id, w.tag) for w in deck.words], [("003", True)])
+            self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "c_deck.tsv")))
+
+    def test_history_filters_known_words(self):
+        history = AnkiDictionary()
+        history.addNewWords([AnkiWord("001", "你好", "", "", "", "", "", "", True, 5), AnkiWord("x", "貓", "", "", "", "", "", "", True, 1)])
+        history.saveJournaled(os.path.join(self.tmp.name, "history.tsv"))
+        self.writeManifest({"output": "decks", "history": "history.tsv", "books": [{"book": "a.txt", "dictionary": "dict.tsv"},
+                                                                                   {"book": "b.txt", "dictionary": "dict.tsv"}]})
+        report = runBatch(loadManifest(self.manifest))
+        # 你好 is known; 貓 was rated 1, so 猫 is still being learned and stays in b's deck
+        self.assertEqual(sorted((os.path.basename(b["book"]), b["tagged"]) for b in report["books"]), [("a.txt", 1), ("b.txt", 1)])
+        deck = AnkiDictionary()
+        deck.loadFromFile(os.path.join(self.tmp.name, "decks", "a.tsv"))
+        self.assertEqual([w.id for w in deck.words], ["002"])
+
+    def test_manifest_errors(self):
+        self.writeManifest({"books": [{"book": "missing.txt", "dictionary": "dict.tsv"}]})
+        with self.assertRaises(ManifestError):
+            loadManifest(self.manifest)
+        self.writeManifest({"books": ["a.txt"]})
+        with self.assertRaises(ManifestError):
+            loadManifest(self.manifest)
+        os.mkdir(os.path.join(self.tmp.name, "more"))
+        with open(os.path.join(self.tmp.name, "more", "a.txt"), "w", encoding="utf-8") as f:
+            f.write("世界")
+        self.writeManifest({"output": "decks", "books": [{"book": "a.txt", "dictionary": "dict.tsv"},
+                                                         {"book": "more/a.txt", "dictionary": "dict.tsv"}]})
+        with self.assertRaises(ManifestError):
+            loadManifest(self.manifest)
+
+
 # class TestAnkiParseFunction(unittest.TestCase):
     # @patch("builtins.open", new_callable=mock_open, read_data="你好你好")
     # def test_anki_parse(self, mock_file):